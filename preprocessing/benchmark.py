@@ -0,0 +1,858 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the preprocessing pipeline.
+
+Every task runs the old code path and the new one on the same synthetic
+workload, checks that they agree, and reports the throughput of both:
+
+    python benchmark.py --task marker_matcher --n_lines 200000
+"""
+
+import io
+import os
+import json
+import sys
+import time
+import random
+import re
+import argparse
+import tempfile
+from multiprocessing import Pool
+
+from markers import MarkerMatcher, keep_sentence
+from chinese import sent_tokenize as ch_sent_tokenize, MarkerRules
+from sharding import find_shards, iter_shard_lines
+from dedup import FingerprintSet, BloomFilter
+from cfg import EN_DISCOURSE_MARKERS, CH_DISCOURSE_MARKERS  # also sets the utf8 default encoding
+
+parser = argparse.ArgumentParser(description='DisExtract benchmarks')
+parser.add_argument("--task", type=str, default="marker_matcher", help="marker_matcher|sharded_filter|ch_sent_tokenize|ch_marker_rules|dedup|corenlp_batch|corenlp_concurrency|corenlp_endpoints|parse_groups|pos_prescreen|corenlp_output|find_pair|compact_parse|subphrase")
+parser.add_argument("--n_lines", default=200000, type=int, help="size of the synthetic corpus")
+parser.add_argument("--max_seq_len", default=50, type=int)
+parser.add_argument("--min_seq_len", default=5, type=int)
+parser.add_argument("--workers", default=4, type=int, help="largest process pool to try")
+parser.add_argument("--seed", default=123, type=int)
+parser.add_argument("--endpoints", type=str, default=None,
+                    help="comma separated english CoreNLP server urls for corenlp_endpoints")
+parser.add_argument("--standin", default=0, type=int,
+                    help="run the corenlp tasks against this many local stand-in servers instead of CoreNLP")
+parser.add_argument("--standin_fixtures", type=str, default="en_tests_parses.jsonl", help="recorded parses for the stand-ins")
+parser.add_argument("--standin_latency", default=0.02, type=float, help="seconds per request of a stand-in")
+parser.add_argument("--standin_threads", default=4, type=int, help="requests a stand-in serves at a time")
+parser.add_argument("--fake_trees", default=0, type=int,
+                    help="give the en_tests sentences of find_pair, compact_parse and subphrase random trees (fake_parse) "
+                         "instead of parsing them")
+
+FILLER_WORDS = ("the a he she it they was were had said looked at to of in on her his "
+                "room door back away up down could would not just like eyes hand know "
+                "what there from with into over time , . ? ! '' ``").split()
+
+
+def synthetic_english_corpus(n_lines, marker_rate=0.05):
+    """
+    lower-cased BookCorpus-like lines, roughly one in three carries a marker
+    """
+    lines = []
+    for _ in range(n_lines):
+        length = random.randint(2, 30)
+        words = []
+        for _ in range(length):
+            if random.random() < marker_rate:
+                words.extend(random.choice(EN_DISCOURSE_MARKERS + ["for example"]).split())
+            else:
+                words.append(random.choice(FILLER_WORDS))
+        lines.append(u" ".join(words) + u"\n")
+    return lines
+
+
+def report(name, n_items, unit, seconds):
+    print("{:<24} {:>12.0f} {}/sec  ({:.2f}s)".format(name, n_items / seconds, unit, seconds))
+
+
+def timed(fn, *fn_args):
+    start = time.time()
+    result = fn(*fn_args)
+    return result, time.time() - start
+
+
+def marker_matcher(args):
+    markers = EN_DISCOURSE_MARKERS + ["for example"]
+    lines = synthetic_english_corpus(args.n_lines)
+
+    def marker_loop(lines):
+        # the filter loop as it was in bookcorpus.py
+        sentences = {marker: [] for marker in markers}
+        for sentence in lines:
+            words = sentence.replace("for example", "for_example").split()
+            for marker in markers:
+                proxy_marker = "for_example" if marker == "for example" else marker
+                if len(words) >= args.max_seq_len or len(words) < args.min_seq_len:
+                    continue
+                if proxy_marker in words:
+                    sentences[marker].append(sentence)
+        return sentences
+
+    def compiled_matcher(lines):
+        matcher = MarkerMatcher(markers)
+        sentences = {marker: [] for marker in markers}
+        for sentence in lines:
+            if matcher.search(sentence):
+                if not keep_sentence(sentence, u"", True, args.min_seq_len, args.max_seq_len, 0.0, 0.0):
+                    continue
+                for marker in matcher.find(sentence.split()):
+                    sentences[marker].append(sentence)
+        return sentences
+
+    old, old_time = timed(marker_loop, lines)
+    new, new_time = timed(compiled_matcher, lines)
+    for marker in markers:
+        assert old[marker] == new[marker], marker
+
+    print("{} lines, {} with a marker".format(len(lines), len(set(s for m in new for s in new[m]))))
+    report("marker loop", len(lines), "lines", old_time)
+    report("compiled matcher", len(lines), "lines", new_time)
+    print("speedup: {:.1f}x".format(old_time / new_time))
+
+
+def _filter_shard(shard):
+    file_path, start, end = shard
+    matcher = MarkerMatcher(EN_DISCOURSE_MARKERS)
+    pairs = []
+    for previous, sentence in iter_shard_lines(file_path, start, end):
+        if matcher.search(sentence):
+            for marker in sorted(matcher.find(sentence.split())):
+                pairs.append((marker, sentence, previous))
+    return pairs
+
+
+def sharded_filter(args):
+    fd, file_path = tempfile.mkstemp(suffix=".txt")
+    with io.open(fd, 'w', encoding="utf-8") as f:
+        f.writelines(synthetic_english_corpus(args.n_lines))
+
+    try:
+        # reference: one pass over the file, as the filter stage used to do
+        matcher = MarkerMatcher(EN_DISCOURSE_MARKERS)
+        expected = []
+        previous = u""
+        with io.open(file_path, 'rU', encoding="utf-8") as f:
+            for sentence in f:
+                if matcher.search(sentence):
+                    for marker in sorted(matcher.find(sentence.split())):
+                        expected.append((marker, sentence, previous))
+                previous = sentence
+
+        workers = 1
+        base_time = None
+        while workers <= args.workers:
+            shards = [(file_path, start, end) for start, end in find_shards(file_path, workers * 4)]
+            pool = Pool(workers)
+            start_time = time.time()
+            pairs = [p for shard_pairs in pool.imap(_filter_shard, shards) for p in shard_pairs]
+            seconds = time.time() - start_time
+            pool.close()
+            pool.join()
+
+            assert pairs == expected, "{} workers".format(workers)
+            base_time = base_time or seconds
+            report("{} workers".format(workers), args.n_lines, "lines", seconds)
+            print("speedup: {:.1f}x".format(base_time / seconds))
+            workers *= 2
+    finally:
+        os.remove(file_path)
+
+
+def reference_ch_sent_tokenize(p):
+    # gigaword_cn.sent_tokenize before it moved to chinese.py
+    sents = []
+    sent = []
+
+    prev_stop_tok = False  # manual lookahead for ?", !", 。"
+    inside_quot = False
+    for w in p.decode('utf-8'):
+
+        if w == '"'.decode('utf-8') and inside_quot:
+            inside_quot = False
+        elif w == '"'.decode('utf-8'):
+            inside_quot = True
+
+        if prev_stop_tok and w == '"'.decode('utf-8') and not inside_quot:
+            sent.append(w)
+            sents.append("".join(sent))
+            sent = []
+            prev_stop_tok = False
+            continue
+        if prev_stop_tok and not inside_quot:
+            # meaning it's not `“。` scenario
+            sents.append("".join(sent))
+            sent = [w]
+            prev_stop_tok = False
+            continue
+
+        if w == "。".decode('utf-8') or w == "?".decode('utf-8') or w == "!".decode('utf-8'):
+            sent.append(w)
+            prev_stop_tok = True
+        elif w == ";".decode('utf-8') and not inside_quot:
+            sent.append("。")
+            sents.append("".join(sent))
+            sent = []
+        else:
+            sent.append(w)
+
+    if prev_stop_tok:
+        sents.append("".join(sent))
+
+    return sents
+
+
+def ch_sent_tokenize_benchmark(args):
+    # correctness: short random strings over the characters the splitter cares about
+    special = u'"。?!;中文\n'
+    for _ in range(100000):
+        p = u"".join(random.choice(special) for _ in range(random.randint(0, 12)))
+        assert reference_ch_sent_tokenize(p) == ch_sent_tokenize(p), repr(p)
+
+    # speed: gigaword-like paragraphs
+    clause = u"据报导,上个月细螺旋体病已感染了四千八百八十九人"
+    endings = [u"。", u"?", u"!", u";", u",", u'。"', u'"']
+    paragraphs = []
+    for _ in range(args.n_lines // 10):
+        parts = []
+        for _ in range(random.randint(1, 6)):
+            parts.append(clause[:random.randint(5, len(clause))] + random.choice(endings))
+        paragraphs.append(u"".join(parts) + u"\n")
+
+    old, old_time = timed(lambda ps: [reference_ch_sent_tokenize(p) for p in ps], paragraphs)
+    new, new_time = timed(lambda ps: [ch_sent_tokenize(p) for p in ps], paragraphs)
+    assert old == new
+
+    report("per-character loop", len(paragraphs), "paragraphs", old_time)
+    report("compiled splitter", len(paragraphs), "paragraphs", new_time)
+    print("speedup: {:.1f}x".format(old_time / new_time))
+
+
+def reference_ch_marker_filter(sent, discourse_markers, args):
+    # the per-marker checks of gigaword_cn.collect_raw_sentences before MarkerRules
+    out = []
+    for marker in discourse_markers:
+        if marker == "当时" and "当时" in sent and "当时的" not in sent:
+            if len(sent.split(marker)) == 2:
+                s1, s2 = sent.split(marker)
+                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
+                    continue
+                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
+                        s2.decode("utf-8")) < args.min_seq_len:
+                    continue
+            out.append(marker)
+            continue
+        if marker == "而且" and ",而且" in sent:
+            if len(sent.split(marker)) == 2:
+                s1, s2 = sent.split(",而且")
+                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
+                    continue
+                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
+                        s2.decode("utf-8")) < args.min_seq_len:
+                    continue
+            out.append(marker)
+            continue
+        if marker == "而" and ",而" in sent:
+            if len(sent.split(",而")) == 2:
+                s1, s2 = sent.split(",而")
+                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
+                    continue
+                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
+                        s2.decode("utf-8")) < args.min_seq_len:
+                    continue
+            out.append(marker)
+            continue
+        if marker == "但" and ",但" in sent:
+            if len(sent.split(",但是")) == 2 or len(sent.split("但")) == 2:
+                if ",但是" in sent:
+                    s1, s2 = sent.split(",但是")
+                else:
+                    s1, s2 = sent.split(",但")
+                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
+                    continue
+                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
+                        s2.decode("utf-8")) < args.min_seq_len:
+                    continue
+            out.append(marker)
+            continue
+        if marker == "因为" and "因为" in sent and "是因为" not in sent:
+            if len(sent.split("因为")) == 2:
+                s1, s2 = sent.split("因为")
+                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
+                    continue
+                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
+                        s2.decode("utf-8")) < args.min_seq_len:
+                    continue
+            out.append(marker)
+            continue
+        if marker in sent:
+            if len(sent.split(marker)) == 2:
+                s1, s2 = sent.split(marker)
+                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
+                    continue
+                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
+                        s2.decode("utf-8")) < args.min_seq_len:
+                    continue
+            out.append(marker)
+    return out
+
+
+def ch_marker_rules(args):
+    pieces = [u"而且", u"而", u",而", u"但", u",但是", u"是", u"因为", u"是因为", u"当时", u"当时的",
+              u"如果", u"所以", u"据报导", u"上个月", u"细螺旋体病已感染了", u"四千八百八十九人", u","]
+    sentences = []
+    for _ in range(args.n_lines):
+        sentences.append(u"".join(random.choice(pieces) for _ in range(random.randint(1, 10))) + u"。")
+
+    rules = MarkerRules(CH_DISCOURSE_MARKERS, args.min_seq_len, args.max_seq_len)
+    old, old_time = timed(lambda ss: [reference_ch_marker_filter(s, CH_DISCOURSE_MARKERS, args) for s in ss],
+                          sentences)
+    new, new_time = timed(lambda ss: [rules.find(s) for s in ss], sentences)
+    assert old == new
+
+    print("{} sentences, {} kept for at least one marker".format(len(sentences), sum(1 for m in new if m)))
+    report("chained checks", len(sentences), "sentences", old_time)
+    report("rule table", len(sentences), "sentences", new_time)
+    print("speedup: {:.1f}x".format(old_time / new_time))
+
+
+def string_set_nbytes(records):
+    # the set itself plus every tuple and string it keeps alive
+    seen = set(records)
+    return sys.getsizeof(seen) + sum(sys.getsizeof(record) + sum(sys.getsizeof(field) for field in record)
+                                     for record in seen)
+
+
+def dedup_benchmark(args):
+    lines = synthetic_english_corpus(args.n_lines)
+    # every line a few times, like a sentence filtered for several markers or books that repeat
+    records = []
+    for i, line in enumerate(lines):
+        record = (random.choice(EN_DISCOURSE_MARKERS), line, lines[i - 1])
+        records.extend([record] * random.randint(1, 3))
+    random.shuffle(records)
+
+    def string_loop(records):
+        seen = set()
+        kept = []
+        for record in records:
+            if record not in seen:
+                seen.add(record)
+                kept.append(True)
+            else:
+                kept.append(False)
+        return kept
+
+    old, old_time = timed(string_loop, records)
+    old_bytes = string_set_nbytes(records)
+    print("{} records, {} unique".format(len(records), sum(old)))
+    report("string set", len(records), "records", old_time)
+    print("{:<24} {:>12.1f} bytes/record".format("string set", float(old_bytes) / sum(old)))
+
+    for name, dedup in [("fingerprints 64", FingerprintSet(64)), ("fingerprints 128", FingerprintSet(128)),
+                        ("bloom", BloomFilter(sum(old)))]:
+        new, new_time = timed(lambda rs: [dedup.add(record) for record in rs], records)
+        if name != "bloom":
+            assert old == new
+        else:
+            # a bloom filter never keeps a duplicate
+            assert all(o or not n for o, n in zip(old, new))
+            print("bloom dropped {} unique records".format(sum(old) - sum(new)))
+        report(name, len(records), "records", new_time)
+        print("{:<24} {:>12.1f} bytes/record ({:.1f}x less)".format(
+            name, float(dedup.nbytes()) / len(dedup), float(old_bytes) / dedup.nbytes()))
+
+
+def corenlp_batch(args):
+    # needs the english CoreNLP server on EN_PORT, keep --n_lines small
+    from parser import get_parse, get_parses
+
+    sentences = [line.strip().encode("utf-8") for line in synthetic_english_corpus(args.n_lines) if line.strip()]
+
+    old, old_time = timed(lambda ss: [get_parse(s) for s in ss], sentences)
+    for batch_size in [8, 32, 128]:
+        new, new_time = timed(lambda ss: [parse for k in range(0, len(ss), batch_size)
+                                          for parse in get_parses(ss[k:k + batch_size])], sentences)
+        assert old == new
+        report("batches of {}".format(batch_size), len(sentences), "sentences", new_time)
+        print("speedup: {:.1f}x".format(old_time / new_time))
+    report("one request each", len(sentences), "sentences", old_time)
+
+
+def corenlp_concurrency(args):
+    # needs the english CoreNLP server on EN_PORT
+    from parser import depparse_ssplit_stream
+    from corenlp_client import get_client
+
+    items = [(i, line.strip(), u"", random.choice(EN_DISCOURSE_MARKERS))
+             for i, line in enumerate(synthetic_english_corpus(args.n_lines)) if line.strip()]
+
+    results = {}
+    for concurrency in [1, 2, 4, 8, 16]:
+        if concurrency > 1 and concurrency > 2 * args.workers:
+            break
+        results[concurrency], seconds = timed(lambda xs: list(depparse_ssplit_stream(xs, concurrency=concurrency)), items)
+        assert results[concurrency] == results[1]
+        report("concurrency {}".format(concurrency), len(items), "sentences", seconds)
+        print(get_client("en").summary())
+
+
+def corenlp_endpoints(args):
+    # needs one english CoreNLP server for every url in --endpoints
+    from parser import depparse_ssplit_stream
+    from corenlp_client import get_client, set_endpoints
+
+    urls = args.endpoints.split(",")
+    items = [(i, line.strip(), u"", random.choice(EN_DISCOURSE_MARKERS))
+             for i, line in enumerate(synthetic_english_corpus(args.n_lines)) if line.strip()]
+
+    results = {}
+    for n in range(1, len(urls) + 1):
+        set_endpoints("en", urls[:n])
+        # two requests per server, so none of them waits for the client
+        results[n], seconds = timed(lambda xs: list(depparse_ssplit_stream(xs, concurrency=2 * n)), items)
+        assert results[n] == results[1]
+        report("{} servers".format(n), len(items), "sentences", seconds)
+        print(get_client("en").summary())
+
+
+def parse_groups(args):
+    # no server needed, counts the sentences the parse stage sends for the ALL18 records
+    from parser import group_items, GROUP_WINDOW
+
+    matcher = MarkerMatcher(EN_DISCOURSE_MARKERS)
+    items = []
+    previous = u""
+    for sentence in synthetic_english_corpus(args.n_lines):
+        for marker in sorted(matcher.find(sentence.split())):
+            items.append((len(items), sentence, previous, marker))
+        previous = sentence
+
+    groups, seconds = timed(lambda xs: list(group_items(xs)), items)
+    assert sorted(key for keys, _, _, _ in groups for _, key in keys) == range(len(items))
+    print("{} records, {} sentences to parse ({:.2f} records per sentence)".format(
+        len(items), len(groups), float(len(items)) / len(groups)))
+    report("grouping", len(items), "records", seconds)
+
+    # the records of a sentence a few records apart, as with a sentence that comes again
+    rnd = random.Random(0)
+    shuffled = []
+    for start in range(0, len(items), 50):
+        block = items[start:start + 50]
+        rnd.shuffle(block)
+        shuffled.extend(block)
+    for window in (1, 10, GROUP_WINDOW):
+        groups = list(group_items(shuffled, window))
+        print("shuffled within 50 records, window {}: {} sentences to parse".format(window, len(groups)))
+
+
+def pos_prescreen_benchmark(args):
+    # needs the english CoreNLP server on EN_PORT
+    from parser import depparse_ssplit_stream, prescreen_stats
+
+    matcher = MarkerMatcher(EN_DISCOURSE_MARKERS)
+    items = []
+    previous = u""
+    for sentence in synthetic_english_corpus(args.n_lines):
+        for marker in sorted(matcher.find(sentence.split())):
+            items.append((len(items), sentence.strip(), previous.strip(), marker))
+        previous = sentence
+
+    old, old_time = timed(lambda xs: list(depparse_ssplit_stream(xs)), items)
+    new, new_time = timed(lambda xs: list(depparse_ssplit_stream(xs, prescreen=True)), items)
+    assert old == new
+    print(prescreen_stats.summary())
+    report("depparse everything", len(items), "records", old_time)
+    report("POS pre-screen", len(items), "records", new_time)
+    print("speedup: {:.1f}x".format(old_time / new_time))
+
+
+def corenlp_output(args):
+    # needs the english CoreNLP server on EN_PORT, keep --n_lines small
+    import json
+    from corenlp_client import get_client
+    from corenlp_output import request_properties, decode_sentences, lean_sentence, set_output_format, is_binary
+
+    client = get_client("en")
+    sentences = [line.strip().encode("utf-8") for line in synthetic_english_corpus(args.n_lines) if line.strip()]
+    annotators = 'tokenize,ssplit,pos,depparse'
+
+    def run(request, decode):
+        n_bytes = [0]
+        decode_time = [0.0]
+
+        def parse(sentence):
+            response = request(sentence)
+            n_bytes[0] += len(response)
+            start = time.time()
+            parsed = decode(response)
+            decode_time[0] += time.time() - start
+            return parsed
+
+        parsed, seconds = timed(lambda ss: [parse(s) for s in ss], sentences)
+        return parsed, seconds, n_bytes[0], decode_time[0]
+
+    def default_request(sentence):
+        return client.annotate(sentence, "{annotators:'" + annotators + "'}")
+
+    def default_decode(response):
+        return [lean_sentence(s) for s in json.loads(response.replace('\r\n', '').replace('\x19', ''))["sentences"]]
+
+    old, old_time, old_bytes, old_decode = run(default_request, default_decode)
+    report("default json", len(sentences), "sentences", old_time)
+    print("{:<24} {:>12.0f} bytes/sentence, {:.2f}ms decoding".format(
+        "", float(old_bytes) / len(sentences), 1000 * old_decode / len(sentences)))
+
+    for output_format in ["json", "protobuf"]:
+        try:
+            set_output_format(output_format)
+        except ImportError:
+            print("{}: corenlp_protobuf is not installed".format(output_format))
+            continue
+        new, new_time, new_bytes, new_decode = run(
+            lambda s: client.annotate(s, request_properties(annotators), raw=is_binary()), decode_sentences)
+        assert old == new
+        report("lean " + output_format, len(sentences), "sentences", new_time)
+        print("{:<24} {:>12.0f} bytes/sentence, {:.2f}ms decoding".format(
+            "", float(new_bytes) / len(sentences), 1000 * new_decode / len(sentences)))
+        print("speedup: {:.1f}x".format(old_time / new_time))
+    set_output_format("json")
+
+
+FAKE_FILLER_WORDS = {
+    "en": FILLER_WORDS,
+    "sp": u"el la que de en y se un por con no una su para es al lo como más pero sus le ya o , está".split(),
+    "ch": u"我 你 他 的 了 在 是 有 和 人 这 中 大 为 上 个 国 , 说".split(),
+}
+FAKE_TAGS = {
+    "en": ["VBD", "VB", "NN", "NNS", "DT", "JJ", "VBG", "PRP"],
+    "sp": ["VERB", "NOUN", "DET", "ADJ", "PRON", "ADP"],
+    "ch": ["VV", "NN", "AD", "P", "CD", "NR"],
+}
+FAKE_RELATIONS = ["nsubj", "dobj", "det", "amod", "advmod", "punct", "cop", "mark", "cc", "dep", "nmod"]
+
+
+def fake_parse(sentence, lang, rnd):
+    # a random dependency tree over the words of sentence, as CoreNLP's json has it. The marker
+    # words mostly get the POS and the relation of one of their patterns and are attached near a
+    # verb that often has the S1 relation, so that find_pair finds a pair now and then
+    from parser import dependency_patterns
+
+    roles = {}
+    for marker, patterns in sorted(dependency_patterns[lang].items()):
+        for pattern in patterns:
+            roles.setdefault(pattern.get("head", marker), pattern)
+    s1_relations = sorted(set(pattern["S1"] for pattern in roles.values()))
+    verb = FAKE_TAGS[lang][0]
+
+    spans = [(match.group(), match.start(), match.end()) for match in re.finditer(r"\S+", sentence)]
+    words = [word for word, _, _ in spans]
+    tags = []
+    for word in words:
+        if word.lower() in roles and rnd.random() < 0.8:
+            tags.append(roles[word.lower()]["POS"])
+        else:
+            tags.append(rnd.choice(FAKE_TAGS[lang]))
+
+    n = len(words)
+    root = rnd.randint(1, n)
+    governors = {root: 0}
+    relations = {root: "ROOT"}
+    attached = [root]
+    order = [i for i in range(1, n + 1) if i != root]
+    rnd.shuffle(order)
+    for i in order:
+        pattern = roles.get(words[i - 1].lower())
+        if pattern and rnd.random() < 0.85:
+            governors[i] = min(attached, key=lambda a: abs(a - i) + 3 * rnd.random())
+            relations[i] = pattern["S2"]
+            if rnd.random() < 0.8:
+                tags[governors[i] - 1] = verb
+            if governors[i] != root and rnd.random() < 0.5:
+                relations[governors[i]] = pattern["S1"]
+        else:
+            governors[i] = rnd.choice(attached)
+            relations[i] = rnd.choice(FAKE_RELATIONS + s1_relations)
+            if relations[i] in s1_relations and rnd.random() < 0.7:
+                tags[i - 1] = verb
+        attached.append(i)
+
+    def utf16_offset(k):
+        return len(sentence[:k].encode("utf-16-le")) // 2
+
+    tokens = [{"index": i + 1, "word": word, "originalText": word, "pos": tags[i],
+               "characterOffsetBegin": utf16_offset(begin), "characterOffsetEnd": utf16_offset(end)}
+              for i, (word, begin, end) in enumerate(spans)]
+    dependencies = [{"dep": relations[i], "governor": governors[i], "dependent": i,
+                     "governorGloss": words[governors[i] - 1] if governors[i] else "ROOT",
+                     "dependentGloss": words[i - 1]} for i in [root] + sorted(order)]
+    # decoded like a response, with unicode keys and names
+    return json.loads(json.dumps({"index": 0, "tokens": tokens, "basicDependencies": dependencies}))
+
+
+def fake_cases(lang, n, seed):
+    # n (marker, sentence, previous sentence, parse) of random filler words around one or two
+    # markers, each with a random tree from fake_parse
+    from parser import dependency_patterns, cleanup
+
+    rnd = random.Random(seed)
+    markers = sorted(dependency_patterns[lang])
+    cases = []
+    previous = u"x ."
+    for _ in range(n):
+        marker = rnd.choice(markers)
+        words = [rnd.choice(FAKE_FILLER_WORDS[lang]) for _ in range(rnd.randint(4, 30))]
+        words.insert(rnd.randint(0, len(words)), marker)
+        if rnd.random() < 0.5:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(markers))
+        sentence = cleanup(u" ".join(words) + u" .", lang)
+        cases.append((marker, sentence, previous, fake_parse(sentence, lang, rnd)))
+        previous = sentence
+    return cases
+
+
+def reference_sentence():
+    # Sentence with the dependency lookups of before, every one a scan of all the dependencies of
+    # the json, the patterns of a marker matched one by one and the level by level search for phrases
+    from parser import Sentence, dependency_patterns
+
+    class ReferenceSentence(Sentence):
+        def __init__(self, parse, original_sentence, lang):
+            Sentence.__init__(self, parse, original_sentence, lang)
+            self.tokens = parse["tokens"]
+            self.dependencies = parse["basicDependencies"]
+
+        def word(self, index):
+            return self.tokens[int(index) - 1]["word"]
+
+        def pos(self, index):
+            return self.tokens[int(index) - 1]["pos"]
+
+        def relation(self, d):
+            return self.dependencies[d]["dep"]
+
+        def get_subtree_indices(self, head_index, exclude_indices=[], exclude_types=[]):
+            return self.get_subordinate_indices(acc=[head_index], explore=[head_index],
+                                                exclude_indices=exclude_indices, exclude_types=exclude_types)
+
+        def marker_matches(self, marker, lang):
+            # every pattern of the marker tried on its own
+            needs_verb = lang == "en" or lang == "sp"
+            matches = []
+            for pattern_number, dep_pattern in enumerate(dependency_patterns[lang][marker]):
+                for marker_index in self.get_valid_marker_indices(marker, dep_pattern):
+                    s2_candidates = self.get_candidate_S2_indices(marker, marker_index, dep_pattern,
+                                                                  needs_verb=needs_verb)
+                    if s2_candidates:
+                        matches.append(((pattern_number, 0, marker_index), s2_candidates))
+            return matches
+
+        def is_verb(self, index):
+            return self._is_verb(index)
+
+        def find_deps(self, index, dir=None, filter_types=False, exclude_types=False, exclude_type_and_POS=False):
+            # numbers of the dependencies, as Sentence.find_deps gives them
+            deps = []
+            if dir == "parents" or dir is None:
+                deps += [(k, d['governor']) for k, d in enumerate(self.dependencies) if d['dependent'] == index]
+            if dir == "children" or dir is None:
+                deps += [(k, d['dependent']) for k, d in enumerate(self.dependencies) if d['governor'] == index]
+            if filter_types:
+                deps = [(k, other) for k, other in deps if self.dependencies[k]["dep"] in filter_types]
+            if exclude_types:
+                deps = [(k, other) for k, other in deps if not self.dependencies[k]["dep"] in exclude_types]
+            if exclude_type_and_POS:
+                deps = [(k, other) for k, other in deps
+                        if (self.dependencies[k]["dep"], self.pos(other)) not in exclude_type_and_POS]
+            return [k for k, _ in deps]
+
+    return ReferenceSentence
+
+
+def en_test_cases(args):
+    # needs the english CoreNLP server on EN_PORT, --standin with fixtures recorded from en_tests.json
+    # or --fake_trees
+    from parser import get_parses, cleanup, parsed_text
+
+    with open("en_tests.json") as f:
+        items = json.load(f)["test_items"]
+    sentences = [cleanup(item["sentence"].strip()) for item in items]
+    if args.fake_trees:
+        # over the text get_parses would send
+        rnd = random.Random(args.seed)
+        parses = [fake_parse(parsed_text(sentence), "en", rnd) for sentence in sentences]
+    else:
+        parses = get_parses([sentence.encode("utf-8") for sentence in sentences])
+    cases = [(item, sentence, parse) for item, sentence, parse in zip(items, sentences, parses) if parse]
+    if not cases:
+        raise Exception("no parses, start CoreNLP or pass --standin with fixtures")
+    return cases
+
+
+def find_pair_benchmark(args, repeats=20):
+    from parser import Sentence
+
+    cases = en_test_cases(args)
+
+    def match(sentence_class):
+        # find_pair prints the sentences it can not align
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            for _ in range(repeats):
+                pairs = [sentence_class(parse, sentence, "en").find_pair(
+                    item["marker"], "any", item["previous_sentence"].strip()) for item, sentence, parse in cases]
+        finally:
+            sys.stdout = stdout
+        return pairs
+
+    old, old_time = timed(match, reference_sentence())
+    new, new_time = timed(match, Sentence)
+    assert old == new
+    expected = sum(1 for (item, _, _), pair in zip(cases, new) if (list(pair) if pair else None) == item["output"])
+    print("{} of {} parsed test items give the expected pair".format(expected, len(cases)))
+    report("reference", repeats * len(cases), "sentences", old_time)
+    report("indexed", repeats * len(cases), "sentences", new_time)
+    print("speedup: {:.1f}x".format(old_time / new_time))
+
+
+def subphrase_benchmark(args, repeats=20):
+    from parser import Sentence, extract_subphrase
+
+    class RealignedSentence(Sentence):
+        # the parsed words lined up with the words of the original sentence
+        def subphrase(self, indices):
+            return extract_subphrase(self.original_sentence.split(), self.parsed_words(), indices, lang=self.lang)
+
+    class ParsedWordsSentence(Sentence):
+        # the parsed words joined by spaces, as get_phrase_from_head had them
+        def subphrase(self, indices):
+            return " ".join([self.word(i) for i in indices])
+
+    cases = en_test_cases(args)
+
+    def match(sentence_class):
+        # extract_subphrase prints the phrases it can not line up
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            for _ in range(repeats):
+                pairs = [sentence_class(parse, sentence, "en").find_pair(
+                    item["marker"], "any", item["previous_sentence"].strip()) for item, sentence, parse in cases]
+        finally:
+            sys.stdout = stdout
+        return pairs
+
+    def phrases(sentence_class):
+        # the phrase of every token, with nothing excluded
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            found = 0
+            for _, sentence, parse in cases:
+                parsed_sentence = sentence_class(parse, sentence, "en")
+                found += sum(1 for i in range(1, len(parsed_sentence.parse) + 1) if parsed_sentence.get_phrase_from_head(i))
+        finally:
+            sys.stdout = stdout
+        return found
+
+    n_phrases = sum(len(parse["tokens"]) for _, _, parse in cases)
+    print("{} parsed test items, {} with a pair, {} tokens".format(
+        len(cases), sum(1 for item, _, _ in cases if item["output"]), n_phrases))
+    print("{:<16} {:>8} {:>9} {:>9} {:>16}".format("", "pairs", "expected", "phrases", "sentences/sec"))
+    for name, sentence_class in [("offsets", Sentence), ("realigned", RealignedSentence),
+                                 ("parsed words", ParsedWordsSentence)]:
+        pairs, seconds = timed(match, sentence_class)
+        expected = sum(1 for (item, _, _), pair in zip(cases, pairs) if (list(pair) if pair else None) == item["output"])
+        print("{:<16} {:>8} {:>9} {:>8.1%} {:>16.0f}".format(
+            name, sum(1 for pair in pairs if pair), expected, float(phrases(sentence_class)) / n_phrases,
+            repeats * len(cases) / seconds))
+
+
+def deep_size(obj, seen):
+    # bytes of obj and of everything it holds that is not in seen yet
+    from compact_parse import CompactParse
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, CompactParse):
+        size += sum(deep_size(getattr(obj, name), seen) for name in CompactParse.__slots__)
+    return size
+
+
+def compact_parse_benchmark(args, repeats=20):
+    from compact_parse import compact_parse, TAGS, RELATIONS
+    from parser import Sentence
+
+    parses = [parse for _, _, parse in en_test_cases(args)]
+    compact, convert_time = timed(lambda: [[compact_parse(parse) for parse in parses] for _ in range(repeats)][0])
+
+    # the vocabularies are shared by all parses and not counted
+    json_bytes = deep_size(parses, set())
+    compact_bytes = deep_size(compact, set())
+    print("{} parses, {} POS tags and {} relations in the vocabularies".format(len(parses), len(TAGS), len(RELATIONS)))
+    print("{:<24} {:>12.0f} bytes/parse".format("json", float(json_bytes) / len(parses)))
+    print("{:<24} {:>12.0f} bytes/parse".format("compact", float(compact_bytes) / len(parses)))
+    print("{:.1f}x smaller".format(float(json_bytes) / compact_bytes))
+    report("conversion", repeats * len(parses), "parses", convert_time)
+
+    def index(parses):
+        # what find_pair needs of every parse before its patterns are matched
+        for _ in range(repeats):
+            for parse in parses:
+                sentence = Sentence(parse, u"", "en")
+                sentence.index_graph()
+                sentence.pattern_matches("en")
+
+    _, json_time = timed(index, parses)
+    _, compact_time = timed(index, compact)
+    report("from json", repeats * len(parses), "sentences", json_time)
+    report("from compact", repeats * len(parses), "sentences", compact_time)
+
+
+TASKS = {
+    "marker_matcher": marker_matcher,
+    "sharded_filter": sharded_filter,
+    "ch_sent_tokenize": ch_sent_tokenize_benchmark,
+    "ch_marker_rules": ch_marker_rules,
+    "dedup": dedup_benchmark,
+    "corenlp_batch": corenlp_batch,
+    "corenlp_concurrency": corenlp_concurrency,
+    "corenlp_endpoints": corenlp_endpoints,
+    "parse_groups": parse_groups,
+    "pos_prescreen": pos_prescreen_benchmark,
+    "corenlp_output": corenlp_output,
+    "find_pair": find_pair_benchmark,
+    "compact_parse": compact_parse_benchmark,
+    "subphrase": subphrase_benchmark,
+}
+
+def start_standins(args):
+    from corenlp_client import set_endpoints
+    from corenlp_standin import start_standin, load_fixtures
+
+    fixtures = load_fixtures(args.standin_fixtures) if args.standin_fixtures else None
+    servers = [start_standin(fixtures=fixtures, latency=args.standin_latency, threads=args.standin_threads,
+                             seed=args.seed + k) for k in range(args.standin)]
+    args.endpoints = ",".join(server.url for server in servers)
+    set_endpoints("en", servers[0].url)
+    return servers
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    random.seed(args.seed)
+    servers = start_standins(args) if args.standin else []
+    try:
+        TASKS[args.task](args)
+    finally:
+        for server in servers:
+            server.shutdown()
@@ -60,6 +60,11 @@ EN_PORT = 12345
 CH_PORT = 12346
 SP_PORT = 12347
 
+# corenlp servers for each language, requests are spread over all of them (see corenlp_client.py)
+EN_ENDPOINTS = ["http://localhost:{}".format(EN_PORT)]
+CH_ENDPOINTS = ["http://localhost:{}".format(CH_PORT)]
+SP_ENDPOINTS = ["http://localhost:{}".format(SP_PORT)]
+
 _PAD = b"<pad>" # no need to pad
 _UNK = b"<unk>"
 _START_VOCAB = [_PAD, _UNK]
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Durable progress for the filter and parse stages, used by --resume.
+
+A checkpoint is a small json file next to the output. It is only written
+after the output it describes has been synced to disk, and it is replaced
+atomically, so after a crash it always points at output that exists.
+On resume the output is cut back to the length recorded in the checkpoint,
+anything written after it is dropped and produced again, never twice.
+
+Filter checkpoint, sentences/{tag}.ckpt:
+    {"writer": RecordWriter.state(), "position": {"file": ..., <corpus-specific offsets>}}
+
+Parse checkpoint, {output}.ckpt:
+    {"records": records handled, "output_bytes": size of the output, "finished": ...}
+"""
+
+import os
+import json
+import logging
+from os.path import join as pjoin
+
+logger = logging.getLogger(__name__)
+
+
+def save_checkpoint(path, state):
+    with open(path + ".tmp", 'wb') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    """
+    :return: the saved state, None if there is no checkpoint
+    """
+    if not os.path.exists(path):
+        logger.info("no checkpoint at {}, starting from the beginning".format(path))
+        return None
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+def remove_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def sync_file(path):
+    with open(path, 'ab') as f:
+        os.fsync(f.fileno())
+
+
+def truncate_file(path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+
+
+def filter_checkpoint_path(output_dir, marker_set_tag):
+    return pjoin(output_dir, "{}.ckpt".format(marker_set_tag))
+
+
+def load_filter_checkpoint(output_dir, marker_set_tag, resume):
+    """
+    :return: (checkpoint path, saved state or None)
+    """
+    path = filter_checkpoint_path(output_dir, marker_set_tag)
+    if not resume:
+        remove_checkpoint(path)
+        return path, None
+    return path, load_checkpoint(path)
+
+
+def save_filter_checkpoint(path, writer, position):
+    """
+    :param position: where the next run starts, {"file": ..., ...}
+    """
+    save_checkpoint(path, {"writer": writer.state(), "position": position})
+
+
+def resume_position(state, filenames, filename):
+    """
+    :param state: filter checkpoint, or None when not resuming
+    :return: None if filename was finished before the checkpoint,
+             otherwise the saved position within it ({} to start at the top)
+    """
+    if state is None:
+        return {}
+    position = state["position"]
+    if filenames.index(filename) < filenames.index(position["file"]):
+        return None
+    if filename == position["file"]:
+        return None if position.get("finished") else position
+    return {}
+
+
+class ParseProgress(object):
+    """
+    Output file of the parse stage with a checkpoint every `every` records.
+
+    Records are numbered in input order. On resume the records up to
+    `done` are skipped by the caller, and the output is cut back to what was
+    written for them.
+    """
+
+    def __init__(self, output_path, resume=False, every=10000, append=False):
+        self.output_path = output_path
+        self.checkpoint_path = output_path + ".ckpt"
+        self.every = every
+
+        state = load_checkpoint(self.checkpoint_path) if resume else None
+        if state is not None:
+            truncate_file(output_path, state["output_bytes"])
+            self.done = state["records"]
+            self.finished = state["finished"]
+            logger.info("resuming after {} records, {} bytes of output".format(self.done, state["output_bytes"]))
+            if self.finished:
+                logger.info("{} was already finished".format(output_path))
+            mode = 'ab'
+        else:
+            remove_checkpoint(self.checkpoint_path)
+            self.done = 0
+            self.finished = False
+            mode = 'ab' if append else 'wb'
+
+        self.output = open(output_path, mode)
+        self.output.seek(0, os.SEEK_END)
+        self.records = self.done
+
+    def write(self, line):
+        self.output.write(line)
+
+    def save(self, finished=False):
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        save_checkpoint(self.checkpoint_path, {"records": self.records, "output_bytes": self.output.tell(),
+                                               "finished": finished})
+
+    def checkpoint(self, records):
+        """
+        :param records: number of records handled so far, including skipped ones
+        """
+        self.records = records
+        if records % self.every == 0:
+            self.save()
+
+    def close(self):
+        self.save(finished=True)
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the last checkpoint, the tail is dropped on resume
+            self.output.close()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact parses, for Sentence and for keeping many parses in memory.
+
+CoreNLP's JSON output has a dict for every token and every dependency, and
+a lookup in them compares unicode keys with the str literals of the code.
+CompactParse keeps what Sentence reads in parallel arrays instead:
+
+    words                  the words, a tuple
+    tags                   POS of every token, ids in TAGS
+    begins, ends           character offsets of every token
+    governors, dependents  one entry per dependency, in the order of basicDependencies
+    relations              relation of every dependency, ids in RELATIONS
+
+Tokens are numbered from 1 as in CoreNLP, so the POS of token i is
+TAGS.names[parse.tags[i - 1]]. The vocabularies are shared by all parses of
+a process, the ids mean nothing in another process.
+"""
+
+import threading
+from array import array
+
+
+def intern_name(name):
+    """
+    POS tags and relations are ascii. As interned str they compare with the
+    literals in dep_patterns.py and parser.py without decoding.
+    """
+    try:
+        return intern(name.encode("ascii") if isinstance(name, unicode) else name)
+    except UnicodeError:
+        return name
+
+
+class Vocabulary(object):
+    """
+    ids has the names as unicode, as they are in CoreNLP's JSON, and names
+    has them as intern_name gives them.
+    """
+    __slots__ = ("ids", "names", "_lock")
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self._lock = threading.Lock()
+
+    def id(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            # parses are converted by several threads of depparse_ssplit_stream
+            with self._lock:
+                if isinstance(name, str):
+                    name = name.decode("utf-8")
+                i = self.ids.get(name)
+                if i is None:
+                    i = len(self.names)
+                    self.names.append(intern_name(name))
+                    self.ids[name] = i
+        return i
+
+    def __len__(self):
+        return len(self.names)
+
+
+TAGS = Vocabulary()
+RELATIONS = Vocabulary()
+
+
+class CompactParse(object):
+    __slots__ = ("words", "tags", "begins", "ends", "governors", "dependents", "relations")
+
+    def __len__(self):
+        return len(self.words)
+
+
+def compact_parse(json_sentence):
+    """
+    :param json_sentence: a sentence of CoreNLP's JSON output, with tokens and basicDependencies
+    :return: CompactParse of it
+    """
+    # the keys of decoded json are unicode, str keys would be decoded on every lookup
+    tokens = json_sentence[u"tokens"]
+    dependencies = json_sentence[u"basicDependencies"]
+
+    parse = CompactParse()
+    parse.words = tuple(t[u"word"] for t in tokens)
+    parse.tags = array('H', [TAGS.id(t[u"pos"]) for t in tokens])
+    parse.begins = array('i', [t[u"characterOffsetBegin"] for t in tokens])
+    parse.ends = array('i', [t[u"characterOffsetEnd"] for t in tokens])
+    parse.governors = array('H', [d[u"governor"] for d in dependencies])
+    parse.dependents = array('H', [d[u"dependent"] for d in dependencies])
+    parse.relations = array('H', [RELATIONS.id(d[u"dep"]) for d in dependencies])
+    return parse
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""
+HTTP client for the CoreNLP servers.
+
+Every thread keeps its own requests.Session, so connections are kept alive
+between requests instead of being opened for every sentence. The number of
+requests in flight is bounded by the number of threads that call the client,
+see parser.depparse_ssplit_stream, and by the limit described below.
+
+A language can have several servers (EN_ENDPOINTS etc. in cfg.py, or
+--corenlp_endpoints). Each request goes to the live server with the fewest
+requests outstanding, so throughput grows with the number of servers as long
+as --concurrency is at least as large. A server is ejected for a while
+
+    after max_failures connection errors or timeouts in a row
+    when its time per kB sent is slow_factor times the median of the others
+
+and is taken back after eject_seconds (doubled for each ejection in a row).
+The first request after that is its health check: if it fails, it is ejected
+again right away.
+
+A request that times out (after `timeout` seconds without an answer), cannot
+connect or gets a 5xx answer is retried up to `retries` times, on another
+server if there is one. After that the error is raised, so the caller can
+count the lost sentences instead of waiting on a stuck server. A 4xx answer
+is about the request, not the server: it is raised right away, without a retry.
+
+The requests in flight are limited by AIMD (see ConcurrencyLimit): the limit
+grows by one per round of answers that come back about as fast as the
+fastest of the last BASELINE_ANSWERS, and shrinks by a quarter when they get
+slower or fail. The baseline moves with the servers, so one lucky answer (or
+a server that has become slower for good) does not count as queueing forever.
+A CoreNLP server that queues requests gets slower before it fails, so the
+limit settles near what the servers can take without queueing.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+
+import requests
+
+from cfg import EN_ENDPOINTS, SP_ENDPOINTS, CH_ENDPOINTS
+
+logger = logging.getLogger(__name__)
+
+ENDPOINTS = {"en": EN_ENDPOINTS, "ch": CH_ENDPOINTS, "sp": SP_ENDPOINTS, "es": SP_ENDPOINTS}
+
+# weight of the newest request in the latency average
+LATENCY_DECAY = 0.2
+# requests before a server can be called slow
+MIN_REQUESTS = 10
+MAX_EJECT_SECONDS = 600
+CONNECT_TIMEOUT = 10
+# seconds before the first retry of a request that failed on every server, doubled after that
+RETRY_BACKOFF = 1.0
+# an answer slower than this times the fastest recent one per kB counts as queueing
+CONGESTION_TOLERANCE = 2.0
+# answers of a kind the fastest recent one is taken from
+BASELINE_ANSWERS = 50
+# the limit is multiplied by this on queueing or failure
+AIMD_DECREASE = 0.75
+
+
+class ConcurrencyLimit(object):
+    """
+    Additive increase, multiplicative decrease of the requests in flight, as TCP
+    does with its window. Below `threshold` the limit grows by one per answer
+    (slow start), above it by one per limit answers.
+
+    There is no limit until set_maximum is called.
+    """
+
+    def __init__(self):
+        self.maximum = None
+        self.limit = 1.0
+        self.threshold = None
+        self.in_flight = 0
+        self.decreases = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def set_maximum(self, maximum):
+        with self._condition:
+            self.maximum = maximum
+            self.threshold = float(maximum)
+            self.limit = min(self.limit, maximum)
+            self._condition.notify_all()
+
+    def acquire(self):
+        with self._condition:
+            while self.maximum is not None and self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def increase(self):
+        with self._condition:
+            if self.maximum is None:
+                return
+            if self.limit < self.threshold:
+                self.limit += 1
+            else:
+                self.limit += 1.0 / self.limit
+            self.limit = min(self.limit, self.maximum)
+            self._condition.notify()
+
+    def decrease(self, started):
+        """
+        :param started: when the slow or failed request was sent. The requests sent
+                        before the last decrease saw the old limit and do not count again
+        """
+        with self._condition:
+            if self.maximum is None or started < self._last_decrease:
+                return
+            self._last_decrease = time.time()
+            self.limit = max(1.0, self.limit * AIMD_DECREASE)
+            self.threshold = self.limit
+            self.decreases += 1
+
+    def __str__(self):
+        if self.maximum is None:
+            return "no in flight limit"
+        return "in flight limit {:.1f} of {}, lowered {} times".format(self.limit, self.maximum, self.decreases)
+
+
+class Endpoint(object):
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        # requests since it was last taken back
+        self.recent = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.consecutive_ejections = 0
+        self.ejected_until = 0
+        # seconds per kB sent, moving average
+        self.latency = None
+        # seconds per kB of the last BASELINE_ANSWERS answers for each kind of request (properties),
+        # kept across ejections
+        self.baseline = {}
+
+    def is_live(self, now):
+        return self.ejected_until <= now
+
+    def __str__(self):
+        latency = "-" if self.latency is None else "{:.3f}s/kB".format(self.latency)
+        return "{} requests={} failures={} ejections={} latency={}".format(
+            self.url, self.requests, self.failures, self.ejections, latency)
+
+
+class CoreNLPClient(object):
+    def __init__(self, urls, max_failures=3, eject_seconds=30, slow_factor=4.0, timeout=60, retries=2):
+        if isinstance(urls, basestring):
+            urls = [urls]
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.slow_factor = slow_factor
+        self.timeout = timeout
+        self.retries = retries
+        self.limit = ConcurrencyLimit()
+        self.requests = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.rejected = 0
+        self.given_up = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def annotate(self, data, properties, raw=False):
+        """
+        :param data: utf-8 text
+        :param properties: CoreNLP properties, like "{annotators:'tokenize,ssplit'}"
+        :param raw: return the body as bytes, for binary output formats
+        :return: response body
+        :raises requests.RequestException: when the last retry failed
+        """
+        self.limit.acquire()
+        try:
+            return self._annotate(data, properties, raw)
+        finally:
+            self.limit.release()
+
+    def _annotate(self, data, properties, raw):
+        tried = []
+        attempt = 0
+        while True:
+            if len(tried) == len(self.endpoints):
+                # every server failed once, give them a moment before going round again
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - len(self.endpoints)))
+                tried = []
+            endpoint = self._acquire(tried)
+            tried.append(endpoint)
+            start = time.time()
+            try:
+                response = self.session().post(endpoint.url, params={"properties": properties}, data=data,
+                                               timeout=(CONNECT_TIMEOUT, self.timeout))
+                if response.status_code >= 500:
+                    raise requests.HTTPError("{} {}".format(response.status_code, response.reason),
+                                             response=response)
+            except requests.RequestException as e:
+                logger.warning("{} failed: {}".format(endpoint.url, e))
+                self._release(endpoint, failed=True, error=e)
+                self.limit.decrease(start)
+                if attempt == self.retries:
+                    with self._lock:
+                        self.given_up += 1
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                continue
+            if response.status_code >= 400:
+                # about the request, not the server: another server would reject it as well
+                logger.warning("{} rejected the request: {} {}".format(endpoint.url, response.status_code,
+                                                                       response.reason))
+                self._release(endpoint, rejected=True)
+                raise requests.HTTPError("{} {}".format(response.status_code, response.reason), response=response)
+            seconds = time.time() - start
+            if self._release(endpoint, seconds=seconds, n_bytes=len(data), kind=properties):
+                self.limit.decrease(start)
+            else:
+                self.limit.increase()
+            return response.content if raw else response.text
+
+    def check_health(self, timeout=10):
+        """
+        Sends a tiny request to every server, ejects the ones that do not answer.
+
+        :return: urls of the live servers
+        """
+        live = []
+        for endpoint in self.endpoints:
+            try:
+                self.session().post(endpoint.url, params={"properties": "{annotators:'tokenize'}"},
+                                    data="ping", timeout=timeout)
+            except requests.RequestException as e:
+                logger.warning("{} is not answering: {}".format(endpoint.url, e))
+                with self._lock:
+                    self._eject(endpoint, time.time())
+                continue
+            live.append(endpoint.url)
+        return live
+
+    def set_max_concurrency(self, maximum):
+        self.limit.set_maximum(maximum)
+
+    def summary(self):
+        with self._lock:
+            lines = ["corenlp: {} requests, {} retried, {} timed out, {} other errors, {} rejected, {} given up; {}"
+                     .format(self.requests, self.retried, self.timeouts, self.errors, self.rejected, self.given_up,
+                             self.limit)]
+            return "\n".join(lines + [str(endpoint) for endpoint in self.endpoints])
+
+    def _acquire(self, tried):
+        with self._lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if e not in tried]
+            live = [e for e in candidates if e.is_live(now)]
+            if live:
+                # a new server has no latency yet and gets the next request
+                endpoint = min(live, key=lambda e: (e.outstanding, e.latency or 0))
+            else:
+                # everything left is ejected, try the one that comes back first
+                endpoint = min(candidates, key=lambda e: e.ejected_until)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release(self, endpoint, failed=False, seconds=None, n_bytes=None, kind=None, error=None, rejected=False):
+        """
+        :param rejected: a 4xx answer, which says nothing about the server
+        :return: True if the answer was slow enough to mean that the server queues requests
+        """
+        with self._lock:
+            now = time.time()
+            self.requests += 1
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            endpoint.recent += 1
+
+            if rejected:
+                self.rejected += 1
+                return False
+
+            if failed:
+                if isinstance(error, requests.Timeout):
+                    self.timeouts += 1
+                else:
+                    self.errors += 1
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                # a server that was just taken back gets one chance
+                if endpoint.consecutive_failures >= self.max_failures or endpoint.consecutive_ejections > 0:
+                    self._eject(endpoint, now)
+                return False
+
+            endpoint.consecutive_failures = 0
+            endpoint.consecutive_ejections = 0
+            latency = seconds / max(1.0, n_bytes / 1000.0)
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += LATENCY_DECAY * (latency - endpoint.latency)
+            if kind not in endpoint.baseline:
+                endpoint.baseline[kind] = deque(maxlen=BASELINE_ANSWERS)
+            recent = endpoint.baseline[kind]
+            fastest = min(recent) if recent else latency
+            recent.append(latency)
+
+            if endpoint.recent >= MIN_REQUESTS and self._is_slow(endpoint, now):
+                logger.warning("{} is slow ({:.3f}s/kB)".format(endpoint.url, endpoint.latency))
+                self._eject(endpoint, now)
+            return latency > CONGESTION_TOLERANCE * fastest
+
+    def _is_slow(self, endpoint, now):
+        others = sorted(e.latency for e in self.endpoints
+                        if e is not endpoint and e.is_live(now) and e.latency is not None)
+        # never eject the last live server for being slow
+        if not others:
+            return False
+        median = others[len(others) // 2]
+        return endpoint.latency > self.slow_factor * median
+
+    def _eject(self, endpoint, now):
+        if not endpoint.is_live(now):
+            return
+        seconds = min(self.eject_seconds * 2 ** endpoint.consecutive_ejections, MAX_EJECT_SECONDS)
+        endpoint.ejected_until = now + seconds
+        endpoint.ejections += 1
+        endpoint.consecutive_ejections += 1
+        endpoint.consecutive_failures = 0
+        # judged afresh when it is back
+        endpoint.recent = 0
+        endpoint.latency = None
+        logger.warning("ejecting {} for {}s".format(endpoint.url, seconds))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def set_endpoints(lang, urls):
+    """
+    :param urls: list of server urls, or a comma separated string of them
+    """
+    if isinstance(urls, basestring):
+        urls = [url.strip() for url in urls.split(",") if url.strip()]
+    with _clients_lock:
+        _clients[lang] = CoreNLPClient(urls)
+
+
+def get_client(lang):
+    with _clients_lock:
+        if lang not in _clients:
+            _clients[lang] = CoreNLPClient(ENDPOINTS[lang])
+        return _clients[lang]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of corenlp_client.py and of how get_parses copes with failed batches,
+against the stand-in server (corenlp_standin.py):
+
+    python -m unittest corenlp_client_test
+"""
+
+import json
+import unittest
+
+import requests
+
+import corenlp_client
+import parser
+from corenlp_client import CoreNLPClient, CONGESTION_TOLERANCE, BASELINE_ANSWERS
+from corenlp_standin import start_standin
+
+
+def standin_stats(server):
+    return json.loads(requests.get(server.url + "/stats").text)
+
+
+class ClientTest(unittest.TestCase):
+
+    def serve(self, **options):
+        server = start_standin(**options)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_4xx_is_not_retried(self):
+        server = self.serve()
+        client = CoreNLPClient([server.url], retries=2)
+        # the stand-in only writes json
+        with self.assertRaises(requests.HTTPError):
+            client.annotate("A sentence .", json.dumps({"annotators": "tokenize", "outputFormat": "serialized"}))
+        self.assertEqual(standin_stats(server)["requests"], 1)
+        self.assertEqual((client.rejected, client.retried, client.errors), (1, 0, 0))
+        # and the server is not held responsible for it
+        self.assertEqual((client.endpoints[0].failures, client.endpoints[0].ejections), (0, 0))
+
+    def test_5xx_is_retried(self):
+        server = self.serve(error_rate=1.0)
+        corenlp_client.RETRY_BACKOFF, backoff = 0.0, corenlp_client.RETRY_BACKOFF
+        self.addCleanup(setattr, corenlp_client, "RETRY_BACKOFF", backoff)
+        client = CoreNLPClient([server.url], retries=2)
+        with self.assertRaises(requests.HTTPError):
+            client.annotate("A sentence .", json.dumps({"annotators": "tokenize"}))
+        self.assertEqual(standin_stats(server)["requests"], 3)
+        self.assertEqual((client.retried, client.given_up), (2, 1))
+
+    def test_baseline_moves_on(self):
+        client = CoreNLPClient(["http://localhost:1"])
+        endpoint = client.endpoints[0]
+
+        def answer(seconds):
+            endpoint.outstanding += 1
+            return client._release(endpoint, seconds=seconds, n_bytes=1000, kind="k")
+
+        for _ in range(10):
+            self.assertFalse(answer(1.0))
+        self.assertFalse(answer(0.1))
+        # slower than the lucky answer, until it is out of the window
+        slow = [answer(1.0) for _ in range(BASELINE_ANSWERS + 10)]
+        self.assertTrue(all(slow[:BASELINE_ANSWERS]))
+        self.assertFalse(any(slow[BASELINE_ANSWERS:]))
+        self.assertTrue(answer(1.0 * CONGESTION_TOLERANCE + 0.1))
+
+
+class BatchFailureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = start_standin(max_words=10)
+        self.addCleanup(self.server.shutdown)
+        # one try per request, a split batch costs no waiting
+        corenlp_client._clients["en"] = CoreNLPClient([self.server.url], retries=0)
+        self.addCleanup(corenlp_client._clients.pop, "en")
+        parser.set_parse_cache(None)
+        parser.parse_stats = parser.ParseStats()
+
+    def test_a_long_sentence_only_loses_itself(self):
+        sentences = ["This is sentence number {} .".format(i) for i in range(8)]
+        sentences[5] = " ".join(["word"] * 20) + " ."
+        parses = parser.get_parses(sentences)
+        self.assertEqual([k for k, parse in enumerate(parses) if parse is None], [5])
+        self.assertEqual([parse["tokens"][4]["word"] for k, parse in enumerate(parses) if k != 5],
+                         [str(i) for i in range(8) if i != 5])
+        self.assertGreater(parser.parse_stats.batch_splits, 0)
+        self.assertEqual(parser.parse_stats.failed, 1)
+        self.assertEqual(parser.parse_stats.sent, 8)
+
+    def test_unreachable_servers_give_up_the_batch(self):
+        corenlp_client._clients["en"] = CoreNLPClient(["http://localhost:1"], retries=0)
+        parses = parser.get_parses(["This is sentence number {} .".format(i) for i in range(4)])
+        self.assertEqual(parses, [None] * 4)
+        self.assertEqual(parser.parse_stats.batch_splits, 0)
+        self.assertEqual(parser.parse_stats.failed, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Request properties and response decoding for the CoreNLP server.
+
+Sentence only reads the tokens and the basic dependencies of a parse, so
+requests ask for compact output and everything else is dropped on decoding
+(the enhanced and enhanced++ graphs are most of a default response).
+
+    json      JSON without pretty printing. It is decoded with ujson if that is
+              installed, and with json.loads(strict=False) otherwise, which
+              accepts the control characters that made json.loads fail before
+    protobuf  CoreNLP's serialized protocol buffers, decoded with the
+              corenlp_protobuf package (pip install corenlp-protobuf)
+
+Both give the same sentence dicts as the server's JSON output.
+"""
+
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+OUTPUT_FORMATS = ["json", "protobuf"]
+
+# the parts of a parsed sentence that are kept
+SENTENCE_KEYS = ("index", "tokens", "basicDependencies")
+
+_output_format = "json"
+
+
+def set_output_format(output_format):
+    global _output_format
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception("unknown output format {}, use one of {}".format(output_format, OUTPUT_FORMATS))
+    if output_format == "protobuf":
+        # fail now rather than on the first response
+        import corenlp_protobuf
+    _output_format = output_format
+
+
+def is_binary():
+    return _output_format == "protobuf"
+
+
+def request_properties(annotators, **extra):
+    """
+    :param extra: more CoreNLP properties, like ssplit.newlineIsSentenceBreak
+    :return: the properties parameter of an annotate request
+    """
+    properties = {"annotators": annotators}
+    if _output_format == "protobuf":
+        properties["outputFormat"] = "serialized"
+        properties["serializer"] = "edu.stanford.nlp.pipeline.ProtobufAnnotationSerializer"
+    else:
+        properties["outputFormat"] = "json"
+        properties["output.prettyPrint"] = "false"
+    properties.update(extra)
+    return json.dumps(properties)
+
+
+def lean_sentence(sentence):
+    return dict((key, sentence[key]) for key in SENTENCE_KEYS if key in sentence)
+
+
+def decode_sentences(response):
+    """
+    :param response: body of an annotate request, bytes for protobuf
+    :return: the parsed sentences, with SENTENCE_KEYS only
+    :raises ValueError: if the response can not be decoded
+    """
+    if _output_format == "protobuf":
+        return [sentence_from_proto(sentence) for sentence in parse_document(response).sentence]
+
+    response = response.replace('\r\n', '')
+    response = response.replace('\x19', '')
+    parsed_output = None
+    if ujson is not None:
+        try:
+            parsed_output = ujson.loads(response)
+        except ValueError:
+            pass
+    if parsed_output is None:
+        parsed_output = json.loads(response, strict=False)
+    return [lean_sentence(sentence) for sentence in parsed_output["sentences"]]
+
+
+def parse_document(response):
+    from corenlp_protobuf import Document, parseFromDelimitedString
+
+    document = Document()
+    try:
+        parseFromDelimitedString(document, response)
+    except Exception as e:
+        raise ValueError("bad protobuf response: {}".format(e))
+    return document
+
+
+def sentence_from_proto(sentence):
+    """
+    :param sentence: corenlp_protobuf Sentence
+    :return: the dict the JSON output has for it
+    """
+    tokens = []
+    for i, token in enumerate(sentence.token):
+        tokens.append({"index": i + 1, "word": token.word, "originalText": token.originalText,
+                       "characterOffsetBegin": token.beginChar, "characterOffsetEnd": token.endChar,
+                       "pos": token.pos, "before": token.before, "after": token.after})
+
+    graph = sentence.basicDependencies
+    dependencies = [{"dep": "ROOT", "governor": 0, "governorGloss": "ROOT",
+                     "dependent": root, "dependentGloss": tokens[root - 1]["word"]} for root in graph.root]
+    # the JSON output lists the edges ordered by dependent, then governor, then relation
+    for edge in sorted(graph.edge, key=lambda e: (e.target, e.source, e.dep)):
+        dependencies.append({"dep": edge.dep, "governor": edge.source, "governorGloss": tokens[edge.source - 1]["word"],
+                             "dependent": edge.target, "dependentGloss": tokens[edge.target - 1]["word"]})
+
+    return {"index": sentence.sentenceIndex, "tokens": tokens, "basicDependencies": dependencies}
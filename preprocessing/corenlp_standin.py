@@ -0,0 +1,376 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A stand-in for the CoreNLP server, for tests and benchmarks without Java.
+
+It answers annotate requests like the real server, from recorded parses:
+
+    python corenlp_standin.py --record sentences.txt --fixtures en_fixtures.jsonl
+    python corenlp_standin.py --port 12345 --fixtures en_fixtures.jsonl --latency 0.05 --error_rate 0.01
+
+The first command parses every line of sentences.txt with the real server and
+stores the responses. The second serves them. --record en_tests.json records
+the sentences of the parser tests as depparse_ssplit sends them, into
+en_tests_parses.jsonl (the same for sp and ch), see parser_test.py --standin.
+Fixtures are json lines:
+
+    {"text": text as sent in a request of its own, "sentences": [parsed sentences]}
+
+A request is split at line breaks when it asks for
+ssplit.newlineIsSentenceBreak, the way batches are sent (see get_parses).
+Each part is looked up in the fixtures and the character offsets are moved
+to where the part starts. Text that is not in the fixtures gets a made-up parse:
+whitespace tokens, tagged NN, all attached to the first one.
+
+Faults are drawn per request:
+
+    --latency, --jitter       seconds before answering, plus up to jitter more
+    --latency_per_sentence    more seconds for each input
+    --threads                 requests served at a time, the rest queue (CoreNLP's -threads)
+    --error_rate              answer HTTP 500
+    --drop_rate               close the connection without an answer
+    --hang_rate               wait --hang_seconds before answering, for client timeouts
+    --max_words               answer HTTP 500 to a request with a longer input, the way
+                              CoreNLP's own -timeout runs out on one sentence of a batch
+
+GET /stats returns the counts of requests, fixture hits and faults.
+"""
+
+import re
+import sys
+import json
+import time
+import copy
+import random
+import socket
+import logging
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+reload(sys)
+sys.setdefaultencoding('utf8')
+
+logger = logging.getLogger(__name__)
+
+PUNCTUATION_TAGS = set(u'.,:;!?')
+
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def load_fixtures(path):
+    fixtures = {}
+    with open(path, 'rb') as f:
+        for line in f:
+            record = json.loads(line)
+            fixtures[record["text"]] = record["sentences"]
+    return fixtures
+
+
+def record_fixtures(texts, path, lang="en"):
+    """
+    Parses every text with the CoreNLP server of lang and stores the responses.
+    """
+    from corenlp_client import get_client
+    from corenlp_output import request_properties, decode_sentences
+
+    client = get_client(lang)
+    properties = request_properties('tokenize,ssplit,pos,depparse')
+    n = 0
+    with open(path, 'wb') as f:
+        for text in texts:
+            sentences = decode_sentences(client.annotate(text.encode("utf-8"), properties))
+            f.write(json.dumps({"text": text, "sentences": sentences}) + "\n")
+            n += 1
+    return n
+
+
+def fixtures_path_for_tests(tests_path):
+    return re.sub(r"\.json$", "_parses.jsonl", tests_path)
+
+
+def texts_for_tests(tests_path, lang="en"):
+    """
+    The texts depparse_ssplit sends for the test items and curious cases of a
+    parser test file (en_tests.json etc.).
+    """
+    from parser import cleanup, parsed_text
+
+    with open(tests_path, 'rb') as f:
+        data = json.load(f)
+    texts = []
+    for item in data["test_items"] + data["curious_cases"]:
+        text = parsed_text(cleanup(item["sentence"].strip(), lang).encode("utf-8"), lang).decode("utf-8")
+        if text not in texts:
+            texts.append(text)
+    return texts
+
+
+def synthesize_sentence(text):
+    tokens = []
+    for i, m in enumerate(re.finditer(r'\S+', text)):
+        word = m.group()
+        begin = utf16_len(text[:m.start()])
+        tokens.append({"index": i + 1, "word": word, "originalText": word,
+                       "characterOffsetBegin": begin, "characterOffsetEnd": begin + utf16_len(word),
+                       "pos": word if word in PUNCTUATION_TAGS else "NN", "before": "", "after": ""})
+    dependencies = []
+    if tokens:
+        dependencies.append({"dep": "ROOT", "governor": 0, "governorGloss": "ROOT",
+                             "dependent": 1, "dependentGloss": tokens[0]["word"]})
+    for token in tokens[1:]:
+        dependencies.append({"dep": "dep", "governor": 1, "governorGloss": tokens[0]["word"],
+                             "dependent": token["index"], "dependentGloss": token["word"]})
+    return [{"index": 0, "tokens": tokens, "basicDependencies": dependencies}] if tokens else []
+
+
+def read_properties(properties):
+    """
+    The properties the stand-in looks at. CoreNLP also accepts the unquoted
+    form "{annotators:'tokenize'}", so this does not parse json.
+    """
+    def value(key):
+        m = re.search(re.escape(key) + r"""['"]?\s*:\s*['"]([^'"]*)['"]""", properties)
+        return m.group(1) if m else None
+
+    return {"annotators": value("annotators") or "tokenize,ssplit,pos,depparse",
+            "newline_break": value("ssplit.newlineIsSentenceBreak") == "always",
+            "output_format": value("outputFormat") or "json"}
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fixtures=None, latency=0.0, jitter=0.0, latency_per_sentence=0.0, threads=None,
+                 error_rate=0.0, drop_rate=0.0, hang_rate=0.0, hang_seconds=60.0, max_words=None, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+        self.fixtures = fixtures or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_per_sentence = latency_per_sentence
+        self.slots = threading.Semaphore(threads) if threads else None
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.max_words = max_words
+        self.random = random.Random(seed)
+
+        self.stats = {"requests": 0, "inputs": 0, "fixture_hits": 0, "fixture_misses": 0,
+                      "errors": 0, "drops": 0, "hangs": 0, "too_long": 0}
+        self.lock = threading.Lock()
+        self.connections = set()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(self.server_address[0], self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        # clients that time out or go away are part of the test
+        logger.debug("lost the connection to {}".format(client_address))
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def shutdown(self):
+        """
+        Stops serving and ends the connections clients keep alive, so that no
+        handler is left waiting for a request when the process exits.
+        """
+        BaseHTTPServer.HTTPServer.shutdown(self)
+        with self.lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # the handlers end on their own; a hanging one (--hang_rate) is not waited for
+        deadline = time.time() + 1.0
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
+        self.server_close()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def draw(self):
+        # one number picks the fault, the other the jitter; seeded runs repeat the same faults
+        with self.lock:
+            return self.random.random(), self.random.random()
+
+    def annotate(self, text, properties):
+        if properties["newline_break"]:
+            parts = []
+            start = 0
+            for line in text.split(u"\n"):
+                parts.append((start, line))
+                start += len(line) + 1
+        else:
+            parts = [(0, text)]
+
+        sentences = []
+        for start, part in parts:
+            if not part.strip():
+                continue
+            self.count("inputs")
+            parsed = self.fixtures.get(part)
+            if parsed is None:
+                self.count("fixture_misses")
+                parsed = synthesize_sentence(part)
+            else:
+                self.count("fixture_hits")
+
+            offset = utf16_len(text[:start])
+            for sentence in parsed:
+                sentence = copy.deepcopy(sentence)
+                sentence["index"] = len(sentences)
+                for token in sentence["tokens"]:
+                    token["characterOffsetBegin"] += offset
+                    token["characterOffsetEnd"] += offset
+                if "depparse" not in properties["annotators"]:
+                    sentence.pop("basicDependencies", None)
+                sentences.append(sentence)
+        return sentences
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keeps connections alive, like the real server
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path.startswith("/stats"):
+            with self.server.lock:
+                self.respond(200, json.dumps(self.server.stats))
+        else:
+            self.respond(200, "pong")
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        properties = read_properties(query.get("properties", ["{}"])[0])
+        server.count("requests")
+
+        if server.slots is not None:
+            server.slots.acquire()
+        try:
+            fault, jitter = server.draw()
+            if fault < server.drop_rate:
+                server.count("drops")
+                self.close_connection = 1
+                return
+            fault -= server.drop_rate
+            if fault < server.error_rate:
+                server.count("errors")
+                self.respond(500, "injected error")
+                return
+            fault -= server.error_rate
+            if fault < server.hang_rate:
+                server.count("hangs")
+                time.sleep(server.hang_seconds)
+
+            if properties["output_format"] != "json":
+                self.respond(400, "the stand-in only writes json")
+                return
+
+            text = body.decode("utf-8")
+            if server.max_words is not None and any(len(line.split()) > server.max_words
+                                                    for line in text.split(u"\n")):
+                server.count("too_long")
+                self.respond(500, "CoreNLP request timed out. Your document may be too long.")
+                return
+
+            sentences = server.annotate(text, properties)
+            time.sleep(server.latency + jitter * server.jitter + server.latency_per_sentence * len(sentences))
+            self.respond(200, json.dumps({"sentences": sentences}))
+        finally:
+            if server.slots is not None:
+                server.slots.release()
+
+    def respond(self, status, body):
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except socket.error:
+            # the client gave up on this request
+            self.close_connection = 1
+
+
+def start_standin(port=0, host="localhost", **options):
+    """
+    Runs a stand-in in a background thread, port 0 picks a free port.
+
+    :param options: see StandinServer
+    :return: the server, stop it with shutdown()
+    """
+    server = StandinServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CoreNLP stand-in server')
+    parser.add_argument("--port", default=12345, type=int)
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--fixtures", type=str, default=None, help="json lines of recorded parses")
+    parser.add_argument("--record", type=str, default=None,
+                        help="file with one sentence per line to parse with the real server into --fixtures, "
+                             "or a parser test file like en_tests.json")
+    parser.add_argument("--lang", type=str, default="en", help="server to record from, en|ch|sp")
+    parser.add_argument("--latency", default=0.0, type=float, help="seconds per request")
+    parser.add_argument("--jitter", default=0.0, type=float, help="up to this many more seconds per request")
+    parser.add_argument("--latency_per_sentence", default=0.0, type=float)
+    parser.add_argument("--threads", default=None, type=int, help="requests served at a time, unlimited by default")
+    parser.add_argument("--error_rate", default=0.0, type=float)
+    parser.add_argument("--drop_rate", default=0.0, type=float)
+    parser.add_argument("--hang_rate", default=0.0, type=float)
+    parser.add_argument("--hang_seconds", default=60.0, type=float)
+    parser.add_argument("--max_words", default=None, type=int, help="fail requests with a longer input")
+    parser.add_argument("--seed", default=None, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+
+    if args.record and args.record.endswith(".json"):
+        texts = texts_for_tests(args.record, args.lang)
+        fixtures_path = args.fixtures or fixtures_path_for_tests(args.record)
+        logger.info("recorded {} parses to {}".format(record_fixtures(texts, fixtures_path, args.lang), fixtures_path))
+    elif args.record:
+        with open(args.record, 'rb') as f:
+            texts = [line.decode("utf-8").strip() for line in f if line.strip()]
+        logger.info("recorded {} parses to {}".format(record_fixtures(texts, args.fixtures, args.lang), args.fixtures))
+    else:
+        fixtures = load_fixtures(args.fixtures) if args.fixtures else {}
+        server = StandinServer((args.host, args.port), fixtures=fixtures, latency=args.latency, jitter=args.jitter,
+                               latency_per_sentence=args.latency_per_sentence, threads=args.threads,
+                               error_rate=args.error_rate, drop_rate=args.drop_rate, hang_rate=args.hang_rate,
+                               hang_seconds=args.hang_seconds, max_words=args.max_words, seed=args.seed)
+        logger.info("serving {} fixtures on {}".format(len(fixtures), server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info(json.dumps(server.stats))
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+Duplicate detection with fixed-size fingerprints instead of full strings.
+
+A key is a tuple of strings, like (marker, sentence, previous). It is reduced
+to the first 64 or 128 bits of its md5, and only that is kept:
+
+    memory  open-addressing table of fingerprints in a flat array,
+            8 or 16 bytes per slot instead of a few hundred per string tuple
+    bloom   Bloom filter sized for `capacity` keys, about 2 bytes per key.
+            A small fraction (error_rate) of new keys is taken for a duplicate.
+            Only the filter stage uses it: there a lost record is one pair less
+            in the corpus. Where the records are already counted (the parse
+            and split stages), a lost record is a missing output pair, so
+            those stages ask make_dedup for an exact mode
+    disk    fingerprints in an sqlite table, for corpora whose fingerprints
+            do not fit in memory
+
+With 64 bits, two different keys collide with probability about n^2 / 2^65,
+which is around 1e-7 for a hundred million keys. Use 128 bits to rule it out.
+"""
+
+import os
+import math
+import logging
+import struct
+import sqlite3
+import hashlib
+from array import array
+
+logger = logging.getLogger(__name__)
+
+DEDUP_MODES = ["memory", "bloom", "disk"]
+# modes that never take a new key for a duplicate
+EXACT_DEDUP_MODES = ["memory", "disk"]
+
+# 'l' is 64 bits on the linux machines this runs on
+_SLOT_TYPE = 'l'
+_MAX_LOAD = 2.0 / 3
+
+
+def fingerprint(key):
+    """
+    :param key: tuple of str or unicode
+    :return: 16 byte md5 digest of the fields joined by tabs
+    """
+    fields = [field.encode('utf-8') if isinstance(field, unicode) else field for field in key]
+    return hashlib.md5(b"\t".join(fields)).digest()
+
+
+class FingerprintSet(object):
+    """
+    In-memory set of 64 or 128 bit fingerprints with linear probing.
+    Slot value 0 marks an empty slot, so a zero fingerprint is stored as 1.
+    """
+
+    def __init__(self, bits=64, capacity=1 << 16):
+        assert bits in (64, 128)
+        self.words = bits // 64
+        self._unpack = struct.Struct("<" + "q" * self.words).unpack
+        self.n = 0
+        self.size = 1
+        while self.size * _MAX_LOAD < capacity:
+            self.size *= 2
+        self.table = array(_SLOT_TYPE, [0]) * (self.size * self.words)
+
+    def __len__(self):
+        return self.n
+
+    def nbytes(self):
+        return self.table.buffer_info()[1] * self.table.itemsize
+
+    def add(self, key):
+        """
+        :return: True if key was not seen before
+        """
+        words = self._unpack(fingerprint(key)[:8 * self.words])
+        if words[0] == 0:
+            words = (1,) + words[1:]
+
+        if self.words == 1:
+            new = self._insert64(words[0])
+        else:
+            new = self._insert128(words[0], words[1])
+
+        if new:
+            self.n += 1
+            if self.n > self.size * _MAX_LOAD:
+                self._grow()
+        return new
+
+    def _insert64(self, x):
+        table = self.table
+        mask = self.size - 1
+        i = x & mask
+        while True:
+            y = table[i]
+            if y == 0:
+                table[i] = x
+                return True
+            if y == x:
+                return False
+            i = (i + 1) & mask
+
+    def _insert128(self, hi, lo):
+        table = self.table
+        mask = self.size - 1
+        i = hi & mask
+        while True:
+            y = table[2 * i]
+            if y == 0:
+                table[2 * i] = hi
+                table[2 * i + 1] = lo
+                return True
+            if y == hi and table[2 * i + 1] == lo:
+                return False
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old = self.table
+        self.size *= 2
+        self.table = array(_SLOT_TYPE, [0]) * (self.size * self.words)
+        if self.words == 1:
+            for x in old:
+                if x != 0:
+                    self._insert64(x)
+        else:
+            for i in xrange(0, len(old), 2):
+                if old[i] != 0:
+                    self._insert128(old[i], old[i + 1])
+
+
+class BloomFilter(object):
+    """
+    Never misses a duplicate, but takes about error_rate of the
+    new keys for duplicates once `capacity` keys are in.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.n_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, int(round(float(self.n_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def nbytes(self):
+        return len(self.bits)
+
+    def add(self, key):
+        # double hashing on the two halves of the digest
+        h1, h2 = struct.unpack("<QQ", fingerprint(key))
+        bits = self.bits
+        new = False
+        for j in xrange(self.n_hashes):
+            b = (h1 + j * h2) % self.n_bits
+            byte, mask = b >> 3, 1 << (b & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        if new:
+            self.n += 1
+        return new
+
+    def expected_losses(self):
+        """
+        :return: about how many of the keys added were new but taken for duplicates.
+                 The chance of that grows with the bits set, (1 - e^(-k i / m))^k for the i-th key
+        """
+        steps = 100
+        k, m = self.n_hashes, float(self.n_bits)
+        rate = lambda i: (1 - math.exp(-k * i / m)) ** k
+        # the keys that were taken for duplicates set no bits, n is a little low
+        return sum(rate(self.n * (j + 0.5) / steps) for j in range(steps)) * self.n / steps
+
+
+class DiskFingerprintSet(object):
+    """
+    Fingerprints in an sqlite file. The file is scratch space,
+    it is started fresh and removed by close().
+    """
+
+    def __init__(self, path, bits=64, commit_every=100000):
+        self.path = path
+        self.n_bytes = bits // 8
+        self.commit_every = commit_every
+        self.n = 0
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.db = sqlite3.connect(path)
+        # nothing here has to survive a crash
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("CREATE TABLE seen (fp BLOB PRIMARY KEY)")
+
+    def __len__(self):
+        return self.n
+
+    def nbytes(self):
+        return os.path.getsize(self.path)
+
+    def add(self, key):
+        cursor = self.db.execute("INSERT OR IGNORE INTO seen VALUES (?)",
+                                 (sqlite3.Binary(fingerprint(key)[:self.n_bytes]),))
+        if cursor.rowcount != 1:
+            return False
+        self.n += 1
+        if self.n % self.commit_every == 0:
+            self.db.commit()
+        return True
+
+    def close(self):
+        self.db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def make_dedup(mode="memory", bits=64, path=None, capacity=10 ** 7, exact=False):
+    """
+    :param mode: one of DEDUP_MODES
+    :param path: sqlite file for "disk"
+    :param capacity: expected number of keys, the size of a "bloom" filter
+    :param exact: never drop a new key. "bloom" is replaced by "disk", which also
+                  keeps the memory bounded
+    """
+    if exact and mode not in EXACT_DEDUP_MODES:
+        logger.info("--dedup {} can drop unique records, using --dedup disk here".format(mode))
+        mode = "disk"
+    if mode == "memory":
+        return FingerprintSet(bits)
+    elif mode == "bloom":
+        return BloomFilter(capacity)
+    elif mode == "disk":
+        return DiskFingerprintSet(path, bits)
+    raise Exception("unknown dedup mode {}".format(mode))
+
+
+def close_dedup(dedup):
+    if isinstance(dedup, BloomFilter):
+        logger.info("bloom filter: {} unique records kept, about {:.0f} more taken for duplicates".format(
+            len(dedup), dedup.expected_losses()))
+    if hasattr(dedup, "close"):
+        dedup.close()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of dedup.py:
+
+    python -m unittest dedup_test
+"""
+
+import os
+import random
+import tempfile
+import unittest
+
+from dedup import FingerprintSet, BloomFilter, DiskFingerprintSet, make_dedup, fingerprint
+
+
+def random_keys(n, seed=0):
+    rnd = random.Random(seed)
+    return [(u"marker", u"sentence {}".format(rnd.randrange(n)), u"previous") for _ in range(n)]
+
+
+class FingerprintSetTest(unittest.TestCase):
+
+    def check_against_set(self, bits):
+        dedup = FingerprintSet(bits, capacity=16)
+        seen = set()
+        for key in random_keys(20000):
+            self.assertEqual(dedup.add(key), key not in seen)
+            seen.add(key)
+        self.assertEqual(len(dedup), len(seen))
+
+    def test_64_bits(self):
+        self.check_against_set(64)
+
+    def test_128_bits(self):
+        self.check_against_set(128)
+
+    def test_slot_sizes(self):
+        # one 64-bit word per slot, or two
+        for bits in (64, 128):
+            dedup = FingerprintSet(bits, capacity=1000)
+            self.assertEqual(dedup.nbytes(), dedup.size * bits // 8)
+
+    def test_growth(self):
+        dedup = FingerprintSet(64, capacity=4)
+        size = dedup.size
+        keys = [(str(i),) for i in range(5000)]
+        for n, key in enumerate(keys):
+            self.assertTrue(dedup.add(key))
+            # a power of two, never fuller than _MAX_LOAD
+            self.assertEqual(dedup.size & (dedup.size - 1), 0)
+            self.assertLessEqual(len(dedup), dedup.size * 2.0 / 3)
+        self.assertGreater(dedup.size, size)
+        # every key is found again in the grown table
+        for key in keys:
+            self.assertFalse(dedup.add(key))
+        self.assertEqual(len(dedup), len(keys))
+
+    def test_collisions_64(self):
+        dedup = FingerprintSet(64, capacity=8)
+        size = dedup.size
+        # all start at the last slot, the probe wraps around to the first ones
+        values = [size - 1 + k * size for k in range(1, 6)]
+        for x in values:
+            self.assertTrue(dedup._insert64(x))
+        for x in values:
+            self.assertFalse(dedup._insert64(x))
+        self.assertEqual(sorted(x for x in dedup.table if x != 0), sorted(values))
+        self.assertEqual(dedup.table[0], values[1])
+
+    def test_collisions_128(self):
+        dedup = FingerprintSet(128, capacity=8)
+        # the same first word is not the same fingerprint
+        self.assertTrue(dedup._insert128(5, 1))
+        self.assertTrue(dedup._insert128(5, 2))
+        self.assertFalse(dedup._insert128(5, 1))
+        self.assertFalse(dedup._insert128(5, 2))
+        self.assertTrue(dedup._insert128(5 + dedup.size, 1))
+
+    def test_collisions_survive_growth(self):
+        dedup = FingerprintSet(128, capacity=4)
+        pairs = [(3 + k * 4, k) for k in range(1, 40)]
+        for hi, lo in pairs:
+            dedup._insert128(hi, lo)
+            dedup.n += 1
+            if dedup.n > dedup.size * 2.0 / 3:
+                dedup._grow()
+        for hi, lo in pairs:
+            self.assertFalse(dedup._insert128(hi, lo))
+
+    def test_fields_are_not_concatenated(self):
+        dedup = FingerprintSet(64)
+        self.assertTrue(dedup.add((u"ab", u"c")))
+        self.assertTrue(dedup.add((u"a", u"bc")))
+        # unicode and utf-8 str give the same fingerprint
+        self.assertEqual(fingerprint((u"é",)), fingerprint((u"é".encode("utf-8"),)))
+
+
+class OtherModesTest(unittest.TestCase):
+
+    def test_bloom_never_misses_a_duplicate(self):
+        keys = random_keys(5000)
+        bloom = BloomFilter(len(set(keys)))
+        seen = set()
+        lost = 0
+        for key in keys:
+            new = bloom.add(key)
+            if key in seen:
+                self.assertFalse(new)
+            elif not new:
+                lost += 1
+            seen.add(key)
+        self.assertLess(lost, 0.01 * len(seen))
+        self.assertLess(bloom.expected_losses(), 0.01 * len(seen))
+
+    def test_disk(self):
+        path = os.path.join(tempfile.mkdtemp(), "test.seen")
+        dedup = DiskFingerprintSet(path, commit_every=100)
+        memory = FingerprintSet(64)
+        for key in random_keys(2000):
+            self.assertEqual(dedup.add(key), memory.add(key))
+        dedup.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_exact_modes(self):
+        path = os.path.join(tempfile.mkdtemp(), "test.seen")
+        self.assertIsInstance(make_dedup("bloom", capacity=100), BloomFilter)
+        dedup = make_dedup("bloom", path=path, capacity=100, exact=True)
+        self.assertIsInstance(dedup, DiskFingerprintSet)
+        dedup.close()
+        self.assertIsInstance(make_dedup("memory", exact=True), FingerprintSet)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming paragraph extraction from Gigaword SGML files
+(shared by gigaword_cn.py and gigaword_es.py)
+
+Each .gz file is decompressed line by line and its <DOC type="story"> paragraphs
+are written to a part file as soon as they are closed. Files are handled by a
+process pool, and the parts are appended to the output in a fixed order,
+so memory does not grow with the corpus.
+"""
+
+import os
+import gzip
+import shutil
+import logging
+from itertools import imap, izip
+from multiprocessing import Pool
+from os.path import join as pjoin
+
+from manifest import Manifest
+
+logger = logging.getLogger(__name__)
+
+
+def extract_stories(lines, process_sent):
+    """
+    :param lines: lines of a gigaword xml file, without line breaks
+    :param process_sent: corpus-specific cleanup of a paragraph
+    :return: generator of paragraphs from "story" documents
+    """
+    story_doc = False
+    paragraph = False
+    paragraph_text = []
+    for line in lines:
+        if 'DOC' in line and 'type="story"' in line:
+            story_doc = True
+        if '<P>' in line and story_doc:
+            paragraph = True
+            continue
+        if '</P>' in line and story_doc:
+            paragraph = False
+            sentence = "".join(paragraph_text).strip()
+            # preprocess the sentence
+            yield process_sent(sentence)
+            paragraph_text = []
+        if '</DOC>' in line and story_doc:
+            story_doc = False
+
+        if paragraph:
+            paragraph_text.append(line)
+
+
+def read_gzip_lines(file_path):
+    with gzip.open(file_path, 'rb') as f:
+        for line in f:
+            if line.endswith('\n'):
+                line = line[:-1]
+            yield line
+
+
+def extract_file(job):
+    """
+    Runs in a worker process.
+
+    :param job: (gz file path, part file path, process_sent)
+    :return: (part file path, number of paragraphs)
+    """
+    file_path, part_path, process_sent = job
+    n_paragraphs = 0
+    with open(part_path, 'wb') as f:
+        for paragraph in extract_stories(read_gzip_lines(file_path), process_sent):
+            f.write(paragraph + '\n')
+            n_paragraphs += 1
+    return part_path, n_paragraphs
+
+
+def list_gigaword_files(gigaword_dir):
+    files = []
+    for news_source in sorted(os.listdir(pjoin(gigaword_dir, 'data'))):
+        source_dir = pjoin(gigaword_dir, 'data', news_source)
+        files.extend(pjoin(source_dir, file) for file in sorted(os.listdir(source_dir)) if '.gz' in file)
+    return files
+
+
+def extract_corpus(gigaword_dir, output_path, process_sent, workers=1, incremental=False):
+    """
+    Write the paragraphs of every story in gigaword_dir/data/*/*.gz to output_path,
+    one paragraph per line, in file order.
+
+    With incremental, only .gz files that are not in the manifest yet are extracted,
+    and their paragraphs are appended to output_path. A changed .gz file fails the
+    run, see manifest.py.
+    """
+    parts_dir = output_path + ".parts"
+    if not os.path.exists(parts_dir):
+        os.makedirs(parts_dir)
+
+    manifest = Manifest(os.path.dirname(output_path))
+    file_paths = list_gigaword_files(gigaword_dir)
+    if incremental:
+        file_paths = [file_path for file_path in file_paths
+                      if not manifest.is_processed("extract", os.path.relpath(file_path, gigaword_dir), file_path)]
+
+    jobs = [(file_path, pjoin(parts_dir, "{}.txt".format(i)), process_sent)
+            for i, file_path in enumerate(file_paths)]
+    logger.info("{} files to extract".format(len(jobs)))
+
+    if workers > 1:
+        pool = Pool(workers)
+        file_map = pool.imap
+    else:
+        pool = None
+        file_map = imap
+
+    articles_processed = 0
+    paragraphs = 0
+    if not incremental:
+        manifest.stages["extract"] = {}
+
+    with open(output_path, 'ab' if incremental else 'wb') as out:
+        for (file_path, _, _), (part_path, n_paragraphs) in izip(jobs, file_map(extract_file, jobs)):
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, out)
+            os.remove(part_path)
+
+            # a crash between the two repeats the paragraphs of one file,
+            # the filter stage drops them as duplicates
+            out.flush()
+            manifest.update("extract", os.path.relpath(file_path, gigaword_dir), file_path)
+            manifest.save()
+
+            articles_processed += 1
+            paragraphs += n_paragraphs
+            if articles_processed % 20 == 0:
+                logger.info("processed {} articles".format(articles_processed))
+                logger.info("{} paragraphs are collected".format(paragraphs))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    os.rmdir(parts_dir)
+
+    return paragraphs
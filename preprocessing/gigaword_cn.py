@@ -12,14 +12,20 @@ import re
 import io
 import sys
 import json
-import gzip
 import argparse
 
 import logging
 from util import rephrase
 from os.path import join as pjoin
 
-from parser import depparse_ssplit, setup_corenlp
+from parser import depparse_ssplit_stream, reextract_stream, setup_corenlp, cached_parses, prescreen_stats, parse_summary
+from parse_cache import PARSE_CACHE_FILE
+from gigaword import extract_corpus
+from chinese import sent_tokenize, MarkerRules
+from checkpoints import ParseProgress, load_filter_checkpoint, save_filter_checkpoint, resume_position
+from dedup import DEDUP_MODES, make_dedup, close_dedup
+from records import RecordWriter, find_records, write_statistics, update_statistics
+from manifest import Manifest, pending_records, mark_processed
 from cfg import CH_DISCOURSE_MARKERS
 
 """
@@ -33,17 +39,46 @@ parser = argparse.ArgumentParser(description='DisExtract Gigaword Chinese')
 
 parser.add_argument("--json", type=str, default="example_config.json", help="corpus parameter setting to load")
 parser.add_argument("--extract", action='store_true')
+parser.add_argument("--workers", default=1, type=int, help="number of processes for --extract and --reextract")
 
 parser.add_argument("--filter", action='store_true',
                     help="Stage 2: run filtering on the corpus, collect sentence pairs (sentence and previous sentence)")
 parser.add_argument("--filter_print_every", default=10000, type=int)
 parser.add_argument("--max_seq_len", default=50, type=int)
 parser.add_argument("--min_seq_len", default=5, type=int)
+parser.add_argument("--buffer_size", default=10000, type=int, help="filtered records kept in memory before writing")
+parser.add_argument("--shard_by_marker", action='store_true', help="write one record file per marker")
+parser.add_argument("--dedup", default="memory", choices=DEDUP_MODES,
+                    help="how repeated (marker, sentence, previous) records are detected, see dedup.py")
+parser.add_argument("--fingerprint_bits", default=64, type=int, choices=[64, 128])
+parser.add_argument("--dedup_capacity", default=10 ** 8, type=int, help="expected number of records for --dedup bloom")
+
+parser.add_argument("--incremental", action='store_true',
+                    help="only extract, filter or parse input that is new or grown since the last run, see manifest.py")
+parser.add_argument("--resume", action='store_true', help="continue the filter or parse stage from its last checkpoint")
+parser.add_argument("--checkpoint_every", default=10000, type=int,
+                    help="lines (filter) or sentences (parse) between checkpoints")
 
 parser.add_argument("--parse", action='store_true',
                     help="Stage 3: run parsing on filtered sentences, collect sentence pairs (S1 and S2)")
+parser.add_argument("--batch_size", default=32, type=int, help="sentences per CoreNLP request")
+parser.add_argument("--concurrency", default=4, type=int, help="CoreNLP requests in flight at the same time")
+parser.add_argument("--corenlp_endpoints", type=str, default=None,
+                    help="comma separated CoreNLP server urls to spread requests over, the ones in cfg.py by default")
+parser.add_argument("--corenlp_output", type=str, default="json",
+                    help="json|protobuf, protobuf needs the corenlp_protobuf package, see corenlp_output.py")
+parser.add_argument("--corenlp_timeout", default=60, type=float, help="seconds to wait for a CoreNLP request")
+parser.add_argument("--corenlp_retries", default=2, type=int, help="times a failed CoreNLP request is sent again")
 parser.add_argument("--exclude_list", action='store_true', help="use exclusion list defined in this file")
-parser.add_argument("--no_dep_cache", action='store_false', help="not caching dependency parsed result")
+parser.add_argument("--no_dep_cache", action='store_true', help="not caching dependency parsed result")
+parser.add_argument("--dep_cache", type=str, default=None,
+                    help="parse cache file, dep_parse_cache.sqlite in the corpus directory by default")
+parser.add_argument("--dep_cache_gb", default=20, type=float,
+                    help="size of the parse cache, the parses used longest ago are dropped beyond it")
+parser.add_argument("--pos_prescreen", action='store_true',
+                    help="tag sentences with POS first, only dependency parse the ones a marker pattern could match")
+parser.add_argument("--reextract", action='store_true',
+                    help="with --parse, take the parses from the parse cache instead of CoreNLP and only rerun the dependency patterns")
 
 args, _ = parser.parse_known_args()
 
@@ -94,98 +129,10 @@ def process_sent(sent, lang="ch"):
     return sent
 
 
-def extract_stories(lines):
-    # pass in all lines from a gigaword xml file
-    sentences = []
-
-    story_doc = False
-    paragraph = False
-    paragraph_text = []
-    for line in lines:
-        if 'DOC' in line and 'type="story"' in line:
-            story_doc = True
-        if '<P>' in line and story_doc:
-            paragraph = True
-            continue
-        if '</P>' in line and story_doc:
-            paragraph = False
-            sentence = "".join(paragraph_text).strip()
-            # preprocess the sentence
-            sentence = process_sent(sentence)
-            sentences.append(sentence)
-            paragraph_text = []
-        if '</DOC>' in line and story_doc:
-            story_doc = False
-
-        if paragraph:
-            paragraph_text.append(line)
-
-    return sentences
-
-
-def sent_tokenize(p):
-    sents = []
-    sent = []
-
-    prev_stop_tok = False  # manual lookahead for ?", !", 。"
-    inside_quot = False
-    for w in p.decode('utf-8'):
-
-        if w == '"'.decode('utf-8') and inside_quot:
-            inside_quot = False
-        elif w == '"'.decode('utf-8'):
-            inside_quot = True
-
-        if prev_stop_tok and w == '"'.decode('utf-8') and not inside_quot:
-            sent.append(w)
-            sents.append("".join(sent))
-            sent = []
-            prev_stop_tok = False
-            continue
-        if prev_stop_tok and not inside_quot:
-            # meaning it's not `“。` scenario
-            sents.append("".join(sent))
-            sent = [w]
-            prev_stop_tok = False
-            continue
-
-        if w == "。".decode('utf-8') or w == "?".decode('utf-8') or w == "!".decode('utf-8'):
-            sent.append(w)
-            prev_stop_tok = True
-        elif w == ";".decode('utf-8') and not inside_quot:
-            sent.append("。")
-            sents.append("".join(sent))
-            sent = []
-        else:
-            sent.append(w)
-
-    if prev_stop_tok:
-        sents.append("".join(sent))
-
-    return sents
-
-
 def extrat_raw_gigaword():
-    news_sources = os.listdir(pjoin(gigaword_cn_dir, 'data'))
-    articles_processed = 0
-    sentences = []
-    for news_source in news_sources:
-        files = os.listdir(pjoin(gigaword_cn_dir, 'data', news_source))
-        files = filter(lambda s: '.gz' in s, files)
-        for file in files:
-            with gzip.open(pjoin(gigaword_cn_dir, 'data', news_source, file), 'rb') as f:
-                file_content = f.read()
-                lines = file_content.split('\n')
-                sents = extract_stories(lines)
-                sentences.extend(sents)
-            articles_processed += 1
-            if articles_processed % 20 == 0:
-                print("processed {} articles".format(articles_processed))
-                print("{} paragraphs are collected".format(len(sentences)))
-
-    with open(pjoin(gigaword_cn_dir, gigaword_cn_file), 'wb') as f:
-        for sent in sentences:
-            f.write(sent + '\n')
+    paragraphs = extract_corpus(gigaword_cn_dir, pjoin(gigaword_cn_dir, gigaword_cn_file), process_sent,
+                                workers=args.workers, incremental=args.incremental)
+    logger.info("{} paragraphs are collected".format(paragraphs))
 
 # def generate_pairs(sent_splits, marker_sent_list, marker_prev_list):
 #     # successive pairs
@@ -218,127 +165,75 @@ def collect_raw_sentences(source_dir, filenames, marker_set_tag, discourse_marke
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    sentences = {marker: {"sentence": [], "previous": []} for marker in discourse_markers}
+    manifest = Manifest(markers_dir)
+    if args.incremental:
+        manifest.check_unchanged("filter", [(filename, pjoin(source_dir, filename)) for filename in filenames])
+    checkpoint_path, state = load_filter_checkpoint(output_dir, marker_set_tag, args.resume)
+    # duplicates are dropped here, so they are never sent to the parser
+    dedup = make_dedup(args.dedup, args.fingerprint_bits, path=pjoin(output_dir, "{}.seen".format(marker_set_tag)),
+                       capacity=args.dedup_capacity)
+    writer = RecordWriter(output_dir, marker_set_tag, shard_by_marker=args.shard_by_marker,
+                          buffer_size=args.buffer_size, resume_state=state["writer"] if state else None,
+                          dedup=dedup, append=args.incremental)
+    rules = MarkerRules(discourse_markers, args.min_seq_len, args.max_seq_len)
 
     for filename in filenames:
-        logger.info("reading {}".format(filename))
+        position = resume_position(state, filenames, filename)
+        if position is None:
+            logger.info("{} was finished before the checkpoint".format(filename))
+            continue
+
         file_path = pjoin(source_dir, filename)
+        if args.incremental and manifest.is_processed("filter", filename, file_path):
+            logger.info("{} has not changed since the last run".format(filename))
+            continue
+
+        logger.info("reading {}".format(filename))
 
-        previous_sentence = ""
+        previous_sentence = position.get("previous", "")
         with io.open(file_path, 'rU', encoding="utf-8") as f:
             for i, sentence in enumerate(f):
+                if i < position.get("line", 0):
+                    continue
+                if i % args.checkpoint_every == 0:
+                    save_filter_checkpoint(checkpoint_path, writer,
+                                           {"file": filename, "line": i, "previous": previous_sentence})
 
                 # sentence tokenization here!!! <P> is not sentence.
                 sents = sent_tokenize(sentence) # these are already preprocessed
 
                 for sent in sents:
 
-                    # a single marker match, so continue is fine
                     # we match the sentence length condition, but when there are multiple
                     # markers, we sync with spanish, and defer the decision to parser!
-                    for marker in discourse_markers:
-
-                        if marker == "当时" and "当时" in sent and "当时的" not in sent:
-                            if len(sent.split(marker)) == 2:
-                                s1, s2 = sent.split(marker)
-                                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
-                                        s2.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                            sentences[marker]["sentence"].append(sent)
-                            sentences[marker]["previous"].append(previous_sentence)
-                            continue
-
-                        # we will lose sentences that have both "而且" and "而" to "而且"...
-                        # but we will judge by final distribution
-                        if marker == "而且" and ",而且" in sent:
-                            if len(sent.split(marker)) == 2:
-                                s1, s2 = sent.split(",而且")
-                                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
-                                        s2.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                            sentences[marker]["sentence"].append(sent)
-                            sentences[marker]["previous"].append(previous_sentence)
-                            continue
-
-                        if marker == "而" and ",而" in sent:
-                            if len(sent.split(",而")) == 2:
-                                s1, s2 = sent.split(",而")
-                                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
-                                        s2.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                            sentences[marker]["sentence"].append(sent)
-                            sentences[marker]["previous"].append(previous_sentence)
-                            continue
-
-                        if marker == "但" and ",但" in sent:
-                            if len(sent.split(",但是")) == 2 or len(sent.split("但")) == 2:
-                                if ",但是" in sent:
-                                    s1, s2 = sent.split(",但是")
-                                else:
-                                    s1, s2 = sent.split(",但")
-                                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
-                                        s2.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                            sentences[marker]["sentence"].append(sent)
-                            sentences[marker]["previous"].append(previous_sentence)
-                            continue
-
-                        # later one is "because of"
-                        if marker == "因为" and "因为" in sent and "是因为" not in sent:
-                            if len(sent.split("因为")) == 2:
-                                s1, s2 = sent.split("因为")
-                                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
-                                        s2.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                            sentences[marker]["sentence"].append(sent)
-                            sentences[marker]["previous"].append(previous_sentence)
-                            continue
-
-                        if marker in sent:
-                            if len(sent.split(marker)) == 2:
-                                s1, s2 = sent.split(marker)
-                                if len(s1.decode("utf-8")) > args.max_seq_len or len(s1.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                                elif len(s2.decode("utf-8")) > args.max_seq_len or len(
-                                        s2.decode("utf-8")) < args.min_seq_len:
-                                    continue
-                            sentences[marker]["sentence"].append(sent)
-                            sentences[marker]["previous"].append(previous_sentence)
+                    for marker in rules.find(sent):
+                        writer.write(marker, sent, previous_sentence)
 
                     previous_sentence = sent
 
                     if i % args.filter_print_every == 0:
                         logger.info("processed {}".format(i))
 
+        save_filter_checkpoint(checkpoint_path, writer, {"file": filename, "finished": True})
         logger.info("{} file finished".format(filename))
 
-    logger.info('writing files')
-
-    with open(pjoin(output_dir, "{}.json".format(marker_set_tag)), 'wb') as f:
-        json.dump(sentences, f)
-
+    writer.close()
+    close_dedup(dedup)
+    logger.info("{} duplicate records dropped".format(writer.duplicates))
     logger.info('file writing complete')
 
-    statistics_lines = []
-    for marker in sentences:
-        n_sentences = len(sentences[marker]["sentence"])
-        statistics_lines.append("{}\t{}".format(marker, n_sentences))
+    counts = {marker: writer.counts.get(marker, 0) for marker in discourse_markers}
+    if args.incremental:
+        update_statistics(markers_dir, counts)
+    else:
+        write_statistics(markers_dir, counts)
 
-    statistics_report = "\n".join(statistics_lines)
-    with open(pjoin(markers_dir, "VERSION.txt"), "wb") as f:
-        f.write(
-            "commit: \n\ncommand: \n\nmarkers:\n" + statistics_report
-        )
+    if not args.incremental:
+        # the records were written again, so they have to be parsed again
+        manifest.stages = {}
+    for filename in filenames:
+        manifest.update("filter", filename, pjoin(source_dir, filename))
+    manifest.save()
 
 
 def parse_filtered_sentences(source_dir, marker_set_tag):
@@ -352,64 +247,84 @@ def parse_filtered_sentences(source_dir, marker_set_tag):
 
     markers_dir = pjoin(source_dir, "markers_" + marker_set_tag)
     input_dir = pjoin(markers_dir, "sentences")
-    input_file_path = pjoin(input_dir, "{}.json".format(marker_set_tag))
     output_dir = pjoin(markers_dir, "parsed_sentence_pairs")
 
     if not os.path.exists(markers_dir):
         raise Exception("{} does not exist".format(markers_dir))
     if not os.path.exists(input_dir):
         raise Exception("{} does not exist".format(input_dir))
-    if not os.path.exists(input_file_path):
-        raise Exception("{} does not exist".format(input_file_path))
+    if find_records(input_dir, marker_set_tag) is None:
+        raise Exception("no filtered sentences in {}".format(input_dir))
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    logger.info("setting up parser (actually just testing atm)")
-    setup_corenlp()
+    if args.reextract and args.no_dep_cache:
+        raise Exception("--reextract reads the parses from the parse cache")
+    if not args.reextract:
+        logger.info("setting up parser (actually just testing atm)")
+        setup_corenlp()
 
-    # parsed_sentence_pairs = {marker: {"s1": [], "s2": []} for marker in discourse_markers}
-    with open(pjoin(output_dir, "{}_parsed_sentence_pairs.txt".format(marker_set_tag)), 'a') as w:
-
-        with open(input_file_path, 'rb') as f:
-            logger.info("reading {}".format(input_file_path))
-            sentences = json.load(f)
-
-            # resume training only on "而"
-            if args.exclude_list:
-                exclusion_list = [u'虽然', u'可是', u'不过', u'所以', u'但', u'因此']
-                logger.info("excluded: {}".format(exclusion_list))
+    # with --incremental, only records added since the last parse are read and their
+    # pairs appended. After a full filter run everything is parsed again.
+    manifest = Manifest(markers_dir)
+    incremental = args.incremental and "parse" in manifest.stages
+    ranges, records = pending_records(manifest, input_dir, marker_set_tag, incremental)
 
-                # we take them out from the sentences dictionary
-                # those markers have finished parsing
-                for ex_marker in exclusion_list:
-                    del sentences[ex_marker]
-
-            logger.info("total sentences: {}".format(
-                sum([len(sentences[marker]["sentence"]) for marker in sentences])
-            ))
+    # parsed_sentence_pairs = {marker: {"s1": [], "s2": []} for marker in discourse_markers}
+    # the output is checkpointed, see checkpoints.py. --exclude_list and --incremental
+    # add to an earlier output, so they append
+    # parses are kept across runs and marker sets, see parse_cache.py
+    dep_cache = None if args.no_dep_cache else args.dep_cache or pjoin(source_dir, PARSE_CACHE_FILE)
+    with cached_parses(dep_cache, max_gb=args.dep_cache_gb), \
+            ParseProgress(pjoin(output_dir, "{}_parsed_sentence_pairs.txt".format(marker_set_tag)),
+                          resume=args.resume, every=args.checkpoint_every,
+                          append=args.exclude_list or incremental) as w:
+
+        logger.info("reading {}".format(find_records(input_dir, marker_set_tag)))
+
+        # resume training only on "而"
+        exclusion_list = []
+        if args.exclude_list:
+            # those markers have finished parsing
+            exclusion_list = [u'虽然', u'可是', u'不过', u'所以', u'但', u'因此']
+            logger.info("excluded: {}".format(exclusion_list))
+
+        def numbered_items():
             i = 0
-            for marker, slists in sentences.iteritems():
-                for sentence, previous in zip(slists["sentence"], slists["previous"]):
-                    i += 1
-                    if i > 0:  # add an argument
-                        try:
-                            parsed_output = dependency_parsing(sentence, previous, marker)
-                            if parsed_output:
-                                s1, s2 = parsed_output
-                                line_to_print = "{}\t{}\t{}\n".format(s1, s2, marker)
-                                w.write(line_to_print)
-                        except:
-                            print i, marker, sentence
-
-                        if i % args.filter_print_every == 0:
-                            logger.info("processed {}".format(i))
-
+            for marker, sentence, previous in records:
+                if marker in exclusion_list:
+                    continue
+
+                i += 1
+                if i > w.done:  # parsed before the last checkpoint otherwise
+                    yield (i, marker), sentence, previous, marker
+
+        for (i, marker), parsed_output in dependency_parsing(numbered_items()):
+            if parsed_output:
+                s1, s2 = parsed_output
+                line_to_print = "{}\t{}\t{}\n".format(s1, s2, marker)
+                w.write(line_to_print)
+            w.checkpoint(i)
+
+            if i % args.filter_print_every == 0:
+                logger.info("processed {}".format(i))
+
+        logger.info("total sentences: {}".format(w.records))
+        if args.pos_prescreen:
+            logger.info(prescreen_stats.summary())
+        if not args.reextract:
+            logger.info(parse_summary("ch"))
+
+    mark_processed(manifest, "parse", ranges)
     logger.info('file writing complete')
 
 
-def dependency_parsing(sentence, previous_sentence, marker):
-    return depparse_ssplit(sentence, previous_sentence, marker, lang='ch')
+def dependency_parsing(items):
+    if args.reextract:
+        return reextract_stream(items, lang='ch', workers=args.workers)
+    return depparse_ssplit_stream(items, lang='ch', batch_size=args.batch_size, concurrency=args.concurrency,
+                                  prescreen=args.pos_prescreen)
 
 
 if __name__ == '__main__':
@@ -418,5 +333,7 @@ if __name__ == '__main__':
     elif args.filter:
         collect_raw_sentences(gigaword_cn_dir, [gigaword_cn_file], "ALL14", CH_DISCOURSE_MARKERS)
     elif args.parse:
-        setup_corenlp("ch")
+        if not args.reextract:
+            setup_corenlp("ch", endpoints=args.corenlp_endpoints, output_format=args.corenlp_output,
+                          timeout=args.corenlp_timeout, retries=args.corenlp_retries)
         parse_filtered_sentences(gigaword_cn_dir, "ALL14")
@@ -9,17 +9,20 @@ We are only process text type of "story", and ignore the rest.
 
 import os
 import re
-import io
 import sys
 import json
-import gzip
 import argparse
 
 import logging
 from util import rephrase
 from os.path import join as pjoin
 
-from parser import depparse_ssplit, setup_corenlp
+from parser import depparse_ssplit_stream, reextract_stream, setup_corenlp, cached_parses, prescreen_stats, parse_summary
+from parse_cache import PARSE_CACHE_FILE
+from gigaword import extract_corpus
+from segmentation import iter_segmented_lines
+from checkpoints import ParseProgress
+from dedup import DEDUP_MODES, make_dedup, close_dedup
 from cfg import SP_DISCOURSE_MARKERS
 
 """
@@ -33,17 +36,43 @@ parser = argparse.ArgumentParser(description='DisExtract Gigaword Spanish')
 
 parser.add_argument("--json", type=str, default="example_config.json", help="corpus parameter setting to load")
 parser.add_argument("--extract", action='store_true')
+parser.add_argument("--workers", default=1, type=int, help="number of processes for --extract, sentence segmentation and --reextract")
 
 parser.add_argument("--filter", action='store_true',
                     help="Stage 2: run filtering on the corpus, collect sentence pairs (sentence and previous sentence)")
 parser.add_argument("--filter_print_every", default=10000, type=int)
 parser.add_argument("--max_seq_len", default=50, type=int)
 parser.add_argument("--min_seq_len", default=5, type=int)
+parser.add_argument("--dedup", default="memory", choices=DEDUP_MODES,
+                    help="how repeated (marker, sentence, previous) records are detected, see dedup.py")
+parser.add_argument("--fingerprint_bits", default=64, type=int, choices=[64, 128])
+parser.add_argument("--dedup_capacity", default=10 ** 8, type=int, help="expected number of records for --dedup bloom")
+
+parser.add_argument("--incremental", action='store_true',
+                    help="--extract only the .gz files that are new or grown since the last run")
+parser.add_argument("--resume", action='store_true', help="continue the parse stage from its last checkpoint")
+parser.add_argument("--checkpoint_every", default=10000, type=int, help="sentences between parse checkpoints")
 
 parser.add_argument("--parse", action='store_true',
                     help="Stage 3: run parsing on filtered sentences, collect sentence pairs (S1 and S2)")
+parser.add_argument("--batch_size", default=32, type=int, help="sentences per CoreNLP request")
+parser.add_argument("--concurrency", default=4, type=int, help="CoreNLP requests in flight at the same time")
+parser.add_argument("--corenlp_endpoints", type=str, default=None,
+                    help="comma separated CoreNLP server urls to spread requests over, the ones in cfg.py by default")
+parser.add_argument("--corenlp_output", type=str, default="json",
+                    help="json|protobuf, protobuf needs the corenlp_protobuf package, see corenlp_output.py")
+parser.add_argument("--corenlp_timeout", default=60, type=float, help="seconds to wait for a CoreNLP request")
+parser.add_argument("--corenlp_retries", default=2, type=int, help="times a failed CoreNLP request is sent again")
 parser.add_argument("--exclude_list", action='store_true', help="use exclusion list defined in this file")
-parser.add_argument("--no_dep_cache", action='store_false', help="not caching dependency parsed result")
+parser.add_argument("--no_dep_cache", action='store_true', help="not caching dependency parsed result")
+parser.add_argument("--dep_cache", type=str, default=None,
+                    help="parse cache file, dep_parse_cache.sqlite in the corpus directory by default")
+parser.add_argument("--dep_cache_gb", default=20, type=float,
+                    help="size of the parse cache, the parses used longest ago are dropped beyond it")
+parser.add_argument("--pos_prescreen", action='store_true',
+                    help="tag sentences with POS first, only dependency parse the ones a marker pattern could match")
+parser.add_argument("--reextract", action='store_true',
+                    help="with --parse, take the parses from the parse cache instead of CoreNLP and only rerun the dependency patterns")
 
 args, _ = parser.parse_known_args()
 
@@ -61,11 +90,6 @@ with open(args.json, 'rb') as f:
 gigaword_sp_dir = json_config['gigaword_sp_dir']
 gigaword_sp_file = 'gigaword_sp.txt'
 
-import re
-
-import nltk
-spanish_tokenizer = nltk.data.load('tokenizers/punkt/spanish.pickle')
-
 
 def process_sent(sent, lang="sp"):
     #sent = re.sub(r"\(.+\)", "", sent)  # get rid of parentheses (many content inside are English/other languages)
@@ -82,61 +106,10 @@ def process_sent(sent, lang="sp"):
     return sent
 
 
-def extract_stories(lines):
-    # pass in all lines from a gigaword xml file
-    sentences = []
-
-    story_doc = False
-    paragraph = False
-    paragraph_text = []
-    for line in lines:
-        if 'DOC' in line and 'type="story"' in line:
-            story_doc = True
-        if '<P>' in line and story_doc:
-            paragraph = True
-            continue
-        if '</P>' in line and story_doc:
-            paragraph = False
-            sentence = "".join(paragraph_text).strip()
-            # preprocess the sentence
-            sentence = process_sent(sentence)
-            sentences.append(sentence)
-            paragraph_text = []
-        if '</DOC>' in line and story_doc:
-            story_doc = False
-
-        if paragraph:
-            paragraph_text.append(line)
-
-    return sentences
-
-
-def sent_tokenize(p):
-    sents = spanish_tokenizer.tokenize(p)
-    return sents
-
-
 def extrat_raw_gigaword():
-    news_sources = os.listdir(pjoin(gigaword_sp_dir, 'data'))
-    articles_processed = 0
-    sentences = []
-    for news_source in news_sources:
-        files = os.listdir(pjoin(gigaword_sp_dir, 'data', news_source))
-        files = filter(lambda s: '.gz' in s, files)
-        for file in files:
-            with gzip.open(pjoin(gigaword_sp_dir, 'data', news_source, file), 'rb') as f:
-                file_content = f.read()
-                lines = file_content.split('\n')
-                sents = extract_stories(lines)
-                sentences.extend(sents)
-            articles_processed += 1
-            if articles_processed % 20 == 0:
-                print("processed {} articles".format(articles_processed))
-                print("{} paragraphs are collected".format(len(sentences)))
-
-    with open(pjoin(gigaword_sp_dir, gigaword_sp_file), 'wb') as f:
-        for sent in sentences:
-            f.write(sent + '\n')
+    paragraphs = extract_corpus(gigaword_sp_dir, pjoin(gigaword_sp_dir, gigaword_sp_file), process_sent,
+                                workers=args.workers, incremental=args.incremental)
+    logger.info("{} paragraphs are collected".format(paragraphs))
 
 # def generate_pairs(sent_splits, marker_sent_list, marker_prev_list):
 #     # successive pairs
@@ -170,44 +143,51 @@ def collect_raw_sentences(source_dir, filenames, marker_set_tag, discourse_marke
         os.makedirs(output_dir)
 
     sentences = {marker: [] for marker in discourse_markers}
+    # duplicates are dropped here, so they are never sent to the parser
+    dedup = make_dedup(args.dedup, args.fingerprint_bits, path=pjoin(output_dir, "{}.seen".format(marker_set_tag)),
+                       capacity=args.dedup_capacity)
+    duplicates = 0
 
     for filename in filenames:
         logger.info("reading {}".format(filename))
         file_path = pjoin(source_dir, filename)
 
         previous_sentence = ""
-        with io.open(file_path, 'rU', encoding="utf-8") as f:
-            for i, sentence in enumerate(f):
-
-                # sentence tokenization here!!! <P> is not sentence.
-                sents = sent_tokenize(sentence) # these are already preprocessed
-
-                for sent in sents:
-                    sent = sent.replace("\t", "")
-                    # a single marker match, so continue is fine
-                    # we match the sentence length condition, but when there are multiple
-                    # markers, we sync with spanish, and defer the decision to parser!
-                    words = sent.lower().split(" ")
-                    for marker in discourse_markers:
-                      if len(marker.split(" ")) > 1:
-                        if marker in sent:
-                          line_to_write = "{}\t{}\t{}".format(sent, previous_sentence, marker)
-                          sentences[marker].append(line_to_write)
-                      else:
-                        if marker in words:
-                          line_to_write = "{}\t{}\t{}".format(sent, previous_sentence, marker)
-                          sentences[marker].append(line_to_write)
-
-                    previous_sentence = sent
-
-                    if i % args.filter_print_every == 0:
-                        logger.info("processed {}".format(i))
+        # sentence tokenization here!!! <P> is not sentence.
+        # the boundaries are cached next to the file, see segmentation.py
+        for i, (sentence, sents) in enumerate(iter_segmented_lines(file_path, "spanish", workers=args.workers)):
+
+            for sent in sents:
+                sent = sent.replace("\t", "")
+                # a single marker match, so continue is fine
+                # we match the sentence length condition, but when there are multiple
+                # markers, we sync with spanish, and defer the decision to parser!
+                words = sent.lower().split(" ")
+                for marker in discourse_markers:
+                  if len(marker.split(" ")) > 1:
+                    found = marker in sent
+                  else:
+                    found = marker in words
+                  if found:
+                    if not dedup.add((marker, sent, previous_sentence)):
+                      duplicates += 1
+                      continue
+                    line_to_write = "{}\t{}\t{}".format(sent, previous_sentence, marker)
+                    sentences[marker].append(line_to_write)
+
+                previous_sentence = sent
+
+                if i % args.filter_print_every == 0:
+                    logger.info("processed {}".format(i))
 
         logger.info("{} file finished".format(filename))
 
+    close_dedup(dedup)
+    logger.info("{} duplicate records dropped".format(duplicates))
     logger.info('writing files')
 
-    with open(pjoin(output_dir, "{}.tsv".format(marker_set_tag)), 'a') as f:
+    # the sentences are collected in memory, a rerun writes the file again
+    with open(pjoin(output_dir, "{}.tsv".format(marker_set_tag)), 'wb') as f:
       for marker in discourse_markers:
         for line in sentences[marker]:
           f.write(line + "\n")
@@ -250,39 +230,63 @@ def parse_filtered_sentences(source_dir, marker_set_tag):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    logger.info("setting up parser (actually just testing atm)")
-    setup_corenlp()
+    if args.reextract and args.no_dep_cache:
+        raise Exception("--reextract reads the parses from the parse cache")
+    if not args.reextract:
+        logger.info("setting up parser (actually just testing atm)")
+        setup_corenlp()
 
     # parsed_sentence_pairs = {marker: {"s1": [], "s2": []} for marker in discourse_markers}
-    with open(pjoin(output_dir, "{}_parsed_sentence_pairs.txt".format(marker_set_tag)), 'a') as w:
+    # the output is checkpointed, see checkpoints.py
+    # parses are kept across runs and marker sets, see parse_cache.py
+    dep_cache = None if args.no_dep_cache else args.dep_cache or pjoin(source_dir, PARSE_CACHE_FILE)
+    with cached_parses(dep_cache, max_gb=args.dep_cache_gb), \
+            ParseProgress(pjoin(output_dir, "{}_parsed_sentence_pairs.txt".format(marker_set_tag)),
+                          resume=args.resume, every=args.checkpoint_every) as w:
 
         with open(input_file_path, 'rb') as f:
             logger.info("reading {}".format(input_file_path))
-            i = 0
-            for line in f:
-              sentence, previous, marker = line[:-1].split("\t")
-              i+=1
-              if i > 0:
-                #try:
-                  parsed_output = dependency_parsing(sentence, previous, marker)
-                  if parsed_output:
-                    s1, s2 = parsed_output
-                    line_to_print = "{}\t{}\t{}\n".format(s1, s2, marker)
-                    w.write(line_to_print)
-                #except:
-                #  print i, marker, sentence
+            # the filter stage drops duplicates, but older record files can have them
+            seen = make_dedup(args.dedup, args.fingerprint_bits,
+                              path=pjoin(output_dir, "{}.seen".format(marker_set_tag)),
+                              capacity=args.dedup_capacity, exact=True)
+
+            def numbered_items():
+              i = 0
+              for line in f:
+                sentence, previous, marker = line[:-1].split("\t")
+                if not seen.add((marker, sentence, previous)):
+                  continue
+                i+=1
+                if i > w.done:  # parsed before the last checkpoint otherwise
+                  yield (i, marker), sentence, previous, marker
+
+            for (i, marker), parsed_output in dependency_parsing(numbered_items()):
+              if parsed_output:
+                s1, s2 = parsed_output
+                line_to_print = "{}\t{}\t{}\n".format(s1, s2, marker)
+                w.write(line_to_print)
+              w.checkpoint(i)
               if i % args.filter_print_every == 0:
                 logger.info("processed {}".format(i))
               #stop
+            close_dedup(seen)
             #logger.info("total sentences: {}".format(
             #    sum([len(sentences[marker]["sentence"]) for marker in sentences])
             #))
+            if args.pos_prescreen:
+                logger.info(prescreen_stats.summary())
+            if not args.reextract:
+                logger.info(parse_summary("sp"))
 
     logger.info('file writing complete')
 
 
-def dependency_parsing(sentence, previous_sentence, marker):
-    return depparse_ssplit(sentence, previous_sentence, marker, lang='sp')
+def dependency_parsing(items):
+    if args.reextract:
+        return reextract_stream(items, lang='sp', workers=args.workers)
+    return depparse_ssplit_stream(items, lang='sp', batch_size=args.batch_size, concurrency=args.concurrency,
+                                  prescreen=args.pos_prescreen)
 
 
 if __name__ == '__main__':
@@ -291,5 +295,7 @@ if __name__ == '__main__':
     elif args.filter:
         collect_raw_sentences(gigaword_sp_dir, [gigaword_sp_file], "ALL", SP_DISCOURSE_MARKERS)
     elif args.parse:
-        setup_corenlp("sp")
+        if not args.reextract:
+            setup_corenlp("sp", endpoints=args.corenlp_endpoints, output_format=args.corenlp_output,
+                          timeout=args.corenlp_timeout, retries=args.corenlp_retries)
         parse_filtered_sentences(gigaword_sp_dir, "ALL")
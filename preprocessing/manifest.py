@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Record of the input files each stage has processed, used by --incremental.
+
+MANIFEST.json sits in the markers_{tag} directory (or next to the extracted
+Gigaword text), so there is one per marker set tag:
+
+    {stage: {file name: {"size": ..., "mtime": ..., "sha1": ...}}}
+
+A file whose size and mtime match is skipped without reading it. Otherwise
+the first `size` bytes are hashed: if they match, the file only grew and
+everything after `size` is new. If not, the file changed: the records of its old
+version are in the outputs already and cannot be told apart from the others, so
+--incremental refuses to run and a full run (without --incremental) is needed.
+"""
+
+import os
+import json
+import hashlib
+from os.path import join as pjoin
+
+from checkpoints import save_checkpoint
+from records import find_records, record_files, read_record_ranges, read_records
+
+MANIFEST_FILE = "MANIFEST.json"
+
+
+def prefix_hash(file_path, size):
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        remaining = size
+        while remaining > 0:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            sha.update(block)
+            remaining -= len(block)
+    return sha.hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, directory):
+        self.path = pjoin(directory, MANIFEST_FILE)
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.stages = json.load(f)
+        else:
+            self.stages = {}
+
+    def processed_until(self, stage, name, file_path):
+        """
+        :return: byte offset up to which file_path was processed by stage,
+                 0 for a new file, its size if nothing was added
+        :raises Exception: if file_path changed (rather than grew) since stage processed it
+        """
+        entry = self.stages.get(stage, {}).get(name)
+        if entry is None:
+            return 0
+
+        size = os.path.getsize(file_path)
+        if size == entry["size"] and os.path.getmtime(file_path) == entry["mtime"]:
+            return size
+        if size < entry["size"] or prefix_hash(file_path, entry["size"]) != entry["sha1"]:
+            raise Exception("{} changed since the {} stage processed it, its old records are still in the output. "
+                            "Run the {} stage again without --incremental".format(name, stage, stage))
+        return entry["size"]
+
+    def check_unchanged(self, stage, files):
+        """
+        Fail before anything is written if one of the files changed, see processed_until.
+
+        :param files: [(name, path)]
+        """
+        for name, file_path in files:
+            self.processed_until(stage, name, file_path)
+
+    def is_processed(self, stage, name, file_path):
+        return self.processed_until(stage, name, file_path) == os.path.getsize(file_path)
+
+    def update(self, stage, name, file_path, size=None):
+        """
+        :param size: the part of the file that was processed, all of it by default
+        """
+        if size is None:
+            size = os.path.getsize(file_path)
+        self.stages.setdefault(stage, {})[name] = {"size": size, "mtime": os.path.getmtime(file_path),
+                                                   "sha1": prefix_hash(file_path, size)}
+
+    def save(self):
+        save_checkpoint(self.path, self.stages)
+
+
+def pending_records(manifest, input_dir, marker_set_tag, incremental):
+    """
+    Records of the filter stage output for the parse stage.
+
+    :return: (ranges, records), ranges is [(name, path, start, end)] for mark_processed,
+             None for the old json format, which is always read as a whole
+    """
+    if find_records(input_dir, marker_set_tag).endswith(".json"):
+        return None, read_records(input_dir, marker_set_tag)
+
+    ranges = []
+    for name, path in record_files(input_dir, marker_set_tag):
+        start = manifest.processed_until("parse", name, path) if incremental else 0
+        ranges.append((name, path, start, os.path.getsize(path)))
+    return ranges, read_record_ranges(ranges)
+
+
+def mark_processed(manifest, stage, ranges):
+    if ranges is None:
+        return
+    for name, path, _, end in ranges:
+        manifest.update(stage, name, path, size=end)
+    manifest.save()
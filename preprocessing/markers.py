@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Single-pass discourse marker matching for the filter stage.
+
+The marker set is compiled once into
+1. a regex over the raw line, used to reject lines with no marker
+   before they are tokenized at all, and
+2. a token trie, so that a tokenized line is matched against every
+   marker (including multi-word ones like "for example") in one pass.
+
+A marker matches when its words appear as consecutive whitespace-separated
+tokens, which is the same test as the old `proxy_marker in words` loop.
+"""
+
+import re
+
+from util import rephrase
+
+_END = None  # trie key marking the end of a marker
+
+
+class MarkerMatcher(object):
+    def __init__(self, discourse_markers):
+        self.markers = list(discourse_markers)
+
+        self.trie = {}
+        for marker in self.markers:
+            node = self.trie
+            for word in marker.split():
+                node = node.setdefault(word, {})
+            node[_END] = marker
+
+        # one-word markers are answered by a set intersection (runs in C),
+        # the trie is only walked from tokens that start a multi-word marker
+        self.single_word_markers = set(m for m in self.markers if len(m.split()) == 1)
+        self.multi_word_heads = set(m.split()[0] for m in self.markers if len(m.split()) > 1)
+
+        alternatives = [r"\s+".join(re.escape(w) for w in marker.split()) for marker in self.markers]
+        # longest first, so "for example" is tried before a plain "for"
+        alternatives.sort(key=len, reverse=True)
+        self.regex = re.compile(r"(?<!\S)(?:{})(?!\S)".format("|".join(alternatives)), re.UNICODE)
+
+    def search(self, line):
+        """
+        Cheap pre-check on the raw line: False means no marker can match.
+        """
+        return self.regex.search(line) is not None
+
+    def find(self, words):
+        """
+        :param words: tokenized sentence
+        :return: set of markers that occur in words
+        """
+        found = self.single_word_markers.intersection(words)
+
+        if self.multi_word_heads:
+            for i, word in enumerate(words):
+                if word not in self.multi_word_heads:
+                    continue
+                node = self.trie
+                for next_word in words[i:]:
+                    node = node.get(next_word)
+                    if node is None:
+                        break
+                    if _END in node:
+                        found.add(node[_END])
+
+        return found
+
+
+def keep_sentence(sentence, previous_sentence, first, min_seq_len, max_seq_len, min_ratio, max_ratio):
+    """
+    The length filter of the filter stage. Lengths are counted in the tokens of
+    util.rephrase, where "for example" is one token.
+
+    :param first: skip the ratio to the length of previous_sentence
+    """
+    n_words = len(rephrase(sentence).split())
+    # [min_len, max_len) like [5, 10)
+    if n_words >= max_seq_len or n_words < min_seq_len:
+        return False
+
+    # length-based filtering
+    if not first:
+        # because parser might request previous sentence
+        # we are here to control the balance. This is not s1 / s2 ratio.
+        len2 = len(rephrase(previous_sentence).split())
+        ratio = float(len2) / n_words
+
+        if ratio <= min_ratio or ratio >= max_ratio:
+            return False
+
+    return True
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of CoreNLP parses, shared by all runs of the parse stage.
+
+A parse is stored under the sha1 of (language, annotators, text), where text
+is the sentence exactly as it is sent to the server, after cleanup() and the
+language specific fixes in get_parse. The same text always gets the same
+parse, so rerunning the parse stage after a crash, with other dependency
+patterns or with another marker set only asks CoreNLP for new sentences.
+
+The parses are zlib compressed json in an sqlite table:
+
+    parses (key BLOB PRIMARY KEY, parse BLOB, used REAL)
+
+`used` is the time of the last hit. When the file grows past max_bytes,
+the parses used longest ago are dropped until it is at 90% of that.
+
+Worker processes open the file with read_only=True. They never write to it,
+so they do not wait for each other's locks.
+"""
+
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PARSE_CACHE_FILE = "dep_parse_cache.sqlite"
+
+# keep this much of max_bytes after an eviction
+_EVICT_TO = 0.9
+
+
+def cache_key(lang, annotators, text):
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return hashlib.sha1(b"\t".join([lang, annotators, text])).digest()
+
+
+class ParseCache(object):
+    """
+    Safe to share between the threads of depparse_ssplit_stream.
+    """
+
+    def __init__(self, path, max_bytes=None, commit_every=1000, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._used = []
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if read_only:
+            self.n = None
+            return
+
+        self.db.execute("PRAGMA journal_mode = WAL")
+        # a parse lost in a crash is only asked for again
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS parses (key BLOB PRIMARY KEY, parse BLOB, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS parses_used ON parses (used)")
+        self.db.commit()
+        self.n = self.db.execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+        logger.info("parse cache {}: {} parses, {:.1f} MB".format(path, self.n, self.nbytes() / 1e6))
+
+    def nbytes(self):
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def get_many(self, lang, annotators, texts):
+        """
+        :return: the cached parse of each text, None where there is none
+        """
+        keys = [cache_key(lang, annotators, text) for text in texts]
+        with self._lock:
+            found = {}
+            # sqlite allows 999 parameters per statement
+            for k in range(0, len(keys), 500):
+                chunk = keys[k:k + 500]
+                rows = self.db.execute("SELECT key, parse FROM parses WHERE key IN ({})".format(
+                    ",".join("?" * len(chunk))), [sqlite3.Binary(key) for key in chunk])
+                for key, parse in rows:
+                    found[bytes(key)] = parse
+
+            parses = []
+            now = time.time()
+            for key in keys:
+                parse = found.get(key)
+                if parse is None:
+                    self.misses += 1
+                    parses.append(None)
+                else:
+                    self.hits += 1
+                    if not self.read_only:
+                        self._used.append((now, sqlite3.Binary(key)))
+                    parses.append(json.loads(zlib.decompress(bytes(parse))))
+            if len(self._used) >= self.commit_every:
+                self._commit()
+            return parses
+
+    def get(self, lang, annotators, text):
+        return self.get_many(lang, annotators, [text])[0]
+
+    def put_many(self, lang, annotators, texts, parses):
+        """
+        stores the parses that are not None
+        """
+        now = time.time()
+        rows = [(sqlite3.Binary(cache_key(lang, annotators, text)),
+                 sqlite3.Binary(zlib.compress(json.dumps(parse, separators=(',', ':')))), now)
+                for text, parse in zip(texts, parses) if parse is not None]
+        if not rows:
+            return
+        assert not self.read_only
+        with self._lock:
+            # another thread may have stored the same text meanwhile
+            cursor = self.db.executemany("INSERT OR IGNORE INTO parses VALUES (?, ?, ?)", rows)
+            self.n += cursor.rowcount
+            self.stored += len(rows)
+            self._pending += len(rows)
+            if self._pending >= self.commit_every:
+                self._commit()
+
+    def put(self, lang, annotators, text, parse):
+        self.put_many(lang, annotators, [text], [parse])
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def summary(self):
+        with self._lock:
+            return "parse cache: {} hits, {} misses ({:.1%} hit rate), {} stored, {} evicted, {} parses in {:.1f} MB".format(
+                self.hits, self.misses, self.hit_rate(), self.stored, self.evicted, self.n, self.nbytes() / 1e6)
+
+    def close(self):
+        with self._lock:
+            if not self.read_only:
+                self._commit()
+            self.db.close()
+
+    def _commit(self):
+        if self._used:
+            self.db.executemany("UPDATE parses SET used = ? WHERE key = ?", self._used)
+            self._used = []
+        self.db.commit()
+        self._pending = 0
+        if self.max_bytes is not None:
+            self._evict()
+
+    def _evict(self):
+        nbytes = self.nbytes()
+        if nbytes <= self.max_bytes or self.n == 0:
+            return
+        # rows are about the same size, drop enough of the oldest to get under the bound
+        n_drop = int((nbytes - _EVICT_TO * self.max_bytes) / (float(nbytes) / self.n)) + 1
+        self.db.execute("DELETE FROM parses WHERE key IN (SELECT key FROM parses ORDER BY used LIMIT ?)", (n_drop,))
+        self.db.commit()
+        n = self.db.execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+        self.evicted += self.n - n
+        logger.info("parse cache: evicted {} parses, {:.1f} MB left".format(self.n - n, self.nbytes() / 1e6))
+        self.n = n
@@ -27,12 +27,21 @@ import os
 from os.path import join as pjoin
 
 import json
-from itertools import izip
+import threading
+from itertools import izip, islice
+from bisect import bisect_right
+from collections import deque, defaultdict, OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from copy import deepcopy as cp
+from contextlib import contextmanager
 from cfg import DISCOURSE_MARKER_SET_TAG
 from cfg import EN_DISCOURSE_MARKERS, CH_DISCOURSE_MARKERS, SP_DISCOURSE_MARKERS
-from cfg import EN_PORT, SP_PORT, CH_PORT
+from corenlp_client import get_client, set_endpoints
+from parse_cache import ParseCache
+from corenlp_output import request_properties, decode_sentences, lean_sentence, is_binary, set_output_format
+from compact_parse import CompactParse, compact_parse, intern_name, TAGS, RELATIONS
 
 np.random.seed(123)
 
@@ -226,30 +235,47 @@ def extract_subphrase(orig_words, parsed_words, extraction_indices, lang="en"):
 use corenlp server (see https://github.com/erindb/corenlp-ec2-startup)
 to parse sentences: tokens, dependency parse
 """
-def get_parse(sentence, lang="en", depparse=True):
+def parsed_text(sentence, lang="en"):
+    """
+    The text that is sent to CoreNLP for sentence.
+    """
     if lang == 'en':
         sentence = sentence.replace("'t ", " 't ")
-        port = EN_PORT
-    elif lang == "ch":
-        port = CH_PORT
-    elif lang == "sp" or lang=="es":
-        port = SP_PORT
+    return sentence
+
+
+def get_parse(sentence, lang="en", depparse=True):
+    sentence = parsed_text(sentence, lang)
+
+    annotators = get_annotators(depparse)
+    if _parse_cache is not None:
+        parse = _parse_cache.get(lang, annotators, sentence)
+        if parse is not None:
+            return parse
+
+    parse = request_parse(sentence, lang, annotators)
+    if parse is not None and _parse_cache is not None:
+        _parse_cache.put(lang, annotators, sentence, parse)
+    return parse
 
+
+def get_annotators(depparse=True):
     if depparse:
-        url = "http://localhost:" + str(port) + "?properties={annotators:'tokenize,ssplit,pos,depparse'}"
+        return 'tokenize,ssplit,pos,depparse'
     else:
-        url = "http://localhost:" + str(port) + "?properties={annotators:'tokenize,ssplit,pos'}"
+        return 'tokenize,ssplit,pos'
+
+
+def request_parse(sentence, lang, annotators):
+    properties = request_properties(annotators)
 
     data = sentence
 
-    parse_string = requests.post(url, data=data).text
-  
-    parse_string = parse_string.replace('\r\n', '')
-    parse_string = parse_string.replace('\x19', '')
+    # keeps the connection open for the next request
+    parse_string = get_client(lang).annotate(data, properties, raw=is_binary())
 
     try:
-      parsed_output = json.loads(parse_string)
-      sentences = parsed_output["sentences"]
+      sentences = decode_sentences(parse_string)
       if len(sentences)>0:
         return sentences[0]
       else:
@@ -258,24 +284,342 @@ def get_parse(sentence, lang="en", depparse=True):
         return None
 
     except ValueError:
+        # last resort, drop everything but the expected characters
         try:
+          parse_string = parse_string.replace('\r\n', '')
+          parse_string = parse_string.replace('\x19', '')
           if lang=="en":
-            return json.loads(re.sub("[^A-z0-9.,!:?\"'*&/\{\}\[\]()=+-]", "", parse_string))["sentences"][0]
+            return lean_sentence(json.loads(re.sub("[^A-z0-9.,!:?\"'*&/\{\}\[\]()=+-]", "", parse_string))["sentences"][0])
           elif lang=="sp":
-            return json.loads(re.sub("[^áéíóúñÑü¿?¡!ÁÉÍÓÚÜªºA-z0-9.,:\"'*&/\{\}\[\]()=+-]", "", parse_string))["sentences"][0]
+            return lean_sentence(json.loads(re.sub("[^áéíóúñÑü¿?¡!ÁÉÍÓÚÜªºA-z0-9.,:\"'*&/\{\}\[\]()=+-]", "", parse_string))["sentences"][0])
         except:
           print "error loading json:"
           print sentence
           return None
 
 
+# parses are looked up here before asking the server, see parse_cache.py
+_parse_cache = None
+
+
+def set_parse_cache(cache):
+    """
+    :param cache: a ParseCache, or None to parse everything
+    """
+    global _parse_cache
+    _parse_cache = cache
+
+
+@contextmanager
+def cached_parses(path, max_gb=None):
+    """
+    Uses the ParseCache at path within the with block, and no cache if path is None.
+    """
+    if path is None:
+        yield None
+        return
+
+    cache = ParseCache(path, max_bytes=None if max_gb is None else int(max_gb * 2 ** 30))
+    set_parse_cache(cache)
+    try:
+        yield cache
+    finally:
+        set_parse_cache(None)
+        logger.info(cache.summary())
+        cache.close()
+
+
+# Inputs of a batch are separated by a blank line, and CoreNLP is told that a newline
+# always ends a sentence, so no sentence spans two inputs. Within an input sentences
+# are split as usual and the first one is kept, the same as get_parse does.
+BATCH_SEPARATOR = "\n\n"
+# records group_items looks at together, see there
+GROUP_WINDOW = 10000
+
+
+def _utf16_len(text):
+    # CoreNLP character offsets count java chars
+    return len(text.decode("utf-8").encode("utf-16-le")) // 2
+
+
+def _rebase_offsets(sentence, offset):
+    # make the sentence look like it came from a request of its own
+    for token in sentence["tokens"]:
+        if "characterOffsetBegin" in token:
+            token["characterOffsetBegin"] -= offset
+            token["characterOffsetEnd"] -= offset
+    sentence["index"] = 0
+    return sentence
+
+
+class ParseStats(object):
+    """
+    What the parse stage lost, logged at its end. The client counts the
+    timeouts and retries, see CoreNLPClient.summary.
+    """
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.unreadable = 0
+        self.batch_fallbacks = 0
+        self.batch_splits = 0
+        self.bad_parses = 0
+        self.pair_errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, n=1):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + n)
+
+    def summary(self):
+        with self._lock:
+            return ("parse stage: {} sentences sent to corenlp, {} lost to failed requests, {} unreadable, "
+                    "{} batches parsed one by one, {} failed batches split, {} bad parses, {} find_pair errors").format(
+                self.sent, self.failed, self.unreadable, self.batch_fallbacks, self.batch_splits, self.bad_parses,
+                self.pair_errors)
+
+
+parse_stats = ParseStats()
+
+
+def parse_summary(lang="en"):
+    return "\n".join([parse_stats.summary(), get_client(lang).summary()])
+
+
+def _request_parse_or_none(text, lang, annotators):
+    parse_stats.add("sent")
+    try:
+        parse = request_parse(text, lang, annotators)
+    except requests.RequestException as e:
+        # the client gave up after its retries
+        logger.warning("parse failed: {}".format(e))
+        parse_stats.add("failed")
+        return None
+    except Exception as e:
+        logger.warning("bad response: {}".format(e))
+        parse = None
+    if parse is None:
+        parse_stats.add("unreadable")
+    elif _parse_cache is not None:
+        _parse_cache.put(lang, annotators, text, parse)
+    return parse
+
+
+def get_parses(sentences, lang="en", depparse=True, offline=False):
+    """
+    Parse many sentences with one request.
+    Only the sentences that are not in the parse cache are sent.
+
+    :param sentences: utf-8 strings
+    :param offline: only look the sentences up in the parse cache, never ask the server
+    :return: one parsed sentence (or None) per input, the same as get_parse of each
+    """
+    if len(sentences) == 0:
+        return []
+
+    texts = [parsed_text(sentence, lang) for sentence in sentences]
+
+    annotators = get_annotators(depparse)
+    if _parse_cache is not None:
+        parses = _parse_cache.get_many(lang, annotators, texts)
+    else:
+        parses = [None] * len(texts)
+    missing = [k for k, parse in enumerate(parses) if parse is None]
+    if offline:
+        return parses
+
+    for k, parse in izip(missing, _request_parses([texts[k] for k in missing], lang, annotators)):
+        parses[k] = parse
+    return parses
+
+
+def _request_parses(texts, lang, annotators):
+    """
+    Parse texts with one request. A batch the servers fail on (a timeout, or an
+    error answer) is split in halves and those are sent again, so a sentence that
+    is too long for the timeout or that the server rejects only loses itself.
+    """
+    # a line break inside an input would split it, and an unreadable
+    # batch response costs one request per sentence, like before
+    if len(texts) <= 1 or any("\n" in text or "\r" in text for text in texts):
+        return [_request_parse_or_none(text, lang, annotators) for text in texts]
+
+    properties = request_properties(annotators, **{"ssplit.newlineIsSentenceBreak": "always"})
+
+    starts = []
+    position = 0
+    for text in texts:
+        starts.append(position)
+        position += _utf16_len(text) + len(BATCH_SEPARATOR)
+
+    try:
+        parse_string = get_client(lang).annotate(BATCH_SEPARATOR.join(texts), properties, raw=is_binary())
+    except requests.ConnectionError as e:
+        # no server could be reached after the client's retries, smaller requests would only wait
+        # on the same servers. The sentences are not cached, so the next run asks for them again
+        logger.warning("batch of {} failed: {}".format(len(texts), e))
+        parse_stats.add("sent", len(texts))
+        parse_stats.add("failed", len(texts))
+        return [None] * len(texts)
+    except requests.RequestException as e:
+        logger.warning("batch of {} failed ({}), splitting it".format(len(texts), e))
+        parse_stats.add("batch_splits")
+        half = len(texts) // 2
+        return (_request_parses(texts[:half], lang, annotators) +
+                _request_parses(texts[half:], lang, annotators))
+
+    try:
+        parsed_sentences = decode_sentences(parse_string)
+
+        batch_parses = [None] * len(texts)
+        for parsed_sentence in parsed_sentences:
+            j = bisect_right(starts, parsed_sentence["tokens"][0]["characterOffsetBegin"]) - 1
+            if batch_parses[j] is None:
+                batch_parses[j] = _rebase_offsets(parsed_sentence, starts[j])
+
+    except Exception as e:
+        logger.warning("batch of {} unreadable ({}), parsing one by one".format(len(texts), e))
+        parse_stats.add("batch_fallbacks")
+        return [_request_parse_or_none(text, lang, annotators) for text in texts]
+
+    parse_stats.add("sent", len(texts))
+    if _parse_cache is not None:
+        _parse_cache.put_many(lang, annotators, texts, batch_parses)
+    return batch_parses
+
+
+def as_unicode(text):
+    # words are unicode; a str key would be decoded on every comparison with them
+    return text.decode("utf-8") if isinstance(text, str) else text
+
+
+def compile_dependency_patterns(patterns):
+    """
+    Turns {marker: [dep_pattern]} into a lookup of the token a marker can be
+    matched at: (lower cased word, POS, relation to its governor) ->
+    [(marker, number of the pattern, position of the word in the marker head,
+    number of children the token needs)].
+
+    The POS test of find_pair is `token pos in dep_pattern["POS"]`, so every
+    substring of the pattern's POS is a key.
+    """
+    compiled = defaultdict(list)
+    for marker, marker_patterns in patterns.items():
+        n_children = len(marker.split(" ")) - 1
+        for pattern_number, dep_pattern in enumerate(marker_patterns):
+            # POS and relations as in the vocabularies of compact_parse.py
+            pos = intern_name(dep_pattern["POS"])
+            pos_keys = set(intern_name(pos[i:j]) for i in range(len(pos) + 1) for j in range(i, len(pos) + 1))
+            relation = intern_name(dep_pattern["S2"])
+            marker_head = dep_pattern["head"] if "head" in dep_pattern else marker
+            for word_position, word in enumerate(as_unicode(marker_head).split(u" ")):
+                for pos_key in pos_keys:
+                    compiled[(word, pos_key, relation)].append((marker, pattern_number, word_position, n_children))
+    return dict(compiled)
+
+
+compiled_dependency_patterns = dict((lang, compile_dependency_patterns(patterns))
+                                    for lang, patterns in dependency_patterns.items())
+compiled_marker_words = dict((lang, set(word for word, _, _ in compiled))
+                             for lang, compiled in compiled_dependency_patterns.items())
+compiled_marker_tags = dict((lang, set((word, pos) for word, pos, _ in compiled))
+                            for lang, compiled in compiled_dependency_patterns.items())
+
+
 class Sentence():
-    def __init__(self, json_sentence, original_sentence, lang):
-        self.json = json_sentence
-        self.dependencies = json_sentence["basicDependencies"]
-        self.tokens = json_sentence["tokens"]
+    def __init__(self, parse, original_sentence, lang):
+        """
+        :param parse: a CompactParse, or a sentence of CoreNLP's JSON output to convert to one
+        :param original_sentence: the sentence as it was given to get_parse, phrases are cut out of it
+        """
+        if not isinstance(parse, CompactParse):
+            parse = compact_parse(parse)
+        self.parse = parse
         self.original_sentence = original_sentence
         self.lang = lang
+
+        # the dependency graph is indexed on the first lookup, most sentences
+        # are rejected by the POS test of their marker before that
+        self.edges = None
+        # (index, dir, relation) -> the edges of edges[dir][index] with that relation
+        self.typed_edges = {}
+        # flags by token index, filled as they are asked for
+        self.verb_flags = {}
+        # the tree in preorder, see index_subtrees
+        self.preorder = None
+        self.trees_indexed = False
+        # see index_text
+        self.text_indexed = False
+        # lang -> pattern_matches
+        self.matches = {}
+
+    def index_graph(self):
+        """
+        edges[dir][index] is [(dependency number, index at its other end)] for
+        dir parents and children, in the order of the parse's dependencies.
+        """
+        parents = defaultdict(list)
+        children = defaultdict(list)
+        for d, (governor, dependent) in enumerate(izip(self.parse.governors, self.parse.dependents)):
+            parents[dependent].append((d, governor))
+            children[governor].append((d, dependent))
+        self.edges = {"parents": parents, "children": children}
+
+    def index_subtrees(self):
+        """
+        One walk over the dependency tree. The subtree of a token is
+        self.preorder[self.begin[index]:self.end[index]], the token first, and
+        self.levels has the distance of every token from its root.
+
+        A graph that is not a tree (a token with two governors, a cycle) keeps
+        self.preorder None, get_subordinate_indices searches it level by level.
+        """
+        self.trees_indexed = True
+        if self.edges is None:
+            self.index_graph()
+        parents = self.edges["parents"]
+        children = self.edges["children"]
+        if any(len(edges) > 1 for edges in parents.itervalues()):
+            return
+
+        preorder = []
+        begin = {}
+        end = {}
+        levels = {}
+        for top in children.keys():
+            if top in parents:
+                continue
+            levels[top] = 0
+            stack = [top]
+            while stack:
+                index = stack.pop()
+                if index < 0:
+                    end[~index] = len(preorder)
+                    continue
+                begin[index] = len(preorder)
+                preorder.append(index)
+                stack.append(~index)
+                for _, child in children.get(index, []):
+                    levels[child] = levels[index] + 1
+                    stack.append(child)
+
+        # tokens on a cycle are not below any root
+        if len(begin) < len(set(parents) | set(children)):
+            return
+        self.preorder = preorder
+        self.begin = begin
+        self.end = end
+        self.levels = levels
+
+    def typed(self, index, dir, relation):
+        key = (index, dir, relation)
+        if key not in self.typed_edges:
+            relation_id = RELATIONS.ids.get(relation)
+            relations = self.parse.relations
+            self.typed_edges[key] = [(d, other) for d, other in self.edges[dir].get(index, [])
+                                     if relations[d] == relation_id]
+        return self.typed_edges[key]
+
     def indices(self, word):
         if len(word.split(" ")) > 1:
             words = word.split(" ")
@@ -284,11 +628,15 @@ class Sentence():
         else:
             # print " ".join([t["word"].lower() for t in self.tokens])
             # print word.lower()
-            return [i+1 for i in get_indices([t["word"].lower() for t in self.tokens], word)]
-    def token(self, index):
-        return self.tokens[int(index)-1]
+            return [i+1 for i in get_indices([w.lower() for w in self.parse.words], word)]
+    def pos(self, index):
+        return TAGS.names[self.parse.tags[int(index)-1]]
+    def relation(self, d):
+        return RELATIONS.names[self.parse.relations[d]]
     def word(self, index):
-        return self.token(index)["word"]
+        return self.parse.words[int(index)-1]
+    def parsed_words(self):
+        return self.parse.words
 
     def find_parents(self, index, filter_types=False, needs_verb=False):
         deps = self.find_deps(index, dir="parents", filter_types=filter_types)
@@ -296,7 +644,8 @@ class Sentence():
         if needs_verb:
             deps = [d for d in deps if self.gov_is_verb(d)]
 
-        return [d["governor"] for d in deps]
+        governors = self.parse.governors
+        return [governors[d] for d in deps]
 
     def find_children(self, index, filter_types=False, exclude_types=False, needs_verb=False, exclude_type_and_POS=False):
         deps = self.find_deps(
@@ -311,15 +660,20 @@ class Sentence():
             deps = [d for d in deps if self.dep_is_verb(d)]
 
         # print(deps)
-        return [d["dependent"] for d in deps]
+        dependents = self.parse.dependents
+        return [dependents[d] for d in deps]
 
     def is_punct(self, index):
-        pos = self.token(index)["pos"]
         # return pos in '.,"-RRB--LRB-:;'
-        return pos in PUNCTUATION
+        return self.pos(index) in PUNCTUATION
 
     def is_verb(self, index):
-        pos = self.token(index)["pos"]
+        if index not in self.verb_flags:
+            self.verb_flags[index] = self._is_verb(index)
+        return self.verb_flags[index]
+
+    def _is_verb(self, index):
+        pos = self.pos(index)
         if pos[0] == "V":
             return True
         else:
@@ -331,39 +685,42 @@ class Sentence():
                 return False
 
     def gov_is_verb(self, d):
-        index = d["governor"]
+        index = self.parse.governors[d]
         return self.is_verb(index)
 
     def dep_is_verb(self, d):
-        index = d["dependent"]
+        index = self.parse.dependents[d]
         return self.is_verb(index)
 
     def find_deps(self, index, dir=None, filter_types=False, exclude_types=False, exclude_type_and_POS=False):
-        deps = []
-        if dir=="parents" or dir==None:
-            deps += [{"dep": d, "index": d['governor']} for d in self.dependencies if d['dependent']==index]
-        if dir=="children" or dir==None:
-            deps += [{"dep": d, "index": d['dependent']} for d in self.dependencies if d['governor']==index]
-
-        if filter_types:
-            deps = [d for d in deps if d["dep"]["dep"] in filter_types]
+        if self.edges is None:
+            self.index_graph()
+        dirs = ["parents", "children"] if dir==None else [dir]
+        if isinstance(filter_types, list) and len(filter_types) == 1:
+            deps = [e for dir in dirs for e in self.typed(index, dir, filter_types[0])]
+        else:
+            deps = [e for dir in dirs for e in self.edges[dir].get(index, [])]
+            # a string is a substring test, is_verb looks for "cop" like that
+            if filter_types:
+                deps = [(d, other) for d, other in deps if self.relation(d) in filter_types]
+
         if exclude_types:
-            deps = [d for d in deps if not d["dep"]["dep"] in exclude_types]
+            deps = [(d, other) for d, other in deps if not self.relation(d) in exclude_types]
 
         if exclude_type_and_POS:
-            deps = [d for d in deps if (d["dep"]["dep"], self.token(d["index"])["pos"]) not in exclude_type_and_POS]
+            deps = [(d, other) for d, other in deps if (self.relation(d), self.pos(other)) not in exclude_type_and_POS]
 
-        return [d["dep"] for d in deps]
+        return [d for d, _ in deps]
 
     def find_dep_types(self, index, dir=None, filter_types=False):
         deps = self.find_deps(index, dir=dir, filter_types=filter_types)
-        return [d["dep"] for d in deps]
+        return [self.relation(d) for d in deps]
 
     def __str__(self):
         if self.lang == "ch":
-            return "".join([t["word"] for t in self.tokens])
+            return "".join(self.parse.words)
         else:
-            return " ".join([t["word"] for t in self.tokens])
+            return " ".join(self.parse.words)
 
     def get_subordinate_indices(self, acc, explore, depth=0, exclude_indices=[], exclude_types=[]):
         # print("acc: {}\nexplore: {}\ndepth: {}\nexclude_indices: {}".format(acc, explore, depth, exclude_indices))
@@ -403,13 +760,52 @@ class Sentence():
                 exclude_types=exclude_types
             )
 
+    def get_subtree_indices(self, head_index, exclude_indices=[], exclude_types=[]):
+        """
+        get_subordinate_indices from head_index, by walking its subtree in preorder
+        and skipping the subtrees of the children it would not explore.
+        """
+        if not self.trees_indexed:
+            self.index_subtrees()
+        if self.preorder is None:
+            return self.get_subordinate_indices(
+                acc=[head_index],
+                explore=[head_index],
+                exclude_indices=exclude_indices,
+                exclude_types=exclude_types
+            )
+        if head_index not in self.begin:
+            return [head_index]
+
+        exclude_indices = set(exclude_indices)
+        parents = self.edges["parents"]
+        top_level = self.levels[head_index] + 1
+        indices = [head_index]
+        position = self.begin[head_index] + 1
+        end = self.end[head_index]
+        while position < end:
+            c = self.preorder[position]
+            dep = self.relation(parents[c][0][0])
+            if (dep in exclude_types or
+                    (self.levels[c] == top_level and (dep, self.pos(c)) in top_level_deps_to_ignore_if_extra) or
+                    c in exclude_indices or
+                    # commas next to excluded indices
+                    ((c+1 in exclude_indices or c-1 in exclude_indices) and self.word(c)==",")):
+                position = self.end[c]
+                continue
+            # get_subordinate_indices gives up below 15 levels
+            if self.levels[c] - top_level >= 15:
+                return None
+            indices.append(c)
+            position += 1
+        return indices
+
     def get_phrase_from_head(self, head_index, exclude_indices=[], exclude_types=[]):
 
         # given an index,
         # grab every index that's a child of it in the dependency graph
-        subordinate_indices = self.get_subordinate_indices(
-            acc=[head_index],
-            explore=[head_index],
+        subordinate_indices = self.get_subtree_indices(
+            head_index,
             exclude_indices=exclude_indices,
             exclude_types=exclude_types
         )
@@ -436,31 +832,9 @@ class Sentence():
         else:
             # filter so that lengths are nicely behaved, unless it's chinese where tokenization is harder...
 
-            # make string of subordinate phrase from parse
-            parse_subordinate_string = " ".join([self.word(i) for i in subordinate_indices])
-
-            # if "ONU" in parse_subordinate_string:
-            #     print parse_subordinate_string
-
-            # correct subordinate phrase from parsed version to wikitext version
-            # (tokenization systems are different)
-            orig_words = self.original_sentence.split()
-            parsed_words = [t["word"] for t in self.tokens]
-            #print subordinate_indices
-
-            # if "estudios" in parse_subordinate_string:
-            #     # print orig_words
-            #     # print len(orig_words)
-            #     # print parsed_words
-            #     # print len(parsed_words)
-            #     for i in range(len(parsed_words)):
-            #         try:
-            #             print parsed_words[i],
-            #             print orig_words[i]
-            #         except:
-            #             print parsed_words[i]
-
-            subordinate_phrase = extract_subphrase(orig_words, parsed_words, subordinate_indices, lang="sp")
+            # correct subphrase from parsed version to wikitext version
+            # (tokenization systems are different) by the character offsets of the tokens
+            subordinate_phrase = self.subphrase(subordinate_indices)
 
         # if "ONU" in subordinate_phrase:
         #     print subordinate_phrase
@@ -471,6 +845,116 @@ class Sentence():
         else:
             return None
 
+    def subphrase(self, indices):
+        """
+        :param indices: sorted token indices
+        :return: the original sentence at the tokens, see span_text. The parsed words
+                 joined by spaces if the offsets do not fit the original sentence
+        """
+        phrase = self.span_text(indices)
+        if phrase is None:
+            phrase = " ".join([self.word(i) for i in indices])
+        return phrase
+
+    def span_text(self, indices):
+        """
+        Slices every token out of the original sentence with the character offsets
+        CoreNLP gives it, and joins them by a space like the parsed words.
+
+        :param indices: sorted token indices
+        :return: None if the offsets do not fit the original sentence
+        """
+        if not self.text_indexed:
+            self.index_text()
+        positions = self.text_positions
+        if positions is None:
+            return None
+
+        begins = self.parse.begins
+        ends = self.parse.ends
+        spans = []
+        for i in indices:
+            begin, end = begins[i-1], ends[i-1]
+            if not 0 <= begin <= end < len(positions):
+                return None
+            # tokens of one word, like "del" split into "de el", share its offsets
+            if spans and begin < spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            elif begin < end:
+                spans.append([begin, end])
+        return u" ".join([self.text[positions[begin]:positions[end]] for begin, end in spans])
+
+    def index_text(self):
+        """
+        CoreNLP's offsets count java chars of the text as parsed_text sent it.
+        self.text_positions has the position in self.text, the original sentence,
+        of each of them, or is None if the texts can not be lined up.
+        """
+        self.text_indexed = True
+        text = as_unicode(self.original_sentence)
+        self.text = text
+        parsed = parsed_text(text, self.lang)
+        if parsed == text and len(text.encode("utf-16-le")) == 2 * len(text):
+            self.text_positions = range(len(text) + 1)
+            return
+
+        positions = []
+        j = 0
+        for c in parsed:
+            positions.append(j)
+            if c > u"\uffff":
+                # two java chars
+                positions.append(j)
+            # parsed_text only inserts characters
+            if j < len(text) and text[j] == c:
+                j += 1
+        positions.append(j)
+        self.text_positions = positions if j == len(text) else None
+
+    def pattern_matches(self, lang):
+        """
+        What the loops of find_pair try for every marker at once, from one pass
+        over the tokens with compiled_dependency_patterns.
+
+        :return: {marker: [((pattern number, word position, marker index), S2 heads)]},
+                 in the order find_pair tries them. Marker indices without an S2 head are left out
+        """
+        if lang in self.matches:
+            return self.matches[lang]
+        compiled = compiled_dependency_patterns[lang]
+        marker_words = compiled_marker_words[lang]
+        marker_tags = compiled_marker_tags[lang]
+        needs_verb = lang == "en" or lang == "sp"
+
+        candidates = []
+        for i, word in enumerate(self.parsed_words()):
+            word = word.lower()
+            if word in marker_words:
+                pos = self.pos(i + 1)
+                if (word, pos) in marker_tags:
+                    candidates.append((i + 1, word, pos))
+        # a sentence without a marker word of the right POS needs no graph
+        if candidates and self.edges is None:
+            self.index_graph()
+
+        found = defaultdict(list)
+        for index, word, pos in candidates:
+            n_children = len(self.edges["children"].get(index, []))
+            for d, governor in self.edges["parents"].get(index, []):
+                for marker, pattern_number, word_position, marker_children in compiled.get((word, pos, self.relation(d)), []):
+                    if marker_children != n_children or (needs_verb and not self.is_verb(governor)):
+                        continue
+                    found[(marker, pattern_number, word_position, index)].append(governor)
+
+        matches = defaultdict(list)
+        for (marker, pattern_number, word_position, index), s2_candidates in sorted(found.items()):
+            matches[marker].append(((pattern_number, word_position, index), s2_candidates))
+        self.matches[lang] = matches
+        return matches
+
+    def marker_matches(self, marker, lang):
+        return self.pattern_matches(lang).get(marker, [])
+
     def get_valid_marker_indices(self, marker, dep_pattern):
         pos = dep_pattern["POS"]
         if "head" in dep_pattern:
@@ -478,7 +962,7 @@ class Sentence():
         else:
             marker_head = marker
 
-        valid_marker_indices = [i for i in self.indices(marker_head) if self.token(i)["pos"] in pos ]
+        valid_marker_indices = [i for i in self.indices(marker_head) if self.pos(i) in pos ]
         # if marker=="so":
         #     for i in valid_marker_indices:
         #         print self.find_children(i)
@@ -523,86 +1007,85 @@ class Sentence():
         #     print " ".join([t["word"] for t in self.tokens])
         #     print self.get_valid_marker_indices(marker)
 
-        for dep_pattern in dependency_patterns[lang][marker]:
-            #print dep_pattern
-            for marker_index in self.get_valid_marker_indices(marker, dep_pattern):
-                #print marker_index
-                # if " ".join([t["word"] for t in self.tokens])=="The government buried many in mass graves , some above-ground tombs were forced open so bodies could be stacked inside , and others were burned .":
-                #     print marker_index
+        # the patterns of every marker are matched together, see pattern_matches
+        marker_patterns = dependency_patterns[lang][marker]
+        for (pattern_number, _, marker_index), s2_candidates in self.marker_matches(marker, lang):
+            dep_pattern = marker_patterns[pattern_number]
+            #print marker_index
 
-                # if marker=="and" and "magical" in str(self):
-                #     print marker_index
+            for s2_head_index in s2_candidates:
+                s2_ind = s2_head_index
+                #print s2_ind
+                possible_S1s = []
 
-                s2_candidates = self.get_candidate_S2_indices(marker, marker_index, dep_pattern, needs_verb=needs_verb)
-                #print s2_candidates
+                s1_candidates = self.get_candidate_S1_indices(marker, s2_head_index, dep_pattern, needs_verb=needs_verb)
                 
-                for s2_head_index in s2_candidates:
-                    s2_ind = s2_head_index
-                    #print s2_ind
-                    possible_S1s = []
-
-                    s1_candidates = self.get_candidate_S1_indices(marker, s2_head_index, dep_pattern, needs_verb=needs_verb)
-                    
-                    if "acceptable_order" in dep_pattern:
-                        if dep_pattern["acceptable_order"]=="S1 S2":
-                            s1_candidates = [s1_ind for s1_ind in s1_candidates if s1_ind < s2_ind]
-                            
-                    
-                    for s1_head_index in s1_candidates:
-                        # print(marker_index, s2_ind, s1_head_index)
-                        #print s1_head_index
-                        # store S1 if we have one
-                        S1 = self.get_phrase_from_head(
-                            s1_head_index,
-                            exclude_indices=[s2_head_index]
-                        )
-
-                        #print S1
-                        # we'll lose some stuff here because of alignment between
-                        # wikitext tokenization and corenlp tokenization.
-                        # if we can't get a phrase, reject this pair
-                        if not S1:
-                            break
-
-                        # if we are only checking for the "reverse" order, reject anything else
-                        if order=="s2 discourse_marker s1":
-                            if s1_ind < s2_ind:
-                                break
-
-                        possible_S1s.append((s1_head_index, S1))
-
-                    # to do: fix this. it is wrong. we're just grabbing the first if there are multiple matches for the S1 pattern rather than choosing in a principled way
-                    # if len(possible_S1s) > 1:
-                        # could sort by something here...
-                        # possible_S1s = sorted(possible_S1s, key=lambda t: -abs(marker_index - t[0]))
-                        # print self
-                        # print possible_S1s
-                    if len(possible_S1s) > 0:
-                        s1_ind, S1 = possible_S1s[0]
-
-                    # store S2 if we have one
-                    S2 = self.get_phrase_from_head(
-                        s2_head_index,
-                        exclude_indices=[marker_index, s1_ind],
-                        # exclude_types=dependency_patterns[marker]["S1"]
+                if "acceptable_order" in dep_pattern:
+                    if dep_pattern["acceptable_order"]=="S1 S2":
+                        s1_candidates = [s1_ind for s1_ind in s1_candidates if s1_ind < s2_ind]
+                        
+                
+                for s1_head_index in s1_candidates:
+                    # print(marker_index, s2_ind, s1_head_index)
+                    #print s1_head_index
+                    # store S1 if we have one
+                    S1 = self.get_phrase_from_head(
+                        s1_head_index,
+                        exclude_indices=[s2_head_index]
                     )
-                    #print S2
 
+                    #print S1
                     # we'll lose some stuff here because of alignment between
                     # wikitext tokenization and corenlp tokenization.
                     # if we can't get a phrase, reject this pair
-                    # update: we fixed some of these with the @ correction
-                    if not S2:
-                        return None
+                    if not S1:
+                        break
+
+                    # if we are only checking for the "reverse" order, reject anything else
+                    if order=="s2 discourse_marker s1":
+                        if s1_ind < s2_ind:
+                            break
 
-                extracted_pairs.append((S1, S2))
+                    possible_S1s.append((s1_head_index, S1))
+
+                # to do: fix this. it is wrong. we're just grabbing the first if there are multiple matches for the S1 pattern rather than choosing in a principled way
+                # if len(possible_S1s) > 1:
+                    # could sort by something here...
+                    # possible_S1s = sorted(possible_S1s, key=lambda t: -abs(marker_index - t[0]))
+                    # print self
+                    # print possible_S1s
+                if len(possible_S1s) > 0:
+                    s1_ind, S1 = possible_S1s[0]
+
+                # store S2 if we have one
+                S2 = self.get_phrase_from_head(
+                    s2_head_index,
+                    exclude_indices=[marker_index, s1_ind],
+                    # exclude_types=dependency_patterns[marker]["S1"]
+                )
+                #print S2
+
+                # we'll lose some stuff here because of alignment between
+                # wikitext tokenization and corenlp tokenization.
+                # if we can't get a phrase, reject this pair
+                # update: we fixed some of these with the @ correction
+                if not S2:
+                    return None
+
+            extracted_pairs.append((S1, S2))
+
+        # as after looping over the patterns, the flip below is the one of the last pattern
+        if marker_patterns:
+            dep_pattern = marker_patterns[-1]
 
         for S1, S2 in extracted_pairs:
 
             # if S2 is the whole sentence *and* we're missing S1, let S1 be the previous sentence
             words_in_marker = marker.split()
             if S2 and not S1:
-                words_in_sentence = [t["word"] for t in self.tokens if not self.is_punct(t["index"])]
+                # the words of the original sentence, as S2 has them
+                whole_sentence = self.subphrase(range(1, len(self.parse) + 1)) or ""
+                words_in_sentence = [t for t in whole_sentence.split() if not t in PUNCTUATION]
                 words_in_s2 = [t for t in S2.split() if not t in PUNCTUATION]
                 if len(words_in_sentence) - len(words_in_marker) == len(words_in_s2):
                     S1 = previous_sentence[0].capitalize() + previous_sentence[1:]
@@ -617,7 +1100,25 @@ class Sentence():
 
         return None
 
-def setup_corenlp(lang="en"):
+def setup_corenlp(lang="en", endpoints=None, output_format=None, timeout=None, retries=None):
+    """
+    :param endpoints: CoreNLP server urls, comma separated, instead of the ones in cfg.py
+    :param output_format: json or protobuf, see corenlp_output.py
+    :param timeout: seconds to wait for the answer to a request
+    :param retries: times a failed request is sent again
+    """
+    if endpoints:
+        set_endpoints(lang, endpoints)
+    if output_format:
+        set_output_format(output_format)
+    client = get_client(lang)
+    if timeout is not None:
+        client.timeout = timeout
+    if retries is not None:
+        client.retries = retries
+    live = client.check_health()
+    logger.info("{} of {} corenlp servers for '{}' are up".format(len(live), len(client.endpoints), lang))
+
     try:
         test_sentences = {"en": "The quick brown fox jumped over the lazy dog.", "ch": "当周二开始申购时,有数万人涌入索取MTRC的申请表,可以说是盛况空前。", "sp": "Que voy a hacer?"}
         get_parse(test_sentences[lang], lang=lang)
@@ -664,6 +1165,255 @@ def depparse_ssplit(sentence, previous_sentence, marker, lang="en"):
     else:
         return None
 
+def could_have_pair(tokens, marker, lang="en"):
+    """
+    The first test of get_valid_marker_indices, on tokens with POS tags only.
+    If no word of the marker has a POS that one of its dependency patterns
+    allows, find_pair finds nothing, whatever the dependency parse.
+    """
+    words = [t["word"].lower() for t in tokens]
+    for dep_pattern in dependency_patterns[lang].get(marker, []):
+        marker_head = dep_pattern.get("head", marker)
+        for word in marker_head.split(" "):
+            for i in get_indices(words, word):
+                if tokens[i]["pos"] in dep_pattern["POS"]:
+                    return True
+    return False
+
+
+class PrescreenStats(object):
+    def __init__(self):
+        self.screened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def add(self, screened, rejected):
+        with self._lock:
+            self.screened += screened
+            self.rejected += rejected
+
+    def summary(self):
+        rate = float(self.rejected) / self.screened if self.screened else 0.0
+        return "POS pre-screen: {} of {} sentences rejected before depparse ({:.1%})".format(
+            self.rejected, self.screened, rate)
+
+
+prescreen_stats = PrescreenStats()
+
+
+def pos_prescreen(texts, markers, lang="en"):
+    """
+    Tags the sentences with 'tokenize,ssplit,pos' only, which is much cheaper than
+    depparse, and drops the ones where none of their markers could be matched.
+    CoreNLP runs the same tagger with or without depparse, so no pair is lost.
+
+    :param markers: the markers of each text
+    :return: True for each text that needs the dependency parse
+    """
+    tagged = get_parses(texts, lang=lang, depparse=False)
+    keep = []
+    for tagged_sentence, text_markers in izip(tagged, markers):
+        # a failed tagging request is no reason to skip the sentence
+        keep.append(tagged_sentence is None or
+                    any(could_have_pair(tagged_sentence["tokens"], marker, lang) for marker in text_markers))
+    prescreen_stats.add(len(texts), keep.count(False))
+    return keep
+
+
+def depparse_ssplit_batch(items, lang="en", offline=False, prescreen=False):
+    """
+    depparse_ssplit of every (sentence, previous_sentence, markers) in items,
+    with all the sentences parsed in one request (see get_parses). A sentence
+    is parsed once and find_pair runs on that parse for each of its markers.
+
+    :param offline: only use parses from the parse cache
+    :param prescreen: tag the sentences first and only parse the ones that pass pos_prescreen
+    :return: a list with one pair, or None, per marker for each item
+    """
+    sentences = [cleanup(sentence.strip(), lang) for sentence, _, _ in items]
+    texts = [sentence.encode("utf-8") for sentence in sentences]
+    if prescreen and not offline:
+        keep = pos_prescreen(texts, [markers for _, _, markers in items], lang)
+        kept = [k for k in range(len(texts)) if keep[k]]
+        parses = [None] * len(texts)
+        for k, parse in izip(kept, get_parses([texts[k] for k in kept], lang=lang)):
+            parses[k] = parse
+    else:
+        parses = get_parses(texts, lang=lang, offline=offline)
+
+    results = []
+    for (_, previous_sentence, markers), sentence, parse in izip(items, sentences, parses):
+        pairs = [None] * len(markers)
+        if parse:
+            try:
+                parsed_sentence = Sentence(parse, sentence, lang)
+            except Exception as e:
+                logger.warning("bad parse: {}".format(e))
+                parse_stats.add("bad_parses")
+                parsed_sentence = None
+
+            for k, marker in enumerate(markers):
+                if parsed_sentence is None:
+                    break
+                try:
+                    pairs[k] = parsed_sentence.find_pair(marker, "any", previous_sentence.strip(), lang=lang)
+                except Exception as e:
+                    logger.warning("no pair for {}: {}".format(marker, e))
+                    parse_stats.add("pair_errors")
+        results.append(pairs)
+    return results
+
+
+def group_items(items, window=GROUP_WINDOW):
+    """
+    Joins the items with the same sentence and previous sentence among each
+    `window` items, so the markers of a sentence share one parse. The filter
+    stage writes the records for the markers of a sentence one after the other,
+    but a sentence can also come again a few records later. Records in
+    different --shard_by_marker files are further apart than that.
+
+    :param items: iterable of (key, sentence, previous_sentence, marker)
+    :return: generator of (keys, sentence, previous_sentence, markers), each key
+             with its position in items, (position, key). _ungroup puts them back in order
+    """
+    items = iter(items)
+    position = 0
+    while True:
+        groups = OrderedDict()
+        for key, sentence, previous_sentence, marker in islice(items, window):
+            group = groups.get((sentence, previous_sentence))
+            if group is None:
+                group = groups[sentence, previous_sentence] = ([], sentence, previous_sentence, [])
+            group[0].append((position, key))
+            group[3].append(marker)
+            position += 1
+        if not groups:
+            return
+        for group in groups.itervalues():
+            yield group
+
+
+def _ungroup(batches):
+    """
+    :param batches: iterable of (batch of group_items groups, their results)
+    :return: generator of (key, pair), in the order of the items before group_items.
+             Only the items of about one window are held back
+    """
+    done = {}
+    position = 0
+    for batch, results in batches:
+        for (keys, _, _, _), pairs in izip(batch, results):
+            for (i, key), pair in izip(keys, pairs):
+                done[i] = (key, pair)
+        while position in done:
+            yield done.pop(position)
+            position += 1
+
+
+def ordered_batches(fn, items, batch_size, pool, depth, fn_args=()):
+    """
+    Runs fn(batch, *fn_args) on batches of items in a thread or process pool.
+
+    :param items: iterable of (key, ...), fn gets the items without their keys
+    :param pool: None to run everything in this thread
+    :param depth: most batches handed out at a time
+    :return: generator of (batch, fn result), in the order of items
+    """
+    items = iter(items)
+
+    # batches are handed out in order and collected in order. Only a bounded
+    # number is queued, so the input is not read ahead further than that
+    pending = deque()
+    while True:
+        batch = list(islice(items, batch_size))
+        if batch:
+            job = ([item[1:] for item in batch],) + tuple(fn_args)
+            if pool is None:
+                pending.append((batch, FinishedResult(fn(*job))))
+            else:
+                pending.append((batch, pool.apply_async(fn, job)))
+
+        if not pending:
+            return
+        if batch and len(pending) < depth:
+            continue
+
+        batch, result = pending.popleft()
+        yield batch, result.get()
+
+
+def depparse_ssplit_stream(items, lang="en", batch_size=32, concurrency=1, prescreen=False):
+    """
+    :param items: iterable of (key, sentence, previous_sentence, marker)
+    :param batch_size: sentences per request, the markers of a sentence share its parse
+    :param concurrency: most batches parsed at the same time, each by its own thread.
+                        The client lowers this while the servers answer slowly, see ConcurrencyLimit
+    :param prescreen: skip the dependency parse of sentences that fail pos_prescreen
+    :return: generator of (key, pair or None), in the order of items
+    """
+    get_client(lang).set_max_concurrency(concurrency)
+    pool = ThreadPool(concurrency) if concurrency > 1 else None
+    try:
+        batches = ordered_batches(depparse_ssplit_batch, group_items(items), batch_size, pool,
+                                  2 * concurrency, (lang, False, prescreen))
+        for key, pair in _ungroup(batches):
+            yield key, pair
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _open_worker_cache(path):
+    # the connection inherited from the parent process must not be used here
+    set_parse_cache(ParseCache(path, read_only=True))
+
+
+def reextract_batch(items, lang="en"):
+    hits, misses = _parse_cache.hits, _parse_cache.misses
+    results = depparse_ssplit_batch(items, lang, offline=True)
+    return results, _parse_cache.hits - hits, _parse_cache.misses - misses
+
+
+def reextract_stream(items, lang="en", batch_size=1000, workers=1):
+    """
+    depparse_ssplit_stream with the parses taken from the parse cache, without
+    asking the server. Only the dependency patterns and the phrase extraction
+    run again, in `workers` processes. Sentences with no stored parse get None.
+
+    :param items: iterable of (key, sentence, previous_sentence, marker)
+    :return: generator of (key, pair or None), in the order of items
+    """
+    if _parse_cache is None:
+        raise Exception("re-extraction needs the parse cache")
+
+    pool = Pool(workers, _open_worker_cache, (_parse_cache.path,)) if workers > 1 else None
+
+    def counted(batches):
+        for batch, (results, hits, misses) in batches:
+            if pool is not None:
+                # count the lookups of the workers in the cache statistics
+                _parse_cache.hits += hits
+                _parse_cache.misses += misses
+            yield batch, results
+
+    try:
+        batches = ordered_batches(reextract_batch, group_items(items), batch_size, pool, 2 * workers, (lang,))
+        for key, pair in _ungroup(counted(batches)):
+            yield key, pair
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+class FinishedResult(object):
+    # the part of AsyncResult used above, for runs without threads
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.parse_args()
@@ -2,7 +2,16 @@
 # -*- coding: utf-8 -*-
 
 """
+Runs the test items of {lang}_tests.json through depparse_ssplit:
 
+    python parser_test.py --lang en
+    python parser_test.py --lang en --standin
+
+The first asks the CoreNLP server of cfg.py. --standin starts corenlp_standin.py
+with the parses recorded in {lang}_tests_parses.jsonl instead, so no Java is
+needed. Items without a recorded parse are skipped; record them again with
+
+    python corenlp_standin.py --record en_tests.json --lang en
 """
 
 import numpy as np
@@ -13,7 +22,9 @@ import pickle
 import requests
 import re
 
-from parser import depparse_ssplit, setup_corenlp
+from parser import depparse_ssplit, setup_corenlp, cleanup, parsed_text
+from corenlp_client import get_client
+from corenlp_standin import start_standin, load_fixtures, fixtures_path_for_tests
 from dep_patterns import en_dependency_patterns, ch_dependency_patterns, sp_dependency_patterns
 dependency_patterns = None
 
@@ -33,17 +44,28 @@ np.random.seed(123)
 
 def setup_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--lang", type=str, default='en', help="en|ch|es")
+    parser.add_argument("--lang", type=str, default='en', help="en|ch|sp")
+    parser.add_argument("--standin", action='store_true',
+                        help="parse with corenlp_standin.py and the recorded {lang}_tests_parses.jsonl")
     return parser.parse_args()
 
 
-def test(lang):
-    if lang == "en":
-        data = json.load(open("en_tests.json"))
-    elif lang == "sp":
-        data = json.load(open("sp_tests.json"))
-    elif lang == "ch":
-        data = json.load(open("ch_tests.json"))
+def path_of_tests(lang):
+    return "{}_tests.json".format(lang)
+
+
+def as_pair(output):
+    # ch_tests.json keeps the expected pair as a json string
+    if isinstance(output, basestring):
+        return json.loads(output)
+    return list(output) if output else None
+
+
+def test(lang, fixtures=None):
+    """
+    :param fixtures: the texts the stand-in has parses for, items with other texts are skipped
+    """
+    data = json.load(open(path_of_tests(lang)))
 
     test_items = data["test_items"]
     curious_cases = data["curious_cases"]
@@ -77,15 +99,23 @@ def test(lang):
     # n_tests = 79
     # i = 0
     failures = 0
+    skipped = 0
     print("running tests...")
 
     for item in test_items:
         # if i < n_tests:
-            output = depparse_ssplit(item["sentence"], item["previous_sentence"], item["marker"], lang)
-            if output:
-                output = "[\"" + "\", \"".join(list(output)) + "\"]"
+            if fixtures is not None:
+                text = parsed_text(cleanup(item["sentence"].strip(), lang).encode("utf-8"), lang).decode("utf-8")
+                if text not in fixtures:
+                    skipped += 1
+                    continue
+            try:
+                output = as_pair(depparse_ssplit(item["sentence"], item["previous_sentence"], item["marker"], lang))
+            except KeyError as e:
+                # a marker without dependency patterns
+                output = "KeyError: {}".format(e)
             try:
-                assert(output == item["output"])
+                assert(output == as_pair(item["output"]))
             except AssertionError:
                 print("====== TEST FAILED ======" + "\nsentence: " + item["sentence"] + "\nmarker: " + item["marker"] + "\nactual output: " + str(output) + "\ndesired output: " + str(item["output"]))
                 failures += 1
@@ -96,11 +126,24 @@ def test(lang):
         #     print(output)
         # i += 1
 
+    print("{} of {} tests passed, {} skipped without a recorded parse".format(
+        len(test_items) - failures - skipped, len(test_items) - skipped, skipped))
     if failures==0:
         print("All tests passed.")
+    return failures
 
 if __name__ == '__main__':
     args = setup_args()
-    setup_corenlp(args.lang)
-    test(args.lang)
+    fixtures = None
+    if args.standin:
+        fixtures = load_fixtures(fixtures_path_for_tests(path_of_tests(args.lang)))
+        server = start_standin(fixtures=fixtures)
+        setup_corenlp(args.lang, endpoints=server.url)
+        test(args.lang, fixtures)
+        # the kept-alive connection, so the stand-in's threads are done before exit
+        get_client(args.lang).session().close()
+        server.shutdown()
+    else:
+        setup_corenlp(args.lang)
+        test(args.lang)
 
@@ -13,10 +13,15 @@ import json
 import argparse
 
 import logging
-from util import rephrase
 from os.path import join as pjoin
 
-from parser import depparse_ssplit, setup_corenlp
+from parser import depparse_ssplit_stream, reextract_stream, setup_corenlp, cached_parses, prescreen_stats, parse_summary
+from parse_cache import PARSE_CACHE_FILE
+from markers import MarkerMatcher, keep_sentence
+from checkpoints import ParseProgress, load_filter_checkpoint, save_filter_checkpoint, resume_position
+from dedup import DEDUP_MODES, make_dedup, close_dedup
+from records import RecordWriter, find_records, number_records, write_statistics, update_statistics
+from manifest import Manifest, pending_records, mark_processed
 from cfg import DISCOURSE_MARKER_SET_TAG, EN_DISCOURSE_MARKERS, EN_FIVE_DISCOURSE_MARKERS, EN_EIGHT_DISCOURSE_MARKERS
 
 import sys
@@ -31,10 +36,39 @@ parser.add_argument("--max_seq_len", default=50, type=int)
 parser.add_argument("--min_seq_len", default=5, type=int)
 parser.add_argument("--max_ratio", default=5.0, type=float)
 parser.add_argument("--filter_print_every", default=10000, type=int)
+parser.add_argument("--buffer_size", default=10000, type=int, help="filtered records kept in memory before writing")
+parser.add_argument("--shard_by_marker", action='store_true', help="write one record file per marker")
+parser.add_argument("--dedup", default="memory", choices=DEDUP_MODES,
+                    help="how repeated (marker, sentence, previous) records are detected, see dedup.py")
+parser.add_argument("--fingerprint_bits", default=64, type=int, choices=[64, 128])
+parser.add_argument("--dedup_capacity", default=10 ** 8, type=int, help="expected number of records for --dedup bloom")
+
+parser.add_argument("--incremental", action='store_true',
+                    help="only filter or parse input that is new or grown since the last run, see manifest.py")
+parser.add_argument("--resume", action='store_true', help="continue the filter or parse stage from its last checkpoint")
+parser.add_argument("--checkpoint_every", default=10000, type=int,
+                    help="lines (filter) or sentences (parse) between checkpoints")
 
 parser.add_argument("--parse", action='store_true',
                     help="Stage 2: run parsing on filtered sentences, collect sentence pairs (S1 and S2)")
-# parser.add_argument("--no_dep_cache", action='store_true', help="not caching dependency parsed result")
+parser.add_argument("--batch_size", default=32, type=int, help="sentences per CoreNLP request")
+parser.add_argument("--concurrency", default=4, type=int, help="CoreNLP requests in flight at the same time")
+parser.add_argument("--corenlp_endpoints", type=str, default=None,
+                    help="comma separated CoreNLP server urls to spread requests over, the ones in cfg.py by default")
+parser.add_argument("--corenlp_output", type=str, default="json",
+                    help="json|protobuf, protobuf needs the corenlp_protobuf package, see corenlp_output.py")
+parser.add_argument("--corenlp_timeout", default=60, type=float, help="seconds to wait for a CoreNLP request")
+parser.add_argument("--corenlp_retries", default=2, type=int, help="times a failed CoreNLP request is sent again")
+parser.add_argument("--no_dep_cache", action='store_true', help="not caching dependency parsed result")
+parser.add_argument("--dep_cache", type=str, default=None,
+                    help="parse cache file, dep_parse_cache.sqlite in the corpus directory by default")
+parser.add_argument("--dep_cache_gb", default=20, type=float,
+                    help="size of the parse cache, the parses used longest ago are dropped beyond it")
+parser.add_argument("--pos_prescreen", action='store_true',
+                    help="tag sentences with POS first, only dependency parse the ones a marker pattern could match")
+parser.add_argument("--reextract", action='store_true',
+                    help="with --parse, take the parses from the parse cache instead of CoreNLP and only rerun the dependency patterns")
+parser.add_argument("--workers", default=1, type=int, help="number of processes for --reextract")
 
 parser.add_argument("--split", action='store_true',
                     help="Stage 3: load in parsed sentences pairs and split into discourse marker set based groups")
@@ -81,68 +115,73 @@ def collect_raw_sentences(source_dir, filenames, marker_set_tag, discourse_marke
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    sentences = {marker: {"sentence": [], "previous": []} for marker in discourse_markers}
+    manifest = Manifest(markers_dir)
+    if args.incremental:
+        manifest.check_unchanged("filter", [(filename, pjoin(source_dir, filename)) for filename in filenames])
+    checkpoint_path, state = load_filter_checkpoint(output_dir, marker_set_tag, args.resume)
+    # duplicates are dropped here, so they are never sent to the parser
+    dedup = make_dedup(args.dedup, args.fingerprint_bits, path=pjoin(output_dir, "{}.seen".format(marker_set_tag)),
+                       capacity=args.dedup_capacity)
+    writer = RecordWriter(output_dir, marker_set_tag, shard_by_marker=args.shard_by_marker,
+                          buffer_size=args.buffer_size, resume_state=state["writer"] if state else None,
+                          dedup=dedup, append=args.incremental)
+    matcher = MarkerMatcher(discourse_markers)
 
     for filename in filenames:
-        logger.info("reading {}".format(filename))
+        position = resume_position(state, filenames, filename)
+        if position is None:
+            logger.info("{} was finished before the checkpoint".format(filename))
+            continue
+
         file_path = pjoin(source_dir, filename)
+        if args.incremental and manifest.is_processed("filter", filename, file_path):
+            logger.info("{} has not changed since the last run".format(filename))
+            continue
+
+        logger.info("reading {}".format(filename))
 
-        previous_sentence = ""
-        previous_sentence_split = None
+        previous_sentence = position.get("previous", "")
         FIRST = True
         with io.open(file_path, 'rU', encoding="utf-8") as f:
             for i, sentence in enumerate(f):
-                words = rephrase(sentence).split()  # replace "for example"
-                for marker in discourse_markers:
-                    if marker == "for example":
-                        proxy_marker = "for_example"
-                    else:
-                        proxy_marker = marker
-
-                    # [min_len, max_len) like [5, 10)
-                    if len(words) >= args.max_seq_len or len(words) < args.min_seq_len:
-                        continue
-
-                    # length-based filtering
-                    if not FIRST:
-                        # because parser might request previous sentence
-                        # we are here to control the balance. This is not s1 / s2 ratio.
-                        len2 = len(previous_sentence_split)
-                        ratio = float(len2) / len(words)
-
-                        if ratio <= args.min_ratio or ratio >= args.max_ratio:
-                            continue
-
-                    # all bookcorpus text are lower case
-                    if proxy_marker in words:
-                        sentences[marker]["sentence"].append(sentence)
-                        sentences[marker]["previous"].append(previous_sentence)
+                if i < position.get("line", 0):
+                    continue
+                if i % args.checkpoint_every == 0:
+                    save_filter_checkpoint(checkpoint_path, writer,
+                                           {"file": filename, "line": i, "previous": previous_sentence})
+
+                # most lines have no marker at all, drop them before tokenizing
+                if matcher.search(sentence):
+                    if keep_sentence(sentence, previous_sentence, FIRST, args.min_seq_len, args.max_seq_len,
+                                     args.min_ratio, args.max_ratio):
+                        for marker in sorted(matcher.find(sentence.split())):
+                            writer.write(marker, sentence, previous_sentence)
 
                 previous_sentence = sentence
-                previous_sentence_split = words
 
                 if i % args.filter_print_every == 0:
                     logger.info("processed {}".format(i))
 
+        save_filter_checkpoint(checkpoint_path, writer, {"file": filename, "finished": True})
         logger.info("{} file finished".format(filename))
 
-    logger.info('writing files')
-
-    with open(pjoin(output_dir, "{}.json".format(marker_set_tag)), 'wb') as f:
-        json.dump(sentences, f)
-
+    writer.close()
+    close_dedup(dedup)
+    logger.info("{} duplicate records dropped".format(writer.duplicates))
     logger.info('file writing complete')
 
-    statistics_lines = []
-    for marker in sentences:
-        n_sentences = len(sentences[marker]["sentence"])
-        statistics_lines.append("{}\t{}".format(marker, n_sentences))
+    counts = {marker: writer.counts.get(marker, 0) for marker in discourse_markers}
+    if args.incremental:
+        update_statistics(markers_dir, counts)
+    else:
+        write_statistics(markers_dir, counts)
 
-    statistics_report = "\n".join(statistics_lines)
-    with open(pjoin(markers_dir, "VERSION.txt"), "wb") as f:
-        f.write(
-            "commit: \n\ncommand: \n\nmarkers:\n" + statistics_report
-        )
+    if not args.incremental:
+        # the records were written again, so they have to be parsed again
+        manifest.stages = {}
+    for filename in filenames:
+        manifest.update("filter", filename, pjoin(source_dir, filename))
+    manifest.save()
 
 
 def parse_filtered_sentences(source_dir, filenames, marker_set_tag, discourse_markers):
@@ -158,58 +197,80 @@ def parse_filtered_sentences(source_dir, filenames, marker_set_tag, discourse_ma
 
     markers_dir = pjoin(source_dir, "markers_" + marker_set_tag)
     input_dir = pjoin(markers_dir, "sentences")
-    input_file_path = pjoin(input_dir, "{}.json".format(marker_set_tag))
     output_dir = pjoin(markers_dir, "parsed_sentence_pairs")
 
     if not os.path.exists(markers_dir):
         raise Exception("{} does not exist".format(markers_dir))
     if not os.path.exists(input_dir):
         raise Exception("{} does not exist".format(input_dir))
-    if not os.path.exists(input_file_path):
-        raise Exception("{} does not exist".format(input_file_path))
+    if find_records(input_dir, marker_set_tag) is None:
+        raise Exception("no filtered sentences in {}".format(input_dir))
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    logger.info("setting up parser (actually just testing atm)")
-    setup_corenlp()
+    if args.reextract and args.no_dep_cache:
+        raise Exception("--reextract reads the parses from the parse cache")
+    if not args.reextract:
+        logger.info("setting up parser (actually just testing atm)")
+        setup_corenlp(endpoints=args.corenlp_endpoints, output_format=args.corenlp_output,
+                      timeout=args.corenlp_timeout, retries=args.corenlp_retries)
+
+    # with --incremental, only records added since the last parse are read and their
+    # pairs appended. After a full filter run everything is parsed again.
+    manifest = Manifest(markers_dir)
+    incremental = args.incremental and "parse" in manifest.stages
+    ranges, records = pending_records(manifest, input_dir, marker_set_tag, incremental)
 
     # parsed_sentence_pairs = {marker: {"s1": [], "s2": []} for marker in discourse_markers}
-    with open(pjoin(output_dir, "{}_parsed_sentence_pairs.txt".format(marker_set_tag)), 'a') as w:
+    # the output is checkpointed, see checkpoints.py
+    # parses are kept across runs and marker sets, see parse_cache.py
+    dep_cache = None if args.no_dep_cache else args.dep_cache or pjoin(source_dir, PARSE_CACHE_FILE)
+    with cached_parses(dep_cache, max_gb=args.dep_cache_gb), \
+            ParseProgress(pjoin(output_dir, "{}_parsed_sentence_pairs.txt".format(marker_set_tag)),
+                          resume=args.resume, every=args.checkpoint_every, append=incremental) as w:
         # header = "{}\t{}\t{}\n".format("s1", "s2", "marker")
         # w.write(header)
 
-        with open(input_file_path, 'rb') as f:
-            logger.info("reading {}".format(input_file_path))
-            sentences = json.load(f)
-            logger.info("total sentences: {}".format(
-                sum([len(sentences[marker]["sentence"]) for marker in sentences])
-            ))
-            for marker, slists in sentences.iteritems():
-                i = 0
-                if marker in discourse_markers:
-                    # if marker == "because":
-                    for sentence, previous in set(zip(slists["sentence"], slists["previous"])):
-                        i += 1
-                        if True:
-                            parsed_output = dependency_parsing(sentence, previous, marker)
-                            if parsed_output:
-                                s1, s2 = parsed_output
-
-                                line_to_print = "{}\t{}\t{}\n".format(s1, s2, marker)
-                                w.write(line_to_print)
-
-                            if i % args.filter_print_every == 0:
-                                logger.info("processed {}".format(i))
-
+        logger.info("reading {}".format(find_records(input_dir, marker_set_tag)))
+        # the filter stage drops duplicates, but older record files can have them
+        seen = make_dedup(args.dedup, args.fingerprint_bits, path=pjoin(output_dir, "{}.seen".format(marker_set_tag)),
+                          capacity=args.dedup_capacity, exact=True)
+        # records up to w.done were parsed before the last checkpoint
+        items = (((i, marker), sentence, previous, marker)
+                 for i, marker, sentence, previous in number_records(records, discourse_markers, seen, w.done))
+        for (i, marker), parsed_output in dependency_parsing(items):
+            if parsed_output:
+                s1, s2 = parsed_output
+
+                line_to_print = "{}\t{}\t{}\n".format(s1, s2, marker)
+                w.write(line_to_print)
+            w.checkpoint(i)
+
+            if i % args.filter_print_every == 0:
+                logger.info("processed {}".format(i))
+
+        close_dedup(seen)
+        logger.info("total sentences: {}".format(w.records))
+        if args.pos_prescreen:
+            logger.info(prescreen_stats.summary())
+        if not args.reextract:
+            logger.info(parse_summary("en"))
+
+    mark_processed(manifest, "parse", ranges)
     logger.info('file writing complete')
 
 
-def dependency_parsing(sentence, previous_sentence, marker):
-    try:
-        return depparse_ssplit(sentence, previous_sentence, marker)
-    except:
-        return None
+def dependency_parsing(items):
+    """
+    :param items: (key, sentence, previous, marker)
+    :return: (key, pair or None) in the same order, sentences are sent to CoreNLP in batches,
+             or with --reextract looked up in the parse cache
+    """
+    if args.reextract:
+        return reextract_stream(items, workers=args.workers)
+    return depparse_ssplit_stream(items, batch_size=args.batch_size, concurrency=args.concurrency,
+                                  prescreen=args.pos_prescreen)
 
 from collections import defaultdict
 
@@ -223,14 +284,14 @@ def split_parsed_sentences(source_dir, marker_set_tag):
     eight_sents = []
     all_sents = []
 
-    sent_hash_set = set()  # we expect repeating entries
+    sent_hash_set = make_dedup(args.dedup, args.fingerprint_bits, path=pjoin(output_dir, "split.seen"),
+                               capacity=args.dedup_capacity, exact=True)  # we expect repeating entries
     marker_stats = defaultdict(int)
 
     with open(pjoin(output_dir, "{}_parsed_sentence_pairs.txt".format(marker_set_tag)), 'r') as f:
         # this is a tsv file
         for line in f:
-            if line not in sent_hash_set:
-                sent_hash_set.add(line)
+            if sent_hash_set.add((line,)):
                 row = line.strip().split('\t')
                 marker_stats[row[2]] += 1
                 all_sents.append(row)
@@ -239,6 +300,8 @@ def split_parsed_sentences(source_dir, marker_set_tag):
                 if row[2] in EN_EIGHT_DISCOURSE_MARKERS:
                     eight_sents.append(row)
 
+    close_dedup(sent_hash_set)
+
     for k, v in marker_stats.iteritems():
         print "{}: {}".format(k, v)
 
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""
+Interchange format between the filter and the parse stage.
+
+One {"marker": ..., "sentence": ..., "previous": ...} json record per line,
+either all in sentences/{tag}.jsonl or split into sentences/{tag}/{marker}.jsonl.
+Both stages stream records, so memory is bounded by the write buffer
+instead of the corpus size.
+
+The old sentences/{tag}.json blob ({marker: {"sentence": [], "previous": []}})
+can still be read.
+"""
+
+import os
+import json
+from os.path import join as pjoin
+
+from checkpoints import sync_file, truncate_file
+
+
+def jsonl_path(input_dir, marker_set_tag):
+    return pjoin(input_dir, "{}.jsonl".format(marker_set_tag))
+
+
+def marker_shard_dir(input_dir, marker_set_tag):
+    return pjoin(input_dir, marker_set_tag)
+
+
+def legacy_json_path(input_dir, marker_set_tag):
+    return pjoin(input_dir, "{}.json".format(marker_set_tag))
+
+
+def marker_file_name(marker):
+    return marker.replace(" ", "_") + ".jsonl"
+
+
+def encode_record(marker, sentence, previous):
+    return json.dumps({"marker": marker, "sentence": sentence, "previous": previous}) + "\n"
+
+
+class RecordWriter(object):
+    """
+    Buffers records and appends them to the output every buffer_size records.
+    Keeps per-marker counts for VERSION.txt.
+    """
+
+    def __init__(self, output_dir, marker_set_tag, shard_by_marker=False, buffer_size=10000, resume_state=None,
+                 dedup=None, append=False):
+        """
+        :param dedup: drop records whose (marker, sentence, previous) was written before,
+                      see dedup.py. counts only include the records that are kept.
+        :param append: add to the records that are already there (in their layout)
+                       instead of starting from scratch
+        """
+        self.shard_by_marker = shard_by_marker
+        self.buffer_size = buffer_size
+        self.counts = {}
+        self.buffer = []
+        self.dedup = dedup
+        self.duplicates = 0
+
+        if resume_state is not None:
+            self.resume(output_dir, marker_set_tag, resume_state)
+            return
+
+        if append and find_records(output_dir, marker_set_tag) is not None:
+            self.append(output_dir, marker_set_tag)
+            return
+
+        # start from scratch, and make sure the parse stage
+        # does not pick up records of the other layout
+        shard_dir = marker_shard_dir(output_dir, marker_set_tag)
+        if os.path.exists(shard_dir):
+            for file_name in os.listdir(shard_dir):
+                os.remove(pjoin(shard_dir, file_name))
+            os.rmdir(shard_dir)
+        if os.path.exists(jsonl_path(output_dir, marker_set_tag)):
+            os.remove(jsonl_path(output_dir, marker_set_tag))
+
+        if shard_by_marker:
+            self.path = shard_dir
+            os.makedirs(self.path)
+        else:
+            self.path = jsonl_path(output_dir, marker_set_tag)
+            open(self.path, 'wb').close()
+
+    def resume(self, output_dir, marker_set_tag, state):
+        """
+        Continue the output described by state(), records
+        written after that state are dropped.
+        """
+        self.shard_by_marker = state["shard_by_marker"]
+        self.counts = dict(state["counts"])
+        sizes = state["sizes"]
+
+        if self.shard_by_marker:
+            self.path = marker_shard_dir(output_dir, marker_set_tag)
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            for file_name in os.listdir(self.path):
+                if file_name in sizes:
+                    truncate_file(pjoin(self.path, file_name), sizes[file_name])
+                else:
+                    os.remove(pjoin(self.path, file_name))
+        else:
+            self.path = jsonl_path(output_dir, marker_set_tag)
+            truncate_file(self.path, sizes[os.path.basename(self.path)])
+
+        self.seed_dedup()
+
+    def append(self, output_dir, marker_set_tag):
+        self.path = find_records(output_dir, marker_set_tag)
+        if not self.path.endswith(".jsonl") and not os.path.isdir(self.path):
+            raise Exception("cannot append to the old json format in {}".format(self.path))
+        self.shard_by_marker = os.path.isdir(self.path)
+        self.seed_dedup()
+
+    def seed_dedup(self):
+        # records on disk count as seen
+        if self.dedup is not None:
+            for record in self.read_back():
+                self.dedup.add(record)
+
+    def read_back(self):
+        if self.shard_by_marker:
+            for file_name in sorted(os.listdir(self.path)):
+                for record in _read_jsonl(pjoin(self.path, file_name)):
+                    yield record
+        else:
+            for record in _read_jsonl(self.path):
+                yield record
+
+    def state(self):
+        """
+        Flush and sync the output, and return what is needed to resume it:
+        the size of every record file (one per marker with shard_by_marker) and the counts.
+        """
+        self.flush()
+        if self.shard_by_marker:
+            paths = [pjoin(self.path, file_name) for file_name in os.listdir(self.path)]
+        else:
+            paths = [self.path]
+
+        sizes = {}
+        for path in paths:
+            sync_file(path)
+            sizes[os.path.basename(path)] = os.path.getsize(path)
+        return {"shard_by_marker": self.shard_by_marker, "counts": self.counts, "sizes": sizes}
+
+    def write(self, marker, sentence, previous):
+        if self.dedup is not None and not self.dedup.add((marker, sentence, previous)):
+            self.duplicates += 1
+            return
+        self.buffer.append((marker, sentence, previous))
+        self.counts[marker] = self.counts.get(marker, 0) + 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.shard_by_marker:
+            by_marker = {}
+            for record in self.buffer:
+                by_marker.setdefault(record[0], []).append(encode_record(*record))
+            for marker, lines in by_marker.items():
+                with open(pjoin(self.path, marker_file_name(marker)), 'ab') as f:
+                    f.writelines(lines)
+        else:
+            with open(self.path, 'ab') as f:
+                f.writelines(encode_record(*record) for record in self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_jsonl(file_path, start=0, end=None):
+    """
+    :param start: byte offset of the first record
+    :param end: byte offset to stop at, the end of the file by default
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while end is None or position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            record = json.loads(line)
+            yield record["marker"], record["sentence"], record["previous"]
+
+
+def find_records(input_dir, marker_set_tag):
+    """
+    :return: path of whichever record format the filter stage wrote, None if there is none
+    """
+    for path in [jsonl_path(input_dir, marker_set_tag),
+                 marker_shard_dir(input_dir, marker_set_tag),
+                 legacy_json_path(input_dir, marker_set_tag)]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_records(input_dir, marker_set_tag):
+    """
+    yields (marker, sentence, previous) from the filter stage output
+    """
+    path = find_records(input_dir, marker_set_tag)
+    if path is None:
+        raise Exception("no filtered sentences for {} in {}".format(marker_set_tag, input_dir))
+
+    if os.path.isdir(path):
+        for file_name in sorted(os.listdir(path)):
+            for record in _read_jsonl(pjoin(path, file_name)):
+                yield record
+    elif path.endswith(".jsonl"):
+        for record in _read_jsonl(path):
+            yield record
+    else:
+        # old format, this one has to be loaded at once
+        with open(path, 'rb') as f:
+            sentences = json.load(f)
+        for marker, slists in sentences.iteritems():
+            for sentence, previous in zip(slists["sentence"], slists["previous"]):
+                yield marker, sentence, previous
+
+
+def record_files(input_dir, marker_set_tag):
+    """
+    :return: [(name, path)] of the jsonl files the filter stage wrote, in reading order
+    """
+    path = find_records(input_dir, marker_set_tag)
+    if path is None:
+        raise Exception("no filtered sentences for {} in {}".format(marker_set_tag, input_dir))
+
+    if os.path.isdir(path):
+        return [(pjoin(marker_set_tag, file_name), pjoin(path, file_name)) for file_name in sorted(os.listdir(path))]
+    elif path.endswith(".jsonl"):
+        return [(os.path.basename(path), path)]
+    raise Exception("{} is in the old json format, it can only be read as a whole".format(path))
+
+
+def read_record_ranges(ranges):
+    """
+    :param ranges: [(name, path, start, end)] byte ranges of record files
+    """
+    for _, path, start, end in ranges:
+        for record in _read_jsonl(path, start, end):
+            yield record
+
+
+def number_records(records, discourse_markers, seen, done=0):
+    """
+    Number the records the parse stage works on, leaving out records of other
+    markers and records that were seen before.
+
+    :param seen: dedup object, see dedup.py
+    :param done: records up to this number were handled by an earlier run
+    :return: generator of (i, marker, sentence, previous) for i > done
+    """
+    i = 0
+    for marker, sentence, previous in records:
+        if marker not in discourse_markers or not seen.add((marker, sentence, previous)):
+            continue
+        i += 1
+        if i > done:
+            yield i, marker, sentence, previous
+
+
+def read_statistics(markers_dir):
+    """
+    :return: {marker: count} from VERSION.txt, empty if there is none
+    """
+    counts = {}
+    path = pjoin(markers_dir, "VERSION.txt")
+    if not os.path.exists(path):
+        return counts
+    with open(path, 'rb') as f:
+        lines = f.read().split("markers:\n", 1)[-1].split("\n")
+    for line in lines:
+        if "\t" in line:
+            marker, count = line.rsplit("\t", 1)
+            counts[marker] = int(count)
+    return counts
+
+
+def update_statistics(markers_dir, counts):
+    """
+    Add counts of newly filtered sentences to VERSION.txt
+    """
+    total = read_statistics(markers_dir)
+    for marker in counts:
+        total[marker] = total.get(marker, 0) + counts[marker]
+    write_statistics(markers_dir, total)
+
+
+def write_statistics(markers_dir, counts):
+    """
+    :param counts: {marker: number of filtered sentences}
+    """
+    statistics_lines = []
+    for marker in counts:
+        statistics_lines.append("{}\t{}".format(marker, counts[marker]))
+
+    statistics_report = "\n".join(statistics_lines)
+    with open(pjoin(markers_dir, "VERSION.txt"), "wb") as f:
+        f.write(
+            "commit: \n\ncommand: \n\nmarkers:\n" + statistics_report
+        )
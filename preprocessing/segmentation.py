@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cached Punkt sentence segmentation.
+
+Sentence boundaries of a corpus file are computed once, in a process pool,
+and stored next to it as {file}.{tokenizer}.sentidx:
+
+    {"file_hash": ..., "tokenizer": ..., "version": ...}
+    0:57 58:130
+    <one line of start:end character offsets per line of the corpus file>
+
+The index is reused as long as the file hash and the tokenizer version match,
+so rerunning the filter stage with other markers or length thresholds
+does not segment the corpus again.
+"""
+
+import io
+import os
+import json
+import hashlib
+import logging
+from itertools import imap, islice, izip
+from multiprocessing import Pool
+
+import nltk
+
+logger = logging.getLogger(__name__)
+
+CHUNK_LINES = 2000
+
+_tokenizers = {}
+
+
+def load_tokenizer(tokenizer_name):
+    # one per process
+    if tokenizer_name not in _tokenizers:
+        _tokenizers[tokenizer_name] = nltk.data.load('tokenizers/punkt/{}.pickle'.format(tokenizer_name))
+    return _tokenizers[tokenizer_name]
+
+
+def tokenizer_version(tokenizer_name):
+    return "punkt/{} nltk-{}".format(tokenizer_name, nltk.__version__)
+
+
+def file_hash(file_path):
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def index_path(file_path, tokenizer_name):
+    return "{}.{}.sentidx".format(file_path, tokenizer_name)
+
+
+def segment_lines(job):
+    """
+    Runs in a worker process.
+
+    :param job: (tokenizer_name, list of lines)
+    :return: one "start:end start:end" string per line
+    """
+    tokenizer_name, lines = job
+    tokenizer = load_tokenizer(tokenizer_name)
+    encoded = []
+    for line in lines:
+        if line.strip():
+            spans = tokenizer.span_tokenize(line)
+            encoded.append(" ".join("{}:{}".format(start, end) for start, end in spans))
+        else:
+            encoded.append("")
+    return encoded
+
+
+def _read_chunks(file_path, tokenizer_name):
+    with io.open(file_path, 'rU', encoding="utf-8") as f:
+        while True:
+            lines = list(islice(f, CHUNK_LINES))
+            if not lines:
+                return
+            yield tokenizer_name, lines
+
+
+def build_index(file_path, tokenizer_name, header, workers=1):
+    logger.info("segmenting {} with {} processes".format(file_path, workers))
+
+    if workers > 1:
+        pool = Pool(workers)
+        chunk_map = pool.imap
+    else:
+        pool = None
+        chunk_map = imap
+
+    path = index_path(file_path, tokenizer_name)
+    with open(path + ".tmp", 'wb') as f:
+        f.write(json.dumps(header) + "\n")
+        for encoded in chunk_map(segment_lines, _read_chunks(file_path, tokenizer_name)):
+            f.writelines(line + "\n" for line in encoded)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # only a complete index is ever picked up
+    os.rename(path + ".tmp", path)
+
+
+def ensure_index(file_path, tokenizer_name, workers=1):
+    header = {"file_hash": file_hash(file_path), "tokenizer": tokenizer_name,
+              "version": tokenizer_version(tokenizer_name)}
+
+    path = index_path(file_path, tokenizer_name)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if json.loads(f.readline()) == header:
+                logger.info("reusing sentence boundaries from {}".format(path))
+                return path
+        logger.info("{} is stale".format(path))
+
+    build_index(file_path, tokenizer_name, header, workers=workers)
+    return path
+
+
+def iter_segmented_lines(file_path, tokenizer_name, workers=1):
+    """
+    yields (line, sentences of the line) for every line of file_path
+    """
+    path = ensure_index(file_path, tokenizer_name, workers=workers)
+
+    with io.open(file_path, 'rU', encoding="utf-8") as f, open(path, 'rb') as index:
+        index.readline()  # header
+        for line, spans in izip(f, index):
+            sentences = []
+            for span in spans.split():
+                start, end = span.split(":")
+                sentences.append(line[int(start):int(end)])
+            yield line, sentences
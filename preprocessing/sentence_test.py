@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of parser.Sentence against the dependency lookups it replaced
+(benchmark.reference_sentence), on random dependency trees and on the
+recorded parses of the parser tests:
+
+    python -m unittest sentence_test
+"""
+
+import os
+import sys
+import json
+import random
+import unittest
+
+import parser
+import benchmark
+from benchmark import fake_cases, reference_sentence
+from corenlp_standin import load_fixtures, fixtures_path_for_tests
+from parser import Sentence, cleanup, parsed_text, dependency_patterns
+
+ReferenceSentence = reference_sentence()
+
+
+def pairs(sentence_class, cases, lang):
+    # find_pair prints the sentences it can not align
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        return [sentence_class(parse, sentence, lang).find_pair(marker, "any", previous, lang=lang)
+                for marker, sentence, previous, parse in cases]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def phrases(sentence_class, cases, lang):
+    # the phrase of every token, on its own, without two other tokens and without some relations
+    found = []
+    for _, sentence, _, parse in cases:
+        parsed_sentence = sentence_class(parse, sentence, lang)
+        n = len(parse["tokens"])
+        for h in range(1, n + 1):
+            found.append((parsed_sentence.get_phrase_from_head(h),
+                          parsed_sentence.get_phrase_from_head(h, exclude_indices=[(h*7) % n + 1, (h*3) % n + 1]),
+                          parsed_sentence.get_phrase_from_head(h, exclude_types=["mark", "cc", "punct"])))
+    return found
+
+
+def fixture_cases(lang):
+    # every sentence of the recorded parse of every parser test item, with the marker of the item
+    tests_path = "{}_tests.json".format(lang)
+    fixtures = load_fixtures(fixtures_path_for_tests(tests_path))
+    with open(tests_path) as f:
+        items = json.load(f)["test_items"]
+    cases = []
+    for item in items:
+        sentence = cleanup(item["sentence"].strip(), lang)
+        text = parsed_text(sentence.encode("utf-8"), lang).decode("utf-8")
+        if item["marker"] not in dependency_patterns[lang] or text not in fixtures:
+            continue
+        for parse in fixtures[text]:
+            cases.append((item["marker"], sentence, item["previous_sentence"].strip(), parse))
+    return cases
+
+
+def shuffled(cases, seed):
+    # the same trees, their dependencies in another order
+    rnd = random.Random(seed)
+    for _, _, _, parse in cases:
+        rnd.shuffle(parse["basicDependencies"])
+    return cases
+
+
+def with_second_governors(cases, seed):
+    # one token of every tree has a second governor
+    rnd = random.Random(seed)
+    for _, _, _, parse in cases:
+        n = len(parse["tokens"])
+        parse["basicDependencies"].append({"dep": rnd.choice(["dep", "conj", "advcl", "mark"]),
+                                           "governor": rnd.randint(1, n), "dependent": rnd.randint(1, n)})
+    return cases
+
+
+def with_cycles(cases, seed):
+    # a token governs itself, or the governor of one of its children
+    rnd = random.Random(seed)
+    for k, (_, _, _, parse) in enumerate(cases):
+        dependencies = parse["basicDependencies"]
+        d = rnd.randrange(1, len(dependencies)) if len(dependencies) > 1 else 0
+        if k % 2:
+            dependencies[d]["governor"] = dependencies[d]["dependent"]
+        else:
+            governor = dependencies[d]["governor"]
+            for dependency in dependencies:
+                if dependency["dependent"] == governor:
+                    dependency["governor"] = dependencies[d]["dependent"]
+    return cases
+
+
+def as_chains(cases):
+    # every token governs the next one, long sentences are deeper than the 15 levels phrases go down
+    for _, _, _, parse in cases:
+        parse["basicDependencies"] = [{"dep": "ROOT" if i == 1 else "dep", "governor": i - 1, "dependent": i}
+                                      for i in range(1, len(parse["tokens"]) + 1)]
+    return cases
+
+
+class FindPairTest(unittest.TestCase):
+
+    def check_against_reference(self, lang, cases):
+        old = pairs(ReferenceSentence, cases, lang)
+        new = pairs(Sentence, cases, lang)
+        self.assertEqual(old, new)
+        # not only None on both sides
+        self.assertGreater(sum(1 for pair in new if pair), len(cases) // 50)
+
+    def test_en(self):
+        self.check_against_reference("en", fake_cases("en", 1000, seed=1))
+
+    def test_sp(self):
+        self.check_against_reference("sp", fake_cases("sp", 400, seed=2))
+
+    def test_ch(self):
+        self.check_against_reference("ch", fake_cases("ch", 300, seed=3))
+
+    def test_shuffled_dependencies(self):
+        # CoreNLP lists the root first and the rest by dependent, nothing relies on that
+        for n, lang in enumerate(["en", "sp", "ch"]):
+            self.check_against_reference(lang, shuffled(fake_cases(lang, 400, seed=n), seed=n))
+
+    def test_benchmarks_need_parses(self):
+        get_parses = parser.get_parses
+        parser.get_parses = lambda sentences: [None] * len(sentences)
+        self.addCleanup(setattr, parser, "get_parses", get_parses)
+        args = benchmark.parser.parse_args([])
+        for task in [benchmark.find_pair_benchmark, benchmark.compact_parse_benchmark, benchmark.subphrase_benchmark]:
+            with self.assertRaises(Exception) as raised:
+                task(args)
+            self.assertIn("no parses", str(raised.exception))
+
+    def test_fixtures(self):
+        for lang in ["en", "sp", "ch"]:
+            cases = fixture_cases(lang)
+            self.assertEqual(pairs(ReferenceSentence, cases, lang), pairs(Sentence, cases, lang))
+
+
+class PhraseTest(unittest.TestCase):
+
+    def check_against_reference(self, lang, cases):
+        old = phrases(ReferenceSentence, cases, lang)
+        new = phrases(Sentence, cases, lang)
+        self.assertEqual(old, new)
+        return new
+
+    def test_trees(self):
+        for n, lang in enumerate(["en", "sp", "ch"]):
+            self.check_against_reference(lang, fake_cases(lang, 200, seed=n))
+
+    def test_second_governors(self):
+        for n, lang in enumerate(["en", "sp", "ch"]):
+            self.check_against_reference(lang, with_second_governors(fake_cases(lang, 200, seed=n), seed=n))
+
+    def test_cycles(self):
+        for n, lang in enumerate(["en", "sp", "ch"]):
+            self.check_against_reference(lang, with_cycles(fake_cases(lang, 200, seed=n), seed=n))
+
+    def test_depth(self):
+        found = self.check_against_reference("en", as_chains(fake_cases("en", 200, seed=4)))
+        self.assertIn((None, None, None), found)
+        # a chain of 17 tokens is too deep from its first token, not from its second
+        words = u" ".join([u"word"] * 16) + u" ."
+        case = as_chains([(None, words, None, benchmark.fake_parse(words, "en", random.Random(0)))])
+        for sentence_class in [ReferenceSentence, Sentence]:
+            parsed_sentence = sentence_class(case[0][3], words, "en")
+            self.assertIsNone(parsed_sentence.get_phrase_from_head(1))
+            self.assertIsNotNone(parsed_sentence.get_phrase_from_head(2))
+
+    def test_fixtures(self):
+        for lang in ["en", "sp", "ch"]:
+            self.check_against_reference(lang, fixture_cases(lang))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Split large line-oriented corpus files into byte ranges
+so that they can be read by several processes at once.
+
+Shard boundaries always fall on the start of a line, and
+every line belongs to exactly one shard.
+"""
+
+import os
+
+_BLOCK_SIZE = 1 << 16
+
+
+def find_shards(file_path, n_shards):
+    """
+    :param file_path:
+    :param n_shards: number of shards wanted, fewer are returned for small files
+    :return: list of (start, end) byte offsets, end exclusive
+    """
+    size = os.path.getsize(file_path)
+    offsets = [0]
+
+    with open(file_path, 'rb') as f:
+        for k in range(1, n_shards):
+            target = size * k // n_shards
+            if target <= offsets[-1]:
+                continue
+            # move to the first line that starts at or after target
+            f.seek(target - 1)
+            f.readline()
+            if f.tell() > offsets[-1] and f.tell() < size:
+                offsets.append(f.tell())
+
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+
+def decode_line(line):
+    # same result as io.open(..., 'rU', encoding="utf-8")
+    line = line.decode("utf-8")
+    if line.endswith(u"\r\n"):
+        line = line[:-2] + u"\n"
+    elif line.endswith(u"\r"):
+        line = line[:-1] + u"\n"
+    return line
+
+
+def read_line_before(f, offset):
+    """
+    :return: the line that ends right before byte offset, "" at the start of the file
+    """
+    if offset == 0:
+        return u""
+
+    # grow the window backwards until it holds a full line
+    window_start = offset
+    block = b""
+    while True:
+        window_start = max(0, window_start - _BLOCK_SIZE)
+        f.seek(window_start)
+        block = f.read(offset - window_start)
+        line_start = block.rfind(b"\n", 0, len(block) - 1)
+        if line_start >= 0 or window_start == 0:
+            return decode_line(block[line_start + 1:])
+
+
+def iter_shard_lines(file_path, start, end):
+    """
+    yields (previous_line, line) for every line starting in [start, end),
+    previous_line of the very first line in the file is ""
+    """
+    with open(file_path, 'rb') as f:
+        previous = read_line_before(f, start)
+
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            line = decode_line(line)
+            yield previous, line
+            previous = line